@@ -117,13 +117,16 @@ def _fetch(filename):
         return tmp
 
 
-def fetch_files(filenames, bucket_name, fn):
+def fetch_files(filenames, bucket_name, fn, processes=None):
     def init_pool():
         global _bucket
         global _fn
         _bucket = storage.Client().get_bucket(bucket_name)
         _fn = fn
 
-    with Pool(initializer=init_pool, processes=cpu_count() * 4) as pool:
+    if not processes:
+        processes = cpu_count() * 4
+
+    with Pool(initializer=init_pool, processes=processes) as pool:
         ret = pool.map(_fetch, filenames)
     return ret
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mmap
+import resource
+import numpy as np
+
+
+class SharedArray(object):
+    """ Zero filled numpy array backed by an anonymous shared mapping.
+
+    Create it in the parent before starting a Pool, the forked workers then
+    read and write the same memory instead of pickling arrays over pipes.
+    The mapping is not a file in /dev/shm, so it is not limited by the size
+    of that mount (64MB in a default container), only by the pod's memory.
+    Without shared it is a plain numpy array, for callers that don't fork.
+    """
+
+    def __init__(self, shape, dtype, shared=True):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        if not shared:
+            self._mmap = None
+            self.array = np.zeros(self.shape, dtype=self.dtype)
+            return
+        size = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+        self._mmap = mmap.mmap(-1, size, flags=mmap.MAP_SHARED)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self._mmap)
+
+    @property
+    def nbytes(self):
+        return self.array.nbytes
+
+    def close(self):
+        """ Unmap the memory, views of the array must be gone """
+        self.array = None
+        if self._mmap is None:
+            return
+        self._mmap.close()
+        self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def peak_memory():
+    """ Peak resident memory in bytes of this process and of its children """
+    self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return self_kb * 1024, children_kb * 1024
@@ -0,0 +1,325 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Index of the spectrogram objects of a bucket, by location and day, so
+# readers get the object names and metadata without a request per object.
+#
+#   _index/<location>/<YYYY>/<MM>/<DD>/<original filename>.json
+#
+# Every index object holds the chunks of one original file that start on
+# that day (UTC), written by the spectrogram job:
+#
+#   {"entries": {"<object name>": {"chunk": .., "start_time": .., "size": ..,
+#                                  "generation": .., "metadata": {..}}}}
+#
+# Compaction (spectrogram/tools/compact_shards.py) packs the objects of an
+# hour into one shard, _shards/<location>/<YYYY>/<MM>/<DD>/<HH>-<version>.bin,
+# and adds "shard", "offset" and "length" to their entries. A new version of
+# a shard never replaces an old one, so readers with a cached index keep
+# reading valid offsets. Consecutive rows in a shard are read with one
+# ranged download (see batches and read_batches).
+#
+# Outputs of a non default spectrogram config are named <config key>/<chunk>,
+# annotate with the config_key reads those.
+#
+#   index = spectrogram_index.load(bucket, location_name, time_start, time_end)
+#   spectrogram_index.annotate(rows, index, ['png'])
+#   groups = spectrogram_index.batches(rows, 'png')
+#   for row in spectrogram_index.read_batches(bucket, groups, 'png'):
+#       data, metadata = spectrogram_index.download(bucket, row, 'png')
+
+import collections
+import datetime
+import functools
+import hashlib
+import json
+import logging
+import time
+from multiprocessing.pool import ThreadPool
+
+from google.api_core import exceptions
+
+INDEX_PREFIX = '_index/'
+SHARD_PREFIX = '_shards/'
+# Bytes read from a shard with one request at most
+READ_BYTES = 64 * 1024**2
+# Batches read ahead of the rows returned by read_batches
+READ_THREADS = 8
+# Parallel downloads of the objects of a shard
+COMPACT_THREADS = 8
+# Chunks starting this long before a range can still overlap it
+MARGIN = datetime.timedelta(hours=1)
+# Seconds a day of the index is kept in memory
+CACHE_SECONDS = 600
+# Writes of an index object changed by another job meanwhile, before giving up
+WRITE_ATTEMPTS = 5
+
+_cache = {}
+
+
+def object_name(row, extension):
+    """ Object name of the spectrogram of a filelist row, in the config set by annotate """
+    return row.get('prefix', '') + row['filename'].replace('.mp3', '.wav') + '.' + extension
+
+
+def day_prefix(location_name, day):
+    return '%s%s/%04d/%02d/%02d/' % (INDEX_PREFIX, location_name, day.year, day.month, day.day)
+
+
+def index_name(location_name, day, original_filename):
+    return day_prefix(location_name, day) + original_filename + '.json'
+
+
+def shard_name(location_name, hour, version):
+    return '%s%s/%04d/%02d/%02d/%02d-%s.bin' % (SHARD_PREFIX, location_name, hour.year, hour.month, hour.day,
+                                                hour.hour, version)
+
+
+def entry(blob):
+    """ Index entry of an uploaded blob, the writer adds the chunk and its start_time """
+    return {
+        'size': blob.size,
+        'generation': blob.generation,
+        'metadata': blob.metadata,
+    }
+
+
+def write_object(bucket, name, entries, generation=None):
+    """ Replace the entries of one index object
+
+    With a generation the object is only replaced if it is still at that
+    generation, 0 if it does not exist yet, otherwise PreconditionFailed is
+    raised.
+    """
+    bucket.blob(name).upload_from_string(json.dumps({'entries': entries}, sort_keys=True),
+                                         content_type='application/json', if_generation_match=generation)
+    logging.info("Indexed %i objects in gs://%s/%s" % (len(entries), bucket.name, name))
+
+
+def update_object(bucket, name, update):
+    """ Read the entries of an index object, apply update(entries) and write them back
+
+    Jobs for the same original file can write its index objects at the same
+    time, the write is conditional on the generation that was read and is
+    retried on the new entries if another job wrote first.
+    """
+    for attempt in range(WRITE_ATTEMPTS):
+        blob = bucket.get_blob(name)
+        entries = json.loads(blob.download_as_string())['entries'] if blob is not None else {}
+        update(entries)
+        try:
+            write_object(bucket, name, entries, blob.generation if blob is not None else 0)
+            return entries
+        except exceptions.PreconditionFailed:
+            logging.warning("Index object gs://%s/%s was changed by another job, retrying" % (bucket.name, name))
+    raise RuntimeError("Could not write index object gs://%s/%s in %i attempts" % (bucket.name, name, WRITE_ATTEMPTS))
+
+
+def write(bucket, location_name, original_filename, entries):
+    """ Add entries (object name: entry) to the index objects of an original file, one per day """
+    by_day = {}
+    for (name, e) in entries.items():
+        day = datetime.datetime.strptime(e['start_time'][:10], '%Y-%m-%d').date()
+        by_day.setdefault(day, {})[name] = e
+
+    for (day, day_entries) in by_day.items():
+        update_object(bucket, index_name(location_name, day, original_filename),
+                      lambda existing: existing.update(day_entries))
+
+
+def load_objects(bucket, location_name, day):
+    """ Entries of every index object of a day, by index object name """
+    return dict((blob.name, json.loads(blob.download_as_string())['entries'])
+                for blob in bucket.list_blobs(prefix=day_prefix(location_name, day)))
+
+
+def load_day(bucket, location_name, day):
+    """ Entries of all original files of a day, cached for CACHE_SECONDS """
+    key = (bucket.name, location_name, day)
+    cached = _cache.get(key)
+    if cached and time.time() - cached[0] < CACHE_SECONDS:
+        return cached[1]
+
+    entries = {}
+    for object_entries in load_objects(bucket, location_name, day).values():
+        entries.update(object_entries)
+    _cache[key] = (time.time(), entries)
+    return entries
+
+
+def load(bucket, location_name, time_start, time_end):
+    """ Entries of the chunks that can overlap time_start to time_end, empty if there is no index """
+    entries = {}
+    day = (time_start - MARGIN).date()
+    try:
+        while day <= time_end.date():
+            entries.update(load_day(bucket, location_name, day))
+            day += datetime.timedelta(days=1)
+    except Exception as e:
+        logging.warning("Could not load spectrogram index of %s: %s" % (location_name, e))
+    return entries
+
+
+def annotate(rows, index, extensions, config_key=None):
+    """ Set row['index'] to the entries of the spectrograms of every row by extension
+
+    With a config_key the spectrograms of that config (see
+    spectrogram.config_prefix) are read instead of the default ones.
+    """
+    for row in rows:
+        row['prefix'] = config_key + '/' if config_key else ''
+        row['index'] = dict((ext, index.get(object_name(row, ext))) for ext in extensions)
+
+
+def batches(rows, extension, max_bytes=READ_BYTES):
+    """ Consecutive rows grouped into batches that are read together
+
+    Rows whose objects follow each other in a shard share a batch, up to
+    max_bytes. Other rows are a batch of their own.
+    """
+    groups = []
+    reads = []
+    for row in rows:
+        e = (row.get('index') or {}).get(extension)
+        if e is None or not e.get('shard'):
+            groups.append([row])
+            reads.append(None)
+            continue
+        end = e['offset'] + e['length']
+        read = reads[-1] if reads else None
+        if read and read[0] == e['shard'] and read[2] == e['offset'] and end - read[1] <= max_bytes:
+            groups[-1].append(row)
+            reads[-1] = (read[0], read[1], end)
+        else:
+            groups.append([row])
+            reads.append((e['shard'], e['offset'], end))
+    return groups
+
+
+def read_batch(bucket, group, extension):
+    """ The rows of a batch, as copies with their contents if the batch is in a shard
+
+    The batch is read with one ranged download and row['data'][extension]
+    of every row is set to its contents and metadata. When the read fails
+    the rows are returned as they are and download reads them one by one.
+    """
+    first = (group[0].get('index') or {}).get(extension)
+    if first is None or not first.get('shard'):
+        return group
+    last = group[-1]['index'][extension]
+    try:
+        data = bucket.blob(first['shard']).download_as_string(start=first['offset'],
+                                                              end=last['offset'] + last['length'] - 1)
+    except Exception as e:
+        logging.warning("Could not read %i objects from gs://%s/%s: %s" % (len(group), bucket.name, first['shard'], e))
+        return group
+    read = []
+    for row in group:
+        e = row['index'][extension]
+        start = e['offset'] - first['offset']
+        read.append(dict(row, data={extension: (data[start:start + e['length']], e['metadata'])}))
+    return read
+
+
+def read_batches(bucket, groups, extension, threads=READ_THREADS):
+    """ The rows of the batches in order, the ones in a shard with their contents (see read_batch)
+
+    The batches are read in threads, up to threads batches ahead. Only the
+    I/O happens here, the rows are decoded where download is called on them.
+    """
+    with ThreadPool(threads) as pool:
+        pending = collections.deque()
+        for group in groups:
+            pending.append(pool.apply_async(read_batch, (bucket, group, extension)))
+            if len(pending) > threads:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+
+def download(bucket, row, extension):
+    """ Contents and metadata of the spectrogram of a row, (None, None) if it does not exist
+
+    Rows from read_batches have their contents already. With an index entry
+    in the row the metadata comes from the index and the object is read from
+    its shard or downloaded directly, otherwise the blob is looked up first.
+    """
+    name = object_name(row, extension)
+    read = row.get('data', {}).get(extension)
+    if read is not None:
+        return read
+    e = (row.get('index') or {}).get(extension)
+    if e is not None and e.get('shard'):
+        end = e['offset'] + e['length'] - 1
+        return bucket.blob(e['shard']).download_as_string(start=e['offset'], end=end), e['metadata']
+    if e is not None:
+        return bucket.blob(name).download_as_string(), e['metadata']
+    blob = bucket.get_blob(name)
+    if blob is None:
+        return None, None
+    return blob.download_as_string(), blob.metadata
+
+
+def compact(bucket, location_name, day, extension='png', force=False):
+    """ Pack the objects of every hour of a day into a shard, returns the number of shards written
+
+    Hours whose objects are all in a shard already are skipped unless force.
+    """
+    objects = load_objects(bucket, location_name, day)
+    hours = {}
+    for (index_object, entries) in objects.items():
+        for (name, e) in entries.items():
+            if name.endswith('.' + extension):
+                hour = e['start_time'][:13]
+                hours.setdefault(hour, []).append((e['start_time'], name, index_object))
+
+    def read(member):
+        # The generation in the index, the object can have been written again since
+        (_, name, o) = member
+        return bucket.blob(name, generation=objects[o][name]['generation']).download_as_string()
+
+    written = 0
+    packed = {}
+    for hour in sorted(hours):
+        members = sorted(hours[hour])
+        if not force and all(objects[o][name].get('shard') for (_, name, o) in members):
+            continue
+
+        with ThreadPool(COMPACT_THREADS) as pool:
+            data = pool.map(read, members)
+        version = hashlib.sha1(json.dumps([(name, objects[o][name]['generation'])
+                                           for (_, name, o) in members]).encode()).hexdigest()[:12]
+        shard = shard_name(location_name, datetime.datetime.strptime(hour, '%Y-%m-%dT%H'), version)
+        bucket.blob(shard).upload_from_string(b''.join(data), content_type='application/octet-stream')
+
+        offset = 0
+        for ((_, name, o), d) in zip(members, data):
+            packed.setdefault(o, {})[name] = (objects[o][name]['generation'],
+                                              {'shard': shard, 'offset': offset, 'length': len(d)})
+            offset += len(d)
+        written += 1
+        logging.info("Packed %i objects (%i bytes) in gs://%s/%s" % (len(members), offset, bucket.name, shard))
+
+    def place(placements, entries):
+        # An object the spectrogram job wrote again since is not the one in the shard
+        for (name, (generation, placement)) in placements.items():
+            if name in entries and entries[name]['generation'] == generation:
+                entries[name].update(placement)
+
+    for o in sorted(packed):
+        update_object(bucket, o, functools.partial(place, packed[o]))
+    return written
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import io
+import unittest
+import numpy as np
+from PIL import Image
+from common_lib import image_encoding
+
+
+class TestImageEncoding(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.array = rng.randint(0, 256, (64, 128)).astype(np.uint8)
+        self.im = Image.fromarray(self.array)
+
+    def testFormats(self):
+        for (name, (pil_format, content_type, _)) in image_encoding.FORMATS.items():
+            decoded = Image.open(io.BytesIO(image_encoding.encode(self.im, name)))
+            self.assertEqual(decoded.format, pil_format)
+            self.assertEqual(decoded.size, self.im.size)
+            self.assertEqual(image_encoding.content_type(name), content_type)
+
+    def testLossless(self):
+        decoded = Image.open(io.BytesIO(image_encoding.encode(self.im, 'png')))
+        np.testing.assert_array_equal(np.asarray(decoded), self.array)
+
+    def testProgressive(self):
+        decoded = Image.open(io.BytesIO(image_encoding.encode(self.im, 'progressive')))
+        self.assertTrue(decoded.info.get('progressive'))
+        decoded = Image.open(io.BytesIO(image_encoding.encode(self.im, 'jpeg')))
+        self.assertFalse(decoded.info.get('progressive'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import datetime
+import unittest
+import pytz
+from google.api_core import exceptions
+from common_lib import spectrogram_index
+
+
+class Blob(object):
+    """ Blob of a Bucket in memory """
+
+    def __init__(self, bucket, name, generation=None):
+        self.bucket = bucket
+        self.name = name
+        self.generation = generation
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        generation = self.bucket.generations.get(self.name, 0)
+        if if_generation_match is not None and if_generation_match != generation:
+            raise exceptions.PreconditionFailed('Generation %i of %s' % (generation, self.name))
+        self.bucket.objects[self.name] = data if isinstance(data, bytes) else data.encode()
+        self.bucket.generations[self.name] = generation + 1
+        self.bucket.versions[(self.name, generation + 1)] = self.bucket.objects[self.name]
+
+    def download_as_string(self, start=None, end=None):
+        self.bucket.downloads += 1
+        if self.name in self.bucket.failing:
+            raise OSError('Service unavailable')
+        if self.generation is None:
+            data = self.bucket.objects[self.name]
+        else:
+            data = self.bucket.versions[(self.name, self.generation)]
+        # end is inclusive like in storage
+        return data[start or 0:None if end is None else end + 1]
+
+
+class Bucket(object):
+    """ The part of a storage bucket the index uses, in memory """
+
+    def __init__(self, name='spectrograms'):
+        self.name = name
+        self.objects = {}
+        self.generations = {}
+        self.versions = {}
+        self.failing = set()
+        self.lookups = 0
+        self.downloads = 0
+
+    def blob(self, name, generation=None):
+        return Blob(self, name, generation)
+
+    def get_blob(self, name):
+        self.lookups += 1
+        if name not in self.objects:
+            return None
+        blob = Blob(self, name)
+        blob.metadata = {'db_min': '-80'}
+        blob.generation = self.generations.get(name, 0)
+        return blob
+
+    def list_blobs(self, prefix):
+        return [Blob(self, name) for name in sorted(self.objects) if name.startswith(prefix)]
+
+
+def row(i, start):
+    return {'filename': 'x.%04d.mp3' % i, 'start_time': start, 'original_filename': 'x.wav'}
+
+
+def entry(r):
+    return {spectrogram_index.object_name(r, 'png'): {'chunk': r['filename'], 'start_time': r['start_time'].isoformat(),
+                                                      'size': 3, 'generation': 1, 'metadata': {}}}
+
+
+class TestSpectrogramIndex(unittest.TestCase):
+
+    def setUp(self):
+        spectrogram_index._cache.clear()
+        self.bucket = Bucket()
+        # Chunks of one original file before and after midnight
+        midnight = datetime.datetime(2015, 1, 2, tzinfo=pytz.utc)
+        self.rows = [row(i, midnight + datetime.timedelta(seconds=40 * (i - 2))) for i in range(4)]
+        entries = {}
+        for r in self.rows:
+            name = spectrogram_index.object_name(r, 'png')
+            self.bucket.blob(name).upload_from_string(('png%i' % r['start_time'].hour).encode())
+            entries[name] = {'chunk': r['filename'], 'start_time': r['start_time'].isoformat(),
+                             'size': 5, 'generation': 1, 'metadata': {'db_min': '-80', 'db_max': '10'}}
+        spectrogram_index.write(self.bucket, 'Hawaii', 'x.wav', entries)
+        self.bucket.lookups = 0
+
+    def testDays(self):
+        self.assertIn('_index/Hawaii/2015/01/01/x.wav.json', self.bucket.objects)
+        self.assertIn('_index/Hawaii/2015/01/02/x.wav.json', self.bucket.objects)
+        index = spectrogram_index.load(self.bucket, 'Hawaii', self.rows[0]['start_time'], self.rows[-1]['start_time'])
+        self.assertEqual(len(index), 4)
+
+    def testDownload(self):
+        index = spectrogram_index.load(self.bucket, 'Hawaii', self.rows[0]['start_time'], self.rows[-1]['start_time'])
+        spectrogram_index.annotate(self.rows, index, ['png'])
+        data, metadata = spectrogram_index.download(self.bucket, self.rows[0], 'png')
+        self.assertEqual(data, b'png23')
+        self.assertEqual(metadata['db_max'], '10')
+        self.assertEqual(self.bucket.lookups, 0)
+
+        # Without an entry the blob is looked up
+        data, metadata = spectrogram_index.download(self.bucket, row(0, self.rows[0]['start_time']), 'png')
+        self.assertEqual(data, b'png23')
+        self.assertEqual(self.bucket.lookups, 1)
+
+    def testConfigKey(self):
+        # Outputs of a non default config are prefixed with its key
+        r = dict(self.rows[0])
+        name = 'abc/' + spectrogram_index.object_name(r, 'png')
+        self.bucket.objects[name] = b'stft'
+        entry = {'chunk': r['filename'], 'start_time': r['start_time'].isoformat(), 'size': 4,
+                 'generation': 1, 'metadata': {'mode': 'stft'}}
+        spectrogram_index.write(self.bucket, 'Hawaii', 'x.wav', {name: entry})
+        index = spectrogram_index.load(self.bucket, 'Hawaii', r['start_time'], r['start_time'])
+        spectrogram_index.annotate([r], index, ['png'], config_key='abc')
+        data, metadata = spectrogram_index.download(self.bucket, r, 'png')
+        self.assertEqual(data, b'stft')
+        self.assertEqual(metadata['mode'], 'stft')
+
+    def testMerged(self):
+        # A later run adds entries to the index of the day
+        r = row(9, self.rows[-1]['start_time'])
+        entry = {'chunk': r['filename'], 'start_time': r['start_time'].isoformat(), 'size': 3,
+                 'generation': 1, 'metadata': {}}
+        spectrogram_index.write(self.bucket, 'Hawaii', 'x.wav', {spectrogram_index.object_name(r, 'png'): entry})
+        index = spectrogram_index.load(self.bucket, 'Hawaii', r['start_time'], r['start_time'])
+        self.assertEqual(len(index), 5)
+
+    def testConcurrentWrite(self):
+        # Another job writes the index of the day between the read and the write of this one
+        (r, other) = (row(9, self.rows[-1]['start_time']), row(8, self.rows[-1]['start_time']))
+        get_blob = self.bucket.get_blob
+
+        def racing_get_blob(name):
+            blob = get_blob(name)
+            self.bucket.get_blob = get_blob
+            spectrogram_index.write(self.bucket, 'Hawaii', 'x.wav', entry(other))
+            return blob
+
+        self.bucket.get_blob = racing_get_blob
+        spectrogram_index.write(self.bucket, 'Hawaii', 'x.wav', entry(r))
+        index = spectrogram_index.load(self.bucket, 'Hawaii', r['start_time'], r['start_time'])
+        self.assertEqual(len(index), 6)
+
+    def testCompactGeneration(self):
+        # The object was written again after it was indexed, the shard has the indexed generation
+        name = spectrogram_index.object_name(self.rows[0], 'png')
+        self.bucket.blob(name).upload_from_string(b'newer')
+        spectrogram_index.compact(self.bucket, 'Hawaii', self.rows[0]['start_time'], 'png')
+        spectrogram_index._cache.clear()
+        index = spectrogram_index.load(self.bucket, 'Hawaii', self.rows[0]['start_time'], self.rows[0]['start_time'])
+        spectrogram_index.annotate(self.rows[:1], index, ['png'])
+        self.assertEqual(spectrogram_index.download(self.bucket, self.rows[0], 'png')[0], b'png23')
+
+    def testCompactConcurrentWrite(self):
+        # The spectrogram job writes a chunk again while its hour is packed
+        r = self.rows[-1]
+        name = spectrogram_index.object_name(r, 'png')
+        update_object = spectrogram_index.update_object
+
+        def racing_update_object(bucket, index_object, update):
+            spectrogram_index.update_object = update_object
+            e = dict(entry(r)[name], generation=2)
+            spectrogram_index.write(bucket, 'Hawaii', 'x.wav', {name: e})
+            return update_object(bucket, index_object, update)
+
+        spectrogram_index.update_object = racing_update_object
+        try:
+            spectrogram_index.compact(self.bucket, 'Hawaii', r['start_time'], 'png')
+        finally:
+            spectrogram_index.update_object = update_object
+        spectrogram_index._cache.clear()
+        index = spectrogram_index.load(self.bucket, 'Hawaii', r['start_time'], r['start_time'])
+        self.assertNotIn('shard', index[name])
+        self.assertIn('shard', index[spectrogram_index.object_name(self.rows[-2], 'png')])
+
+    def testCompact(self):
+        self.assertEqual(spectrogram_index.compact(self.bucket, 'Hawaii', self.rows[0]['start_time'], 'png'), 1)
+        self.assertEqual(spectrogram_index.compact(self.bucket, 'Hawaii', self.rows[0]['start_time'], 'png'), 0)
+        self.assertEqual(spectrogram_index.compact(self.bucket, 'Hawaii', self.rows[-1]['start_time'], 'png'), 1)
+        shards = [name for name in self.bucket.objects if name.startswith('_shards/Hawaii/2015/01/0')]
+        self.assertEqual(len(shards), 2)
+
+        spectrogram_index._cache.clear()
+        index = spectrogram_index.load(self.bucket, 'Hawaii', self.rows[0]['start_time'], self.rows[-1]['start_time'])
+        spectrogram_index.annotate(self.rows, index, ['png', 'npy'])
+        # The chunks of each day are read together
+        batches = spectrogram_index.batches(self.rows, 'png')
+        self.assertEqual([len(b) for b in batches], [2, 2])
+
+        self.bucket.downloads = 0
+        reads = list(spectrogram_index.read_batches(self.bucket, batches, 'png'))
+        data = [spectrogram_index.download(self.bucket, r, 'png')[0] for r in reads]
+        self.assertEqual(data, [b'png23', b'png23', b'png0', b'png0'])
+        self.assertEqual(self.bucket.downloads, 2)
+        # Another extension of a read row is read from its own shard
+        self.assertEqual(spectrogram_index.download(self.bucket, reads[0], 'npy'), (None, None))
+
+        # A failed shard read leaves the rows to be read one by one
+        self.bucket.failing.add(self.rows[0]['index']['png']['shard'])
+        reads = list(spectrogram_index.read_batches(self.bucket, batches, 'png'))
+        self.assertNotIn('data', reads[0])
+        self.assertEqual(reads[2]['data']['png'][0], b'png0')
+
+        # Small reads are not combined
+        batches = spectrogram_index.batches(self.rows, 'png', max_bytes=5)
+        self.assertEqual([len(b) for b in batches], [1, 1, 1, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import unittest
+import numpy as np
+from dateutil import tz
+from common_lib import timeline
+
+T0 = datetime.datetime(2015, 1, 12, 19, 0, 0, tzinfo=tz.tzutc())
+
+
+def row(start, end):
+    return {'start_time': T0 + datetime.timedelta(seconds=start),
+            'end_time': T0 + datetime.timedelta(seconds=end)}
+
+
+def chunk(value, length, height=3):
+    return np.full((length, height), value, dtype=np.uint8)
+
+
+class TestTimeline(unittest.TestCase):
+
+    def testOffsets(self):
+        starts, ends = timeline.offsets([row(-1.5, 2.5), row(2.5, 6.5)], T0)
+        np.testing.assert_array_equal(starts, [-1.5, 2.5])
+        np.testing.assert_array_equal(ends, [2.5, 6.5])
+
+    def testCropped(self):
+        # 2 px per second on a 10 px buffer
+        src, dst, count = timeline.placements([-1.5, 2.0, 4.5, 6.0], [8, 8, 8, 8], 2, 10)
+        np.testing.assert_array_equal(src, [3, 0, 0, 0])
+        np.testing.assert_array_equal(dst, [0, 4, 9, 12])
+        np.testing.assert_array_equal(count, [5, 6, 1, -2])
+
+    def testOffset(self):
+        src, dst, count = timeline.placements([-1.0, 0.0], [4, 4], 2, 10, offset=1)
+        np.testing.assert_array_equal(src, [1, 0])
+        np.testing.assert_array_equal(dst, [0, 1])
+        np.testing.assert_array_equal(count, [3, 4])
+
+    def testOverlapping(self):
+        arrays = [chunk(1, 6), chunk(2, 6), chunk(3, 6)]
+        src, dst, count = timeline.placements([0, 2, 4], [6, 6, 6], 1, 10)
+        buffer = np.zeros((10, 3), dtype=np.uint8)
+        mask = np.zeros(10, dtype=bool)
+        timeline.assemble(buffer, arrays, src, dst, count, mask=mask)
+        np.testing.assert_array_equal(buffer[:, 0], [1, 1, 2, 2, 3, 3, 3, 3, 3, 3])
+        self.assertTrue(mask.all())
+
+    def testGapped(self):
+        arrays = [chunk(1, 2), chunk(2, 2)]
+        src, dst, count = timeline.placements([1, 6], [2, 2], 1, 10)
+        buffer = np.zeros((10, 3), dtype=np.uint8)
+        mask = np.zeros(10, dtype=bool)
+        timeline.assemble(buffer, arrays, src, dst, count, mask=mask)
+        np.testing.assert_array_equal(buffer[:, 0], [0, 1, 1, 0, 0, 0, 2, 2, 0, 0])
+        np.testing.assert_array_equal(np.nonzero(~mask)[0], [0, 3, 4, 5, 8, 9])
+
+    def testAxis(self):
+        # Images with time along the width, a lower image fills the top rows
+        arrays = [chunk(1, 4, height=3).T, chunk(2, 4, height=2).T]
+        src, dst, count = timeline.placements([-1, 3], [4, 4], 1, 6)
+        buffer = np.zeros((3, 6), dtype=np.uint8)
+        timeline.assemble(buffer, arrays, src, dst, count, axis=1)
+        np.testing.assert_array_equal(buffer, [[1, 1, 1, 2, 2, 2],
+                                               [1, 1, 1, 2, 2, 2],
+                                               [1, 1, 1, 0, 0, 0]])
+
+    def testGaps(self):
+        self.assertEqual(timeline.gaps([True, False, False, True, False]), [(1, 3), (4, 5)])
+        self.assertEqual(timeline.gaps([False, True]), [(0, 1)])
+        self.assertEqual(timeline.gaps([True, True]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import threading
+import time
+import unittest
+from common_lib import worker
+
+
+class TestCoalescer(unittest.TestCase):
+
+    def testCoalesced(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def callback(attributes):
+            calls.append(attributes)
+            started.set()
+            release.wait()
+            return attributes['destination']
+
+        coalescer = worker.Coalescer(callback, lambda attributes: attributes['destination'])
+        results = []
+        first = threading.Thread(target=lambda: results.append(coalescer({'destination': 'a'})))
+        first.start()
+        started.wait()
+        second = threading.Thread(target=lambda: results.append(coalescer({'destination': 'a'})))
+        second.start()
+        while not coalescer.stats['coalesced']:
+            time.sleep(0.01)
+        release.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['a', 'a'])
+        # Not in flight anymore
+        coalescer({'destination': 'a'})
+        self.assertEqual(len(calls), 2)
+
+    def testExclusive(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def callback(attributes):
+            started.set()
+            release.wait()
+            return attributes['destination']
+
+        coalescer = worker.Coalescer(callback, lambda attributes: attributes['destination'], exclusive=True)
+        results = []
+        first = threading.Thread(target=lambda: results.append(coalescer({'destination': 'a'})))
+        first.start()
+        started.wait()
+        # Another job is refused while one runs, an identical one joins it
+        self.assertRaises(worker.Busy, coalescer, {'destination': 'b'})
+        second = threading.Thread(target=lambda: results.append(coalescer({'destination': 'a'})))
+        second.start()
+        while not coalescer.stats['coalesced']:
+            time.sleep(0.01)
+        release.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(results, ['a', 'a'])
+        self.assertEqual(coalescer.stats['busy'], 1)
+        self.assertEqual(coalescer({'destination': 'b'}), 'b')
+
+    def testStats(self):
+        coalescer = worker.Coalescer(lambda attributes: attributes.get('status'), lambda attributes: None)
+        coalescer({})
+        coalescer({'status': 'skipped'})
+        self.assertEqual(coalescer.stats['processed'], 1)
+        self.assertEqual(coalescer.stats['skipped'], 1)
+
+    def testException(self):
+        def callback(attributes):
+            raise ValueError()
+        coalescer = worker.Coalescer(callback, lambda attributes: 'a')
+        self.assertRaises(ValueError, coalescer, {})
+        self.assertEqual(coalescer.stats['failed'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
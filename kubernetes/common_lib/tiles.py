@@ -0,0 +1,52 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The tile grid of the client, shared by the spectrogram and similarity tiles.
+#
+#   for start in tiles.tile_starts(zoom, time_start, time_end):
+#       destination = tiles.tile_destination(location_name, zoom, start)
+
+import datetime
+import math
+
+
+def tile_duration(zoom):
+    """ Seconds covered by a tile at zoom, as in the client (TileDefinitions.js) """
+    return 3600 / 2 ** zoom
+
+
+def tile_destination(location_name, zoom, tile_start, denoise=False):
+    """ Object name of the tile at zoom starting at tile_start
+
+    Matches the names the client requests (SpectrogramTileDefinitions.js and
+    SimilarityTileDefinitions.js), negative zoom levels are written as n<level>.
+    """
+    level = str(zoom) if zoom >= 0 else 'n%i' % -zoom
+    return 'tiles-%s%s/%s/%s.jpg' % (level, '-denoise' if denoise else '', location_name,
+                                     tile_start.strftime('%Y_%m_%dT%H_%M_%S'))
+
+
+def tile_starts(zoom, time_start, time_end):
+    """ Starts of the tiles at zoom that cover time_start to time_end
+
+    Tiles start at multiples of their duration since the epoch, like in the
+    client.
+    """
+    duration = tile_duration(zoom)
+    epoch = datetime.datetime(1970, 1, 1, tzinfo=time_start.tzinfo or datetime.timezone.utc)
+    first = math.floor((time_start - epoch).total_seconds() / duration)
+    last = math.ceil((time_end - epoch).total_seconds() / duration)
+    return [epoch + datetime.timedelta(seconds=i * duration) for i in range(first, last)]
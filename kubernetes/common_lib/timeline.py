@@ -0,0 +1,70 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Placing spectrogram chunks on a time axis.
+#
+#   starts, ends = timeline.offsets(rows, time_start)
+#   src, dst, count = timeline.placements(starts, lengths, px_per_sec, size)
+#   timeline.assemble(buffer, arrays, src, dst, count, mask=mask)
+#   missing = timeline.gaps(mask)
+
+import numpy as np
+
+
+def offsets(rows, origin):
+    """ Start and end seconds of rows (filelist entries) since origin, as float arrays """
+    starts = np.array([(row['start_time'] - origin).total_seconds() for row in rows], dtype=np.float64)
+    ends = np.array([(row['end_time'] - origin).total_seconds() for row in rows], dtype=np.float64)
+    return starts, ends
+
+
+def placements(starts, lengths, px_per_sec, size, offset=0):
+    """ Source start, destination start and pixel count of every chunk
+
+    Chunk i starts at pixel offset + floor(starts[i] * px_per_sec) and is
+    lengths[i] pixels long. The parts before pixel 0 and from pixel size on
+    are cropped, count is <= 0 for chunks that are outside completely.
+    """
+    dst = offset + np.floor(np.asarray(starts, dtype=np.float64) * px_per_sec).astype(np.int64)
+    end = np.minimum(dst + np.asarray(lengths, dtype=np.int64), size)
+    src = np.maximum(0, -dst)
+    dst = np.maximum(0, dst)
+    return src, dst, end - dst
+
+
+def assemble(buffer, arrays, src, dst, count, axis=0, mask=None):
+    """ Copy the chunks into buffer along axis, later chunks overwrite earlier ones
+
+    Chunks smaller than the buffer in the other axes fill the start of them.
+    mask (a bool array of buffer.shape[axis]) is set where a chunk was placed,
+    the rest are gaps.
+    """
+    out = np.moveaxis(buffer, axis, 0)
+    for (a, s, d, n) in zip(arrays, src, dst, count):
+        if n <= 0:
+            continue
+        a = np.moveaxis(a, axis, 0)
+        out[(slice(d, d + n),) + tuple(slice(0, k) for k in a.shape[1:])] = a[s:s + n]
+        if mask is not None:
+            mask[d:d + n] = True
+    return buffer
+
+
+def gaps(mask):
+    """ (start, end) of the runs where mask is False, end exclusive """
+    padded = np.concatenate(([True], np.asarray(mask, dtype=bool), [True]))
+    changes = np.flatnonzero(padded[1:] != padded[:-1])
+    return [(int(a), int(b)) for (a, b) in zip(changes[::2], changes[1::2])]
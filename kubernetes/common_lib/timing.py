@@ -0,0 +1,51 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import contextlib
+import time
+
+
+class StageTimer(object):
+    """ Wall clock seconds per named stage of a job.
+
+        timer = StageTimer()
+        with timer.stage('download'):
+            ...
+        logging.info("Finished", extra=timer.extra())
+    """
+
+    def __init__(self):
+        self.durations = collections.OrderedDict()
+        self._start = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0) + time.time() - t
+
+    def total(self):
+        return time.time() - self._start
+
+    def extra(self):
+        """ Durations as log fields, <stage>_seconds and total_seconds """
+        ret = collections.OrderedDict(
+            ("%s_seconds" % name, round(d, 3)) for name, d in self.durations.items())
+        ret['total_seconds'] = round(self.total(), 3)
+        return ret
@@ -14,9 +14,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import logging
 import multiprocessing
+import threading
 import time
+from concurrent import futures
 from google.api_core.exceptions import DeadlineExceeded
 from google.cloud import pubsub_v1
 
@@ -39,13 +42,82 @@ def _get_attributes(message):
             ret[k] = message.attributes.get(key)
     return ret
     
-def pull_pubsub_streaming(pubsub_subscription, callback, setup=None):
+class Busy(Exception):
+    """ Raised by an exclusive Coalescer for a job that can not join the running one """
+
+
+class Coalescer(object):
+    """ Runs callback once for identical jobs that are in flight together
+
+    key(attributes) identifies a job, None never coalesces. A job arriving
+    while one with the same key runs (or waits) gets its result or exception
+    instead of running again. When exclusive, any other job arriving while
+    one runs raises Busy instead of waiting. The return value of callback
+    is counted in stats, None as 'processed', the joined jobs as
+    'coalesced' and the refused ones as 'busy'.
+    """
+
+    def __init__(self, callback, key, exclusive=False):
+        self.callback = callback
+        self.key = key
+        self.exclusive = exclusive
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.running = 0
+        self.stats = collections.Counter()
+
+    def __call__(self, attributes):
+        k = self.key(attributes)
+        with self.lock:
+            future = self.in_flight.get(k) if k is not None else None
+            owner = future is None
+            if owner and self.exclusive and self.running:
+                self.stats['busy'] += 1
+                raise Busy()
+            if owner:
+                future = futures.Future()
+                self.running += 1
+                if k is not None:
+                    self.in_flight[k] = future
+            else:
+                self.stats['coalesced'] += 1
+
+        if owner:
+            try:
+                future.set_result(self.callback(attributes))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self.lock:
+                    self.in_flight.pop(k, None)
+                    self.running -= 1
+                    if future.exception() is None:
+                        self.stats[future.result() or 'processed'] += 1
+                    else:
+                        self.stats['failed'] += 1
+        return future.result()
+
+
+def pull_pubsub_streaming(pubsub_subscription, callback, setup=None, key=None):
+    """ Listen for pubsub messages with a streaming pull
+
+    Jobs run one at a time. With key (see Coalescer) one more message is
+    leased while a job runs, if it is identical it shares the computation of
+    the job, otherwise it is released right away so other workers (and the
+    autoscaler, which counts undelivered messages) see it.
+    """
     subscriber = pubsub_v1.SubscriberClient()
     subscription_path = subscriber.subscription_path(
         CLOUD_PROJECT, pubsub_subscription)
 
     lock = multiprocessing.Lock()
 
+    def _locked(attributes):
+        with lock:
+            return callback(attributes)
+
+    coalescer = Coalescer(_locked, key or (lambda attributes: None), exclusive=key is not None)
+
     def _callback(message):
         logging.info(
             "Received job" ,
@@ -53,16 +125,20 @@ def pull_pubsub_streaming(pubsub_subscription, callback, setup=None):
         )            
         try:
             attributes = _get_attributes(message)
-            with lock:
-                callback(attributes)
+            coalescer(attributes)
             
+            extra = _log(message)
+            extra.update(('jobs_' + k, v) for (k, v) in coalescer.stats.items())
             logging.info(
                 "Finished job" ,
-                extra=_log(message),
+                extra=extra,
             )            
         
             message.ack()
-        
+
+        except Busy:
+            message.nack()
+            logging.info("Released job while busy", extra=_log(message))
         except Exception as e:                
             message.nack()
             logging.exception("Error happened during processing", e)
@@ -70,7 +146,7 @@ def pull_pubsub_streaming(pubsub_subscription, callback, setup=None):
     if setup:
         setup(None)
 
-    flow_control = pubsub_v1.types.FlowControl(max_messages=1)
+    flow_control = pubsub_v1.types.FlowControl(max_messages=2 if key else 1)
     subscriber.subscribe(subscription_path, callback=_callback, flow_control=flow_control)
 
     # The subscriber is non-blocking, so we must keep the main thread from
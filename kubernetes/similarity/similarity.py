@@ -14,7 +14,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from common_lib import file_utils, cloud_logging, worker
+from common_lib import file_utils, cloud_logging, worker, shared_array, timeline, timing, image_encoding, spectrogram_index
+from common_lib import tiles
 from google.cloud import storage, pubsub_v1
 import sys
 import os
@@ -22,12 +23,17 @@ import logging
 import tempfile
 import datetime
 import math
+import functools
+import hashlib
+import io
+import json
 import multiprocessing
 from PIL import Image, ImageFile
 import numpy as np
 from dateutil import tz
 import librosa
 import cv2
+import threadpoolctl
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 CLOUD_PROJECT = 'gweb-deepblue'
@@ -37,102 +43,446 @@ ACK_DEADLINE = 30
 cloud_logging.setup_logging()
 
 OUTPUT_BUCKET_NAME = 'deepblue-similarities'
+# See image_encoding.FORMATS
+OUTPUT_FORMAT = 'jpeg'
+
+# How chunk covariances are calculated, 'gram' or 'offsets' (see chunk_covariance)
+COV_METHOD = 'gram'
+
+# Storage (pasteboard) and compute dtypes per precision mode
+PRECISIONS = {
+    'float64': (np.float64, np.float64),
+    'float32': (np.float32, np.float32),
+    'float16': (np.float16, np.float32),
+}
+PRECISION = 'float64'
+# The png is written with librosa.amplitude_to_db, which floors every chunk
+# this many dB below its peak, raw spectrograms get the same floor
+TOP_DB = 80
+AMIN = 1e-5
+
+# 'argsort' ranks every value exactly, 'histogram' looks the rank up in the
+# cumulative histogram (EQUALIZE_BINS bins), which is O(n) instead of O(n log n)
+EQUALIZE_METHOD = 'argsort'
+EQUALIZE_BINS = 4096
+
+# 'full' builds the whole covariance of a window pair and straightens it,
+# 'band' only calculates the lags within band_size (see lag_covariance),
+# without a band_size that is every lag and the pairs are calculated in full
+SIMILARITY_MODE = 'full'
+LAG_BLOCK_ROWS = 256
+
+# Number of processes calculating window pairs in parallel, 0 for one per
+# available cpu. One until the scaling has been measured on a cluster node
+# (python -m similarity.tools.benchmark parallel), the pods request less
+# than a cpu.
+PAIR_PROCESSES = 1
+
+# Frames blurred per cv2 call when blurring the pasteboard
+BLUR_BLOCK_ROWS = 4096
+# Files this close to the windows are fetched for the frames around the pairs
+CONTEXT_SECONDS = 1
+
+# Cache of window pair images. With the cache on, windows are aligned to
+# multiples of window_size since the epoch so overlapping requests share pairs.
+# Bump CACHE_VERSION when the pair images change.
+CACHE = False
+CACHE_VERSION = 3
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'similarity-cache')
+CACHE_MAX_BYTES = 2 * 1024**3
+CACHE_BUCKET_NAME = None
+
+# Bytes of the pasteboard of a batch of similarity tiles at most, the
+# seconds in a batch follow from the frame rate and bins of the default
+# spectrogram config (about 0.7 MB per second at float64)
+BATCH_BYTES = 768 * 1024**2
+SPECTROGRAM_FRAMES_PER_SEC = 22050 / 256
+SPECTROGRAM_BINS = 1024
+
+
+def npy_view(data):
+    """ Array of the bytes of a .npy file, as a read only view without copying them """
+    f = io.BytesIO(data)
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    array = np.frombuffer(data, dtype, count=int(np.prod(shape)), offset=f.tell())
+    return array.reshape(shape, order='F' if fortran_order else 'C')
+
+def fetch_raw_spectrogram(row):
+    """ Fetch float16 .npy cqt written next to the png by the spectrogram job
+
+    The downloaded bytes are read in place (the objects come from ranged
+    shard reads, so there is no file to map), clipping them to the range
+    of the png in the pasteboard precision is the only copy.
+    """
+    data, metadata = spectrogram_index.download(pool_bucket, row, 'npy')
+    if data is None:
+        return
+
+    cqt = npy_view(data)
 
+    # Clip to the same range as the png, without the 8 bit quantization
+    floor = max(float(cqt.max()), AMIN) * librosa.db_to_amplitude(-TOP_DB)
+    amp_min = max(librosa.db_to_amplitude(int(metadata['db_min'])), floor)
+    amp_max = librosa.db_to_amplitude(int(metadata['db_max']))
+    clipped = np.empty(cqt.shape, dtype=PRECISIONS[pool_precision][0])
+    np.clip(cqt, amp_min, amp_max, out=clipped)
+
+    return [clipped, metadata]
 
 def fetch_spectrogram_image(row):
     """ Fetch spectrogram at specific path from cloud storage """
+
+    if pool_raw:
+        try:
+            ret = fetch_raw_spectrogram(row)
+            if ret:
+                return ret
+        except Exception as e:
+            logging.warning("Could not read raw spectrogram, falling back to png")
+            logging.warning(e)
     
     try: 
-        filename = row['filename'].replace('.mp3','.wav')+".png"
+        filename = spectrogram_index.object_name(row, 'png')
         # filename = row['filename']
         logging.info("Fetching "+filename)
-        blob = pool_bucket.get_blob(filename)        
-        if not blob:
+        data, metadata = spectrogram_index.download(pool_bucket, row, 'png')
+        if data is None:
             logging.error(filename+" not found")
         
-        tmp = tempfile.NamedTemporaryFile(suffix=".png")
-        blob.download_to_file(tmp)
-        tmp.seek(0)
-        img = np.asarray(Image.open(tmp))
+        img = np.asarray(Image.open(io.BytesIO(data)))
 
-        assert blob.metadata['db_min']
-        assert blob.metadata['db_max']
+        assert metadata['db_min']
+        assert metadata['db_max']
 
-        img_mapped = np.interp(img, (0, 255), (int(blob.metadata['db_min']), int(blob.metadata['db_max'])))
+        # Map the 8 bit values to amplitudes with a lookup table
+        db = np.interp(np.arange(256), (0, 255), (int(metadata['db_min']), int(metadata['db_max'])))
+        lut = librosa.db_to_amplitude(db).astype(PRECISIONS[pool_precision][0])
 
-        cqt = librosa.db_to_amplitude(img_mapped)
+        cqt = lut[img]
         cqt = np.flipud(cqt).T
 
-        tmp.close()
-        
-        return [cqt, blob.metadata]
+        return [cqt, metadata]
     except Exception as e:
         logging.error("Could not download "+filename)
         logging.error(e)
         return 
 
 def get_chunks(x, width, stride):
-    indices = np.arange(0, len(x) - width, stride)
-    chunks = np.empty((len(indices), width, x.shape[1]), dtype=x.dtype)
-    for i in range(len(indices)):
-        j = indices[i]
-        chunks[i] = x[j:j+width]
-    return chunks
+    """ Overlapping windows of x as a read only strided view (no copy) """
+    n = len(range(0, len(x) - width, stride))
+    return np.lib.stride_tricks.as_strided(
+        x,
+        shape=(n, width, x.shape[1]),
+        strides=(x.strides[0] * stride, x.strides[0], x.strides[1]),
+        writeable=False)
+
+def stride_phases(x, width, stride):
+    """ Frames of x regrouped by their phase in the stride, shape (stride, rows, bins)
+
+    Frame `offset` of chunk i is phases[offset % stride, i + offset // stride],
+    so the frames at one offset of all chunks are a contiguous slice. The
+    covariance does not change when shifting x, removing the mean keeps the
+    sums small.
+    """
+    n = len(range(0, len(x) - width, stride))
+    rows = n + (width - 1) // stride
+    mean = x.mean()
+    phases = np.zeros((stride, rows, x.shape[1]), dtype=x.dtype)
+    for p in range(stride):
+        frames = x[p:rows * stride:stride]
+        np.subtract(frames, mean, out=phases[p, :len(frames)])
+    return phases
+
+def diagonal_window_sums(g, length, n):
+    """ out[i, j] = sum(g[i+k, j+k] for k in range(length)) for i, j < n
+
+    Uses cumulative sums along the diagonals (an integral image turned 45
+    degrees) so the cost does not depend on length.
+    """
+    c = np.zeros((len(g) + 1, len(g) + 1), dtype=g.dtype)
+    for i in range(len(g)):
+        np.add(g[i], c[i, :-1], out=c[i + 1, 1:])
+    return c[length:length + n, length:length + n] - c[:n, :n]
+
+def chunk_covariance(x, width, stride, method=COV_METHOD):
+    """ np.cov(flatish(get_chunks(x, width, stride))) without copying the chunks
+
+    The dot product of two chunks is the sum of the dot products of their
+    frames. method 'offsets' accumulates one frame offset at a time, 'gram'
+    calculates the frame gram matrix once per stride phase and sums its
+    diagonals, so the cost scales with the frames instead of frames x width.
+    """
+    n = len(range(0, len(x) - width, stride))
+    size = width * x.shape[1]
+    phases = stride_phases(x, width, stride)
+    frame_sums = phases.sum(axis=2)
+
+    gram = np.zeros((n, n), dtype=phases.dtype)
+    sums = np.zeros(n, dtype=phases.dtype)
+    for offset in range(width):
+        q, p = divmod(offset, stride)
+        sums += frame_sums[p, q:q + n]
+        if method == 'offsets':
+            frames = phases[p, q:q + n]
+            gram += np.dot(frames, frames.T)
+
+    if method == 'gram':
+        # Phases with the same number of offsets share one diagonal sum
+        grams = {}
+        for p in range(min(stride, width)):
+            length = len(range(p, width, stride))
+            g = np.dot(phases[p], phases[p].T)
+            if length in grams:
+                grams[length] += g
+            else:
+                grams[length] = g
+        for length, g in grams.items():
+            gram += diagonal_window_sums(g, length, n)
+
+    mean = sums / size
+    gram -= size * np.outer(mean, mean)
+    gram /= size - 1
+    return gram
+
+def lag_covariance(x, width, stride, band, block=LAG_BLOCK_ROWS):
+    """ Chunk covariance in the straightened (lag) layout, only for lags within band
+
+    out[i, band + l] = cov[i, i + l] for -band <= l < band, which equals
+    straighten(chunk_covariance(...)) when band is n//2. For every stride phase
+    the frame gram is calculated a block of rows at a time and only kept for
+    the lags in the band, so memory is O(n * band) instead of O(n^2). Returns
+    the covariance and the mask of entries that refer to an existing chunk.
+    """
+    n = len(range(0, len(x) - width, stride))
+    size = width * x.shape[1]
+    lags = np.arange(-band, band)
+    phases = stride_phases(x, width, stride)
+    rows = phases.shape[1]
+    frame_sums = phases.sum(axis=2)
+
+    sums = np.zeros(n, dtype=phases.dtype)
+    for offset in range(width):
+        q, p = divmod(offset, stride)
+        sums += frame_sums[p, q:q + n]
+
+    out = np.zeros((n, len(lags)), dtype=phases.dtype)
+    for p in range(min(stride, width)):
+        # Frame gram of this phase in lag layout, g[r, k] = f[r] . f[r + lags[k]]
+        g = np.zeros((rows + 1, len(lags)), dtype=phases.dtype)
+        for r0 in range(0, rows, block):
+            r1 = min(r0 + block, rows)
+            c0 = max(0, r0 - band)
+            c1 = min(rows, r1 + band - 1)
+            sub = np.dot(phases[p, r0:r1], phases[p, c0:c1].T)
+            cols = np.arange(r0, r1)[:, None] + lags[None, :] - c0
+            valid = (cols >= 0) & (cols < c1 - c0)
+            g[r0 + 1:r1 + 1] = np.take_along_axis(sub, np.clip(cols, 0, c1 - c0 - 1), axis=1)
+            g[r0 + 1:r1 + 1][~valid] = 0
+
+        # Chunk i at a lag is the sum of the frames i+q at the same lag, read
+        # from the cumulative sum along the rows
+        length = len(range(p, width, stride))
+        np.cumsum(g, axis=0, out=g)
+        out += g[length:length + n]
+        out -= g[:n]
+
+    mean = sums / size
+    chunks = np.arange(n)[:, None] + lags[None, :]
+    valid = (chunks >= 0) & (chunks < n)
+    out -= size * mean[:, None] * mean[np.clip(chunks, 0, n - 1)]
+    out /= size - 1
+    out[~valid] = 0
+    return out, valid
+
+@functools.lru_cache(maxsize=4)
+def straighten_index(n):
+    """ Flat gather index into an n x n matrix and mask of valid entries for straighten """
+    rows = np.arange(n)[:, None]
+    cols = np.arange(n)[None, :] + rows - n//2
+    valid = (cols >= 0) & (cols < n)
+    index = rows * n + np.clip(cols, 0, n - 1)
+    index.flags.writeable = False
+    valid.flags.writeable = False
+    return index, valid
 
 def straighten(cov):
-    n = len(cov)
-    straight = np.zeros_like(cov)
-    for i, row in enumerate(cov):
-        src = max(0, i - n//2)
-        dst = max(0, n//2 - i)
-        sw = len(cov[i, src:])
-        dw = len(straight[i, dst:])
-        w = min(sw, dw)
-        straight[i, dst:dst+w] = cov[i,src:src+w]
+    """ Shift row i of cov by n//2 - i so the diagonal becomes the center column """
+    index, valid = straighten_index(len(cov))
+    straight = np.ravel(cov)[index]
+    straight[~valid] = 0
     return straight
 
 def flatish(x):
     return x.reshape(len(x), -1)
 
-def histogram_equalize(data, max_val=None, endpoint=False):
+def histogram_equalize(data, max_val=None, endpoint=False, method=EQUALIZE_METHOD):
     input_shape = np.shape(data)
     data_flat = np.asarray(data).flatten()
     if max_val is None:
         max_val = data_flat.max()
+    if method == 'histogram':
+        # Rank approximated by the cumulative histogram, linear within a bin
+        counts, edges = np.histogram(data_flat, bins=EQUALIZE_BINS)
+        cdf = np.concatenate(([0], np.cumsum(counts))) * (float(max_val) / len(data_flat))
+        data_flat = np.interp(data_flat, edges, cdf).astype(data_flat.dtype, copy=False)
+        return data_flat.reshape(*input_shape)
     indices = np.argsort(data_flat)
-    replacements = np.linspace(0, max_val, len(indices), endpoint=endpoint)
+    replacements = np.linspace(0, max_val, len(indices), endpoint=endpoint, dtype=data_flat.dtype)
     data_flat[indices] = replacements
     return data_flat.reshape(*input_shape)
 
-def get_similarity(amp, freq_blur=32, contrast=100, chunk_width=64, chunk_stride=8):
+def get_similarity(amp, freq_blur=32, contrast=100, chunk_width=64, chunk_stride=8, cov_method=COV_METHOD,
+                   precision=PRECISION, equalize=EQUALIZE_METHOD, band=None):
+    """ Similarity of all chunks of amp, or in lag layout for lags within band """
+    amp = amp.astype(PRECISIONS[precision][1], copy=False)
     if freq_blur > 0:
-        blurred = cv2.GaussianBlur(amp, (2*freq_blur+1,1), 0)
-        chunks = get_chunks(blurred, chunk_width, chunk_stride)
-    else:
-        chunks = get_chunks(amp, chunk_width, chunk_stride)
-    cov = np.cov(flatish(chunks))
-    normalize(cov)
-    cov = histogram_equalize(cov)
-    cov **= contrast
+        amp = cv2.GaussianBlur(amp, (2*freq_blur+1,1), 0)
+    if band is None:
+        cov = chunk_covariance(amp, chunk_width, chunk_stride, method=cov_method)
+        normalize(cov)
+        cov = histogram_equalize(cov, method=equalize)
+        cov **= contrast
+        return cov
+
+    cov, valid = lag_covariance(amp, chunk_width, chunk_stride, band)
+    values = normalize(cov[valid])
+    values = histogram_equalize(values, method=equalize)
+    values **= contrast
+    cov[valid] = values
     return cov
 
-def get_similarity_images(cqts, chunk_width=64, chunk_stride=8):
-    images = []
-    for i in range(len(cqts)-1):
-        pair = np.vstack(cqts[i:i+2])
-        pair = np.pad(pair, ((chunk_width//2, chunk_width//2), (0,0)), 'edge')
-        cov = get_similarity(pair, chunk_width=chunk_width, chunk_stride=chunk_stride)
-        cov = straighten(cov)
-        images.append(cov)
+def blur_frequencies(board, freq_blur=32, precision=PRECISION, block=BLUR_BLOCK_ROWS):
+    """ Gaussian blur of every frame of board along frequency, in place
+
+    The blur does not mix frames, so blurring the pasteboard once gives the
+    same pairs as blurring every pair.
+    """
+    if freq_blur <= 0:
+        return board
+    for start in range(0, len(board), block):
+        rows = board[start:start+block]
+        rows[:] = cv2.GaussianBlur(rows.astype(PRECISIONS[precision][1], copy=False), (2*freq_blur+1,1), 0)
+    return board
+
+def padded_board(windows, chunk_width=64, precision=PRECISION):
+    """ Windows in one blurred pasteboard with the edge frames repeated chunk_width//2 times at both ends """
+    pad = chunk_width//2
+    windows = np.asarray(windows)
+    board = np.empty((windows.shape[0] * windows.shape[1] + 2*pad, windows.shape[2]), dtype=windows.dtype)
+    board[pad:len(board)-pad] = windows.reshape(-1, windows.shape[2])
+    board[:pad] = board[pad]
+    board[len(board)-pad:] = board[len(board)-pad-1]
+    return blur_frequencies(board, precision=precision)
+
+def pair_band(n, mode, band):
+    """ Lags on each side lag_covariance calculates for a pair of n chunks, None to calculate it in full
+
+    A band covering every lag is slower than the full covariance and needs
+    more memory, so 'band' mode only uses lag_covariance for narrower bands.
+    """
+    if mode == 'band' and band and band < n//2:
+        return band
+    return None
+
+def pair_similarity(board, i, window_px, chunk_width=64, chunk_stride=8, precision=PRECISION,
+                    equalize=EQUALIZE_METHOD, mode=SIMILARITY_MODE, band=None):
+    """ Straightened similarity image of windows i and i+1 of a blurred pasteboard
+
+    Window i starts at frame chunk_width//2 + i*window_px of board, the
+    pair is a view including the chunk_width//2 frames around it.
+    """
+    pair = board[i*window_px:(i+2)*window_px + 2*(chunk_width//2)]
+    band = pair_band(len(range(0, len(pair) - chunk_width, chunk_stride)), mode, band)
+    if band:
+        return get_similarity(pair, freq_blur=0, chunk_width=chunk_width, chunk_stride=chunk_stride,
+                              precision=precision, equalize=equalize, band=band)
+    cov = get_similarity(pair, freq_blur=0, chunk_width=chunk_width, chunk_stride=chunk_stride,
+                         precision=precision, equalize=equalize)
+    return straighten(cov)
+
+def available_cpus():
+    """ Cpus this process may run on, not the cpus of the node """
+    return len(os.sched_getaffinity(0)) or 1
+
+def _pair_initializer(threads):
+    """ Limit the BLAS and OpenCV threads of a pair worker so the workers don't oversubscribe the cpus """
+    global _pair_thread_limits
+    _pair_thread_limits = threadpoolctl.threadpool_limits(threads)
+    cv2.setNumThreads(threads)
+
+def _pool_pair_similarity(i):
+    _pair_images.array[_pair_slots[i]] = pair_similarity(_pair_board, i, _pair_window_px, **_pair_kwargs)
+
+def compute_pair_images(board, window_px, indices, chunk_width=64, chunk_stride=8, precision=PRECISION,
+                        equalize=EQUALIZE_METHOD, mode=SIMILARITY_MODE, band=None, processes=PAIR_PROCESSES):
+    """ Straightened similarity images of the window pairs in indices, as a dict by index
+
+    board is a blurred pasteboard of windows of window_px frames (see
+    pair_similarity). With more than one process the pairs are calculated
+    by forked workers that read the board from the parent's memory and
+    write their image into a shared array. processes 0 uses every
+    available cpu.
+    """
+    global _pair_board
+    global _pair_window_px
+    global _pair_kwargs
+    global _pair_images
+    global _pair_slots
+
+    kwargs = dict(chunk_width=chunk_width, chunk_stride=chunk_stride, precision=precision,
+                  equalize=equalize, mode=mode, band=band)
+    indices = list(indices)
+    if processes <= 0:
+        processes = available_cpus()
+    if processes <= 1 or len(indices) < 2:
+        return {i: pair_similarity(board, i, window_px, **kwargs) for i in indices}
+
+    n = len(range(0, 2*window_px + 2*(chunk_width//2) - chunk_width, chunk_stride))
+    band = pair_band(n, mode, band)
+    lags = 2 * band if band else n
+    processes = min(processes, len(indices))
+    _pair_board = board
+    _pair_window_px = window_px
+    _pair_kwargs = kwargs
+    # Only the requested pairs get a slot
+    _pair_slots = dict((i, k) for (k, i) in enumerate(indices))
+    _pair_images = shared_array.SharedArray((len(indices), n, lags), PRECISIONS[precision][1])
+    try:
+        with multiprocessing.Pool(processes=processes, initializer=_pair_initializer,
+                                  initargs=(max(1, available_cpus() // processes),)) as pool:
+            pool.map(_pool_pair_similarity, indices, chunksize=1)
+        return {i: np.array(_pair_images.array[_pair_slots[i]]) for i in indices}
+    finally:
+        _pair_images.close()
+        _pair_board = None
+
+def stitch_images(images):
+    """ Stitch the pair images into one image per window """
+    images = list(images)
     n = len(images[0])//2
+    c = images[0].shape[1]//2
     for i in range(len(images)):
         if i+1 < len(images):
-            images[i+1][:n,:n] = images[i][n:,:n] # replace next top left with current bottom left
+            images[i+1] = images[i+1].copy()
+            images[i+1][:n,:c] = images[i][n:,:c] # replace next top left with current bottom left
         else:
             images.append(images[i][n:])
         images[i] = images[i][:n]
     return images
 
+def get_similarity_images(cqts, chunk_width=64, chunk_stride=8, precision=PRECISION, equalize=EQUALIZE_METHOD,
+                          mode=SIMILARITY_MODE, band=None, processes=PAIR_PROCESSES):
+    """ Straightened similarity images of every window, band limits the lags in 'band' mode """
+    board = padded_board(cqts, chunk_width=chunk_width, precision=precision)
+    images = compute_pair_images(board, len(cqts[0]), range(len(cqts) - 1), chunk_width=chunk_width,
+                                 chunk_stride=chunk_stride, precision=precision, equalize=equalize, mode=mode,
+                                 band=band, processes=processes)
+    return stitch_images([images[i] for i in sorted(images)])
+
 import matplotlib.pyplot as plt
 def apply_cmap(x, cmap=None):
     return plt.get_cmap('viridis' if cmap is None else cmap)(x)[...,:3]
@@ -148,144 +498,351 @@ def cqtshow(cqt, power=0.5):
     img **= power
     return 255 * apply_cmap(img, 'inferno')
 
-def generate_similarity(location_name, time_start, time_end, destination, bucket_name='deepblue-spectrograms-denoise', window_size=60, downsample=1):
-    """ Generate a similarity image for a given timeslot and location name """
+def cache_key(**params):
+    """ Short hash of everything that changes the pair images """
+    params['version'] = CACHE_VERSION
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+
+def cache_name(location_name, key, window_index, sources=()):
+    """ Name of a cached pair, sources (e.g. the object generations) are hashed into it """
+    source = hashlib.sha1(json.dumps(list(sources)).encode()).hexdigest()[:8]
+    return "%s/%s/%i-%s.npz" % (location_name, key, window_index, source)
+
+def load_cached_pair(name):
+    """ Pair image and px_per_sec from the local cache, or from CACHE_BUCKET_NAME """
+    path = os.path.join(CACHE_DIR, name)
+    if not os.path.exists(path) and CACHE_BUCKET_NAME:
+        blob = storage.Client().get_bucket(CACHE_BUCKET_NAME).get_blob(name)
+        if blob:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            blob.download_to_filename(path + '.tmp')
+            os.replace(path + '.tmp', path)
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as data:
+            return data['image'], float(data['px_per_sec'])
+    except Exception as e:
+        logging.warning("Could not read cached pair %s: %s" % (name, e))
+        return None
+
+def store_cached_pair(name, image, px_per_sec):
+    path = os.path.join(CACHE_DIR, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write next to the target and rename, concurrent readers never see a partial file
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, image=image, px_per_sec=px_per_sec)
+    os.replace(path + '.tmp', path)
+    if CACHE_BUCKET_NAME:
+        storage.Client().get_bucket(CACHE_BUCKET_NAME).blob(name).upload_from_filename(path)
+
+def prune_cache(max_bytes=CACHE_MAX_BYTES):
+    """ Remove the least recently used pairs until the local cache fits in max_bytes """
+    files = []
+    for root, _, names in os.walk(CACHE_DIR):
+        for name in names:
+            stat = os.stat(os.path.join(root, name))
+            files.append((max(stat.st_atime, stat.st_mtime), stat.st_size, os.path.join(root, name)))
+    total = sum(f[1] for f in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+
+def generate_similarity(location_name, time_start, time_end, destination, bucket_name='deepblue-spectrograms-denoise', window_size=60, downsample=1, raw=False, precision=PRECISION,
+                        equalize=EQUALIZE_METHOD, mode=SIMILARITY_MODE, band_size=None,
+                        processes=PAIR_PROCESSES, cache=CACHE, image_format=OUTPUT_FORMAT, config_key=None):
+    """ Generate a similarity image for a given timeslot and location name 
+    
+    In 'band' mode band_size (seconds) limits the lags in the image, which
+    keeps the memory low for large window sizes.
+
+    With cache the window pairs are read from and written to the pair cache,
+    only the pairs that are not cached yet are downloaded and calculated.
+
+    With a config_key the spectrograms of that spectrogram config are used.
+    """
+    generate_similarity_batch(location_name, [(time_start, time_end, destination)], bucket_name=bucket_name,
+                              window_size=window_size, downsample=downsample, raw=raw, precision=precision,
+                              equalize=equalize, mode=mode, band_size=band_size, processes=processes,
+                              cache=cache, image_format=image_format, config_key=config_key)
+
+
+def generate_similarity_batch(location_name, targets, bucket_name='deepblue-spectrograms-denoise', window_size=60,
+                              downsample=1, raw=False, precision=PRECISION, equalize=EQUALIZE_METHOD,
+                              mode=SIMILARITY_MODE, band_size=None, processes=PAIR_PROCESSES, cache=CACHE,
+                              image_format=OUTPUT_FORMAT, config_key=None):
+    """ Similarity images of the (time_start, time_end, destination) targets, returns the stored destinations
+
+    The span from the first start to the last end is downloaded and its
+    window pairs are computed once, each target is cropped from the stacked
+    image and normalized on its own. Targets should be close together, the
+    gaps between them are computed as well.
+    """
+    timer = timing.StageTimer()
+    time_start = min(t[0] for t in targets)
+    time_end = max(t[1] for t in targets)
     time_start_padded = time_start - datetime.timedelta(seconds=window_size)
     time_end_padded = time_end + datetime.timedelta(seconds=window_size)
+    stride = 8
+    pad = 64//2
+
+    if cache:
+        # Extend to whole windows on the epoch grid, a window then has the same content in every request
+        epoch = datetime.datetime(1970, 1, 1, tzinfo=tz.tzutc())
+        first_window = math.floor((time_start_padded - epoch).total_seconds() / window_size)
+        last_window = math.ceil((time_end_padded - epoch).total_seconds() / window_size)
+        time_start_padded = epoch + datetime.timedelta(seconds=first_window * window_size)
+        time_end_padded = epoch + datetime.timedelta(seconds=last_window * window_size)
+        params = dict(location_name=location_name, bucket_name=bucket_name, window_size=window_size,
+                      stride=stride, raw=raw, precision=precision, equalize=equalize, mode=mode,
+                      band_size=band_size)
+        if config_key:
+            params['config_key'] = config_key
+        key = cache_key(**params)
 
     # Get list of files needed 
-    rows = file_utils.query_audio_files_in_range(
-        location_name, 
-        time_start_padded, 
-        time_end_padded)
+    context = datetime.timedelta(seconds=CONTEXT_SECONDS)
+    with timer.stage('query'):
+        rows = file_utils.query_audio_files_in_range(
+            location_name,
+            time_start_padded - context,
+            time_end_padded + context)
 
     # rows = [{'filename': 'Hawaii19K_DL10_150112_170357.df20.x.0218.mp3', 'start_time': datetime.datetime(2015, 1, 12, 19, 42, 55, tzinfo=tz.tzutc()), 'end_time': datetime.datetime(2015, 1, 12, 19, 43, 38, 750000, tzinfo=tz.tzutc()), 'original_filename': 'Hawaii19K_DL10_150112_170357.df20.x.wav'}, {'filename': 'Hawaii19K_DL10_150112_170357.df20.x.0219.mp3', 'start_time': datetime.datetime(2015, 1, 12, 19, 43, 38, 750000, tzinfo=tz.tzutc()), 'end_time': datetime.datetime(2015, 1, 12, 19, 44, 22, 500000, tzinfo=tz.tzutc()), 'original_filename': 'Hawaii19K_DL10_150112_170357.df20.x.wav'}, {'filename': 'Hawaii19K_DL10_150112_170357.df20.x.0220.mp3', 'start_time': datetime.datetime(2015, 1, 12, 19, 44, 22, 500000, tzinfo=tz.tzutc()), 'end_time': datetime.datetime(2015, 1, 12, 19, 45, 6, 250000, tzinfo=tz.tzutc()), 'original_filename': 'Hawaii19K_DL10_150112_170357.df20.x.wav'}, {'filename': 'Hawaii19K_DL10_150112_170357.df20.x.0221.mp3', 'start_time': datetime.datetime(2015, 1, 12, 19, 45, 6, 250000, tzinfo=tz.tzutc()), 'end_time': datetime.datetime(2015, 1, 12, 19, 45, 50, tzinfo=tz.tzutc()), 'original_filename': 'Hawaii19K_DL10_150112_170357.df20.x.wav'}, {'filename': 'Hawaii19K_DL10_150112_170357.df20.x.0222.mp3', 'start_time': datetime.datetime(2015, 1, 12, 19, 45, 50, tzinfo=tz.tzutc()), 'end_time': datetime.datetime(2015, 1, 12, 19, 46, 33, 750000, tzinfo=tz.tzutc()), 'original_filename': 'Hawaii19K_DL10_150112_170357.df20.x.wav'}, {'filename': 'Hawaii19K_DL10_150112_170357.df20.x.0223.mp3', 'start_time': datetime.datetime(2015, 1, 12, 19, 46, 33, 750000, tzinfo=tz.tzutc()), 'end_time': datetime.datetime(2015, 1, 12, 19, 47, 17, 500000, tzinfo=tz.tzutc()), 'original_filename': 'Hawaii19K_DL10_150112_170357.df20.x.wav'}]
     # logging.info(rows)
 
     if len(rows) == 0:
         logging.warning("No images in time range")
-        return [None, None]
-
-    # Download spectrograms
-    logging.info("Downloading %i spectrogram images" % len(rows))
-    def pool_initializer():
-        global pool_bucket
-        pool_bucket = storage.Client().get_bucket(bucket_name)
-    with multiprocessing.Pool(initializer=pool_initializer) as pool:
-        images = pool.map(fetch_spectrogram_image, rows)
-
-    # Validate downloaded images
-    images = [i for i in images if i is not None]
-    if not images or len(images) == 0:
-        logging.warning("No images in time range after download")
-        return [None, None]
-    logging.info("Download finished (%i)" % len(images))
-    
-    cqts = [i[0] for i in images]
-    
-    # Allocate pasteboard image
-    chunk_width = cqts[0].shape[0]
-    file_duration = rows[0]['end_time'] - rows[0]['start_time']
-    px_per_sec = chunk_width / file_duration.total_seconds()
-
-    window_size_px = math.floor(px_per_sec * window_size)
-    target_width = math.floor((time_end_padded - time_start_padded).total_seconds() * px_per_sec)
-    target_width = int(math.ceil(target_width / window_size_px) * window_size_px)
-    logging.info("Target width %f" %( target_width))
-    logging.info("window size %f sec (%i px)" %( window_size, window_size_px))
-
-    pasteboard = np.zeros((target_width, cqts[0].shape[1]))
-
-    # Insert cqts in pasteboard that is arranged correctly on a timescale
-    for (i, im) in enumerate(cqts):
-        start_offset_sec = (rows[i]['start_time'] - time_start_padded).total_seconds()
-        end_offset_sec = (time_end_padded - rows[i]['end_time']).total_seconds()
-        d = (rows[i]['end_time'] - rows[i]['start_time']).total_seconds()
-
-        start = 0
-        end = im.shape[0]
-
-        out_start = math.floor(start_offset_sec * px_per_sec)
-        out_end = im.shape[0] + out_start
-            
-        # If start time is before window we are analyzing, crop the file
-        if start_offset_sec < 0:
-            size = math.floor(im.shape[0] * (-start_offset_sec / d))  
-            start = size
-            out_start = 0
-            out_end = (im.shape[0]-size) + out_start
-        
-        if end_offset_sec < 0:
-            size = math.floor(im.shape[0] * (-end_offset_sec / d))  
-            end = end - size
-            out_end = (im.shape[0]-size) + out_start
-            
+        return []
+    with timer.stage('index'):
+        index = spectrogram_index.load(storage.Client().bucket(bucket_name), location_name,
+                                       time_start_padded - context, time_end_padded + context)
+        spectrogram_index.annotate(rows, index, ['png', 'npy'] if raw else ['png'], config_key)
+
+    def row_windows(row):
+        first = int(((row['start_time'] - time_start_padded).total_seconds() - CONTEXT_SECONDS) // window_size)
+        last = int(((row['end_time'] - time_start_padded).total_seconds() + CONTEXT_SECONDS) // window_size)
+        return range(first, last + 1)
+
+    if cache:
+        # The generations of the spectrograms around a pair are part of its
+        # name, pairs of regenerated spectrograms are calculated again
+        sources = {}
+        for row in rows:
+            version = [row['filename']] + [(ext, (e or {}).get('generation')) for (ext, e) in sorted(row['index'].items())]
+            for w in row_windows(row):
+                sources.setdefault(w, []).append(version)
+        def pair_name(i):
+            return cache_name(location_name, key, first_window + i, sources.get(i, []) + sources.get(i + 1, []))
+
+        cached = {}
+        with timer.stage('cache_load'):
+            for i in range(last_window - first_window - 1):
+                pair = load_cached_pair(pair_name(i))
+                if pair is not None:
+                    cached[i] = pair
+        missing = [i for i in range(last_window - first_window - 1) if i not in cached]
+        logging.info("%i of %i window pairs cached" % (len(cached), len(cached) + len(missing)),
+                     extra={'labels': {'cached': len(cached), 'missing': len(missing)}})
+
+        # Only the windows of the missing pairs are needed
+        needed = set(missing) | set(i + 1 for i in missing)
+        rows = [row for row in rows if any(i in needed for i in row_windows(row))]
+
+    similarities = {}
+    board = None
+    try:
+        if rows:
+            # Download spectrograms
+            logging.info("Downloading %i spectrogram images" % len(rows))
+            def pool_initializer():
+                global pool_bucket
+                global pool_raw
+                global pool_precision
+                pool_bucket = storage.Client().get_bucket(bucket_name)
+                pool_raw = raw
+                pool_precision = precision
+            # Consecutive rows in a shard are read with one request here, the workers decode every row
+            extension = 'npy' if raw else 'png'
+            groups = spectrogram_index.batches(rows, extension)
+            downloaded = 0
+            with timer.stage('download'), multiprocessing.Pool(initializer=pool_initializer) as pool:
+                reads = spectrogram_index.read_batches(storage.Client().bucket(bucket_name), groups, extension)
+                # Every cqt is pasted as it arrives and dropped, so the
+                # pasteboard is held instead of all cqts next to it
+                for (row, image) in zip(rows, pool.imap(fetch_spectrogram_image, reads)):
+                    if image is None:
+                        continue
+                    cqt = image[0]
+                    if board is None:
+                        # Allocate pasteboard image
+                        chunk_width = cqt.shape[0]
+                        file_duration = row['end_time'] - row['start_time']
+                        px_per_sec = chunk_width / file_duration.total_seconds()
+
+                        window_size_px = math.floor(px_per_sec * window_size)
+                        if cache:
+                            # Every window starts exactly on the grid, whichever request it is part of
+                            px_per_sec = window_size_px / window_size
+                        target_width = math.floor((time_end_padded - time_start_padded).total_seconds() * px_per_sec)
+                        target_width = int(math.ceil(target_width / window_size_px) * window_size_px)
+                        logging.info("Target width %f" %( target_width))
+                        logging.info("window size %f sec (%i px)" %( window_size, window_size_px))
+
+                        # One pasteboard for all pairs with pad frames of context around the
+                        # windows, shared so pair workers read it without copies
+                        limit = target_width + 2*pad
+                        board = shared_array.SharedArray((limit, cqt.shape[1]), PRECISIONS[precision][0],
+                                                         shared=processes != 1)
+                        limit = min(limit, 2*pad + math.floor((time_end_padded - time_start_padded).total_seconds() * px_per_sec))
+                        covered = np.zeros(len(board.array), dtype=bool)
+
+                    # Insert cqt in pasteboard that is arranged correctly on a timescale
+                    starts, _ = timeline.offsets([row], time_start_padded)
+                    src, dst, count = timeline.placements(starts, [len(cqt)], px_per_sec, limit, offset=pad)
+                    timeline.assemble(board.array, [cqt], src, dst, count, mask=covered)
+                    downloaded += 1
+                image = cqt = None
+
+            if board is None and not (cache and cached):
+                logging.warning("No images in time range after download")
+                return []
+            logging.info("Download finished (%i)" % downloaded)
+
+        if board is not None:
+            logging.info("Pasteboard coverage %.3f" % covered[pad:limit-pad].mean())
+
+            with timer.stage('blur'):
+                blur_frequencies(board.array, precision=precision)
         
-        # logging.info("Start %i %f end %f " %(i, start_offset_sec, end_offset_sec))
-        # logging.info("%i %i -> %i %i " %(start, end, out_start, out_end))
-
-        pasteboard[out_start:out_end, :] = im[start:end, :]
-
-
-    # Split pasteboard into sections of window size
-    pasteboard = pasteboard.reshape(-1, window_size_px, pasteboard.shape[-1])
-    
-    # Generate similarity images 
-    stride = 8
-    similarities = get_similarity_images(pasteboard, chunk_stride=stride)
+            # Generate similarity images
+            band = None
+            if band_size:
+                band = int(band_size * px_per_sec / stride)
+            pairs = missing if cache else range(target_width // window_size_px - 1)
+            with timer.stage('pairs'):
+                similarities = compute_pair_images(board.array, window_size_px, pairs, chunk_stride=stride,
+                                                   precision=precision, equalize=equalize, mode=mode, band=band,
+                                                   processes=processes)
+    finally:
+        if board is not None:
+            board.close()
+
+    if cache:
+        with timer.stage('cache_store'):
+            for i in similarities:
+                store_cached_pair(pair_name(i), similarities[i], px_per_sec)
+            prune_cache()
+        for i in cached:
+            similarities[i], px_per_sec = cached[i]
+        if not similarities:
+            logging.warning("No window pairs in time range")
+            return []
+        window_size_px = round(px_per_sec * window_size)
+
+        # Pairs without spectrograms (no audio or failed downloads) are blank,
+        # so every window stays in its place when stitching. They are not cached.
+        blank = [i for i in missing if i not in similarities]
+        if blank:
+            logging.warning("%i window pairs without spectrograms are blank" % len(blank))
+            shape = next(iter(similarities.values())).shape
+            for i in blank:
+                similarities[i] = np.zeros(shape, dtype=PRECISIONS[precision][1])
 
     # Stack similarity images into one large image
-    stacked_similarity = np.vstack(similarities)
+    with timer.stage('stitch'):
+        stacked_similarity = np.vstack(stitch_images([similarities[i] for i in sorted(similarities)]))
     
-    # Calculate the cropping of image
-    duration = time_end - time_start
-    start = int(window_size_px / stride)
-    end = int(start + math.floor(duration.total_seconds() * px_per_sec) / stride)
+    destinations = []
+    for (target_start, target_end, destination) in targets:
+        # Calculate the cropping of image
+        duration = target_end - target_start
+        start = int((window_size_px + (target_start - time_start).total_seconds() * px_per_sec) / stride)
+        if cache:
+            start = int((target_start - time_start_padded).total_seconds() * px_per_sec / stride)
+        end = int(start + math.floor(duration.total_seconds() * px_per_sec) / stride)
     
-    # Crop and downsample
-    stacked_similarity = stacked_similarity[ start : end : downsample, : : downsample ] 
-
-    # logging.info(stacked_similarity.shape)
-
-    # # DEBUG    
-    # imarr = np.vstack(pasteboard)
-    # imarr = cqtshow(imarr)
-    # im = Image.fromarray((imarr).astype(dtype=np.uint8))
-    # im = im.resize((math.floor(imarr.shape[1]/2), math.floor(imarr.shape[0]) ))
-    # im.save(os.path.dirname(os.path.abspath(__file__))+"/test_spec.jpeg")
-
-    imarr = stacked_similarity
-    normalize(imarr)
-    imarr = imarr.T
-    # # imarr = apply_cmap(imarr, 'inferno')
-    im = Image.fromarray((imarr*255).astype(dtype=np.uint8))
-    # im.save(os.path.dirname(os.path.abspath(__file__))+"/test2.jpeg")
+        # Crop and downsample, the stacked image is shared by the targets
+        cropped = stacked_similarity[ start : end : downsample, : : downsample ].copy()
+
+        # logging.info(cropped.shape)
+
+        # # DEBUG
+        # imarr = np.vstack(pasteboard)
+        # imarr = cqtshow(imarr)
+        # im = Image.fromarray((imarr).astype(dtype=np.uint8))
+        # im = im.resize((math.floor(imarr.shape[1]/2), math.floor(imarr.shape[0]) ))
+        # im.save(os.path.dirname(os.path.abspath(__file__))+"/test_spec.jpeg")
+
+        with timer.stage('normalize'):
+            imarr = cropped
+            normalize(imarr)
+            imarr = imarr.T
+            # # imarr = apply_cmap(imarr, 'inferno')
+            im = Image.fromarray((imarr*255).astype(dtype=np.uint8))
+        # im.save(os.path.dirname(os.path.abspath(__file__))+"/test2.jpeg")
+
+        metadata = {}
+        metadata['time_start'] = target_start.isoformat(' ', 'seconds')
+        metadata['time_end'] = target_end.isoformat(' ', 'seconds')
+        metadata['duration'] = duration.total_seconds()
+        metadata['downsample'] = downsample
+        metadata['window_size'] = window_size
+        metadata['precision'] = precision
+        metadata['equalize'] = equalize
+        metadata['mode'] = mode
+        if band_size:
+            metadata['band_size'] = band_size
+        if cache:
+            metadata['cached_pairs'] = len(cached)
+        if config_key:
+            metadata['config_key'] = config_key
+        if len(targets) > 1:
+            metadata['batch_start'] = time_start.isoformat(' ', 'seconds')
+            metadata['batch_end'] = time_end.isoformat(' ', 'seconds')
+
+        with timer.stage('store'):
+            store_image(im, metadata, destination=destination, image_format=image_format)
+        destinations.append(destination)
+    logging.info("Similarity finished", extra=dict(timer.extra(), targets=len(targets)))
+    return destinations
     
     
-    metadata = {}
-    metadata['time_start'] = time_start.isoformat(' ', 'seconds')
-    metadata['time_end'] = time_end.isoformat(' ', 'seconds')
-    metadata['duration'] = duration.total_seconds()
-    metadata['downsample'] = downsample
-    metadata['window_size'] = window_size
-
-    store_image(im, metadata, destination=destination)
-
-
-def store_image(im, metadata, destination, upload=True):
-    """ Upload image to cloud storage """
-    tmp = tempfile.NamedTemporaryFile(suffix=".jpg")
-    im.save(tmp, format='jpeg', optimize=True, quality=80)
-    tmp.seek(0)
-    
+def max_batch_seconds(precision=PRECISION, max_bytes=BATCH_BYTES):
+    """ Seconds of spectrograms that fit a pasteboard of max_bytes in the precision """
+    itemsize = np.dtype(PRECISIONS[precision][0]).itemsize
+    return max_bytes / (SPECTROGRAM_FRAMES_PER_SEC * SPECTROGRAM_BINS * itemsize)
+
+def similarity_tiles(location_name, zoom, time_start, time_end, batch_seconds=None, **kwargs):
+    """ Generate the similarity tiles at zoom between time_start and time_end, returns their destinations
+
+    The tiles are computed in batches of up to batch_seconds (at least one
+    tile), by default as many as fit BATCH_BYTES. Keyword arguments are
+    passed to generate_similarity_batch.
+    """
+    if batch_seconds is None:
+        batch_seconds = max_batch_seconds(kwargs.get('precision', PRECISION))
+    starts = tiles.tile_starts(zoom, time_start, time_end)
+    duration = datetime.timedelta(seconds=tiles.tile_duration(zoom))
+    per_batch = max(1, int(batch_seconds // duration.total_seconds()))
+    destinations = []
+    for i in range(0, len(starts), per_batch):
+        targets = [(start, start + duration, tiles.tile_destination(location_name, zoom, start))
+                   for start in starts[i:i + per_batch]]
+        logging.info("Similarity batch of %i tiles from %s" % (len(targets), targets[0][0]))
+        destinations += generate_similarity_batch(location_name, targets, **kwargs)
+    return destinations
+
+
+def store_image(im, metadata, destination, upload=True, image_format=OUTPUT_FORMAT):
+    """ Encode image in memory and upload it to cloud storage """
     if upload:
         output_bucket = storage.Client().get_bucket(OUTPUT_BUCKET_NAME)
         blob = output_bucket.blob("{}".format(destination))
-        blob.upload_from_filename(tmp.name)
-        blob.metadata = metadata
-        blob.patch()
-        logging.info("Saved to %s" % destination)
-    tmp.close()
+        size = image_encoding.upload(blob, im, metadata, image_format)
+        logging.info("Saved to %s" % destination, extra={'format': image_format, 'bytes': size})
 
 
 def pubsub_callback(message):
@@ -293,14 +850,29 @@ def pubsub_callback(message):
     try:
         time_fmt = "%Y-%m-%d %H:%M:%S.%f %z"
     
-        generate_similarity(
+        if message.attributes.get('batch', 'False') == 'True':
+            # All tiles at zoom in the range, the destinations follow from the tile grid
+            generate = functools.partial(similarity_tiles, zoom=int(message.attributes.get('zoom')),
+                                         batch_seconds=float(message.attributes.get('batch_seconds', 0)) or None)
+        else:
+            generate = functools.partial(generate_similarity, destination=message.attributes.get('destination'))
+
+        generate(
             location_name=message.attributes.get('location_name'),
             time_start=datetime.datetime.strptime(message.attributes.get('time_start'), time_fmt),
             time_end= datetime.datetime.strptime(message.attributes.get('time_end'), time_fmt),
             bucket_name=message.attributes.get('bucket_name', 'deepblue-spectrograms'),
-            destination=message.attributes.get('destination'),
             window_size=int(message.attributes.get('window_size')),
-            downsample=int(message.attributes.get('downsample'))
+            downsample=int(message.attributes.get('downsample')),
+            raw=message.attributes.get('raw', 'False') == 'True',
+            precision=message.attributes.get('precision', PRECISION),
+            equalize=message.attributes.get('equalize', EQUALIZE_METHOD),
+            mode=message.attributes.get('mode', SIMILARITY_MODE),
+            band_size=float(message.attributes.get('band_size', 0)) or None,
+            processes=int(message.attributes.get('processes', PAIR_PROCESSES)),
+            cache=message.attributes.get('cache', str(CACHE)) == 'True',
+            image_format=message.attributes.get('format', OUTPUT_FORMAT),
+            config_key=message.attributes.get('config_key')
         )
         
     except Exception as e:
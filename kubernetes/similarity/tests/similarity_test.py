@@ -0,0 +1,213 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import tempfile
+import unittest
+import librosa
+import numpy as np
+from similarity import similarity
+
+
+def fixture(frames=300, bins=48, seed=0):
+    """ Spectrogram like amplitudes with a few repeated units """
+    rng = np.random.RandomState(seed)
+    amp = rng.rand(frames, bins) * 0.1
+    unit = rng.rand(20, bins)
+    for start in range(10, frames - 20, 70):
+        amp[start:start+20] += unit
+    return amp
+
+
+def loop_chunks(x, width, stride):
+    indices = np.arange(0, len(x) - width, stride)
+    return np.array([x[j:j+width] for j in indices])
+
+
+def loop_straighten(cov):
+    n = len(cov)
+    straight = np.zeros_like(cov)
+    for i, row in enumerate(cov):
+        src = max(0, i - n//2)
+        dst = max(0, n//2 - i)
+        w = min(len(cov[i, src:]), len(straight[i, dst:]))
+        straight[i, dst:dst+w] = cov[i,src:src+w]
+    return straight
+
+
+class TestSimilarity(unittest.TestCase):
+
+    def testGetChunks(self):
+        x = fixture()
+        for width, stride in [(64, 8), (16, 3), (10, 10)]:
+            chunks = similarity.get_chunks(x, width, stride)
+            np.testing.assert_array_equal(chunks, loop_chunks(x, width, stride))
+            self.assertTrue(np.shares_memory(chunks, x))
+
+    def testChunkCovariance(self):
+        x = fixture()
+        for width, stride in [(64, 8), (16, 3)]:
+            expected = np.cov(similarity.flatish(loop_chunks(x, width, stride)))
+            for method in ['offsets', 'gram']:
+                cov = similarity.chunk_covariance(x, width, stride, method=method)
+                np.testing.assert_allclose(cov, expected, rtol=1e-7, atol=1e-12)
+
+    def testChunkCovarianceGram(self):
+        # Strides that do not divide the width give phases with different lengths
+        x = fixture(frames=157, bins=20, seed=1)
+        for width, stride in [(64, 8), (16, 3), (10, 10), (7, 4), (5, 9)]:
+            expected = np.cov(similarity.flatish(loop_chunks(x, width, stride)))
+            cov = similarity.chunk_covariance(x, width, stride, method='gram')
+            np.testing.assert_allclose(cov, expected, rtol=1e-7, atol=1e-12)
+
+    def testDiagonalWindowSums(self):
+        g = np.arange(36, dtype=float).reshape(6, 6)
+        out = similarity.diagonal_window_sums(g, 3, 4)
+        for i in range(4):
+            for j in range(4):
+                self.assertEqual(out[i, j], sum(g[i+k, j+k] for k in range(3)))
+
+    def testHistogramEqualize(self):
+        x = np.random.RandomState(2).rand(50, 40) ** 3
+        exact = similarity.histogram_equalize(x)
+        approx = similarity.histogram_equalize(x, method='histogram')
+        self.assertEqual(approx.shape, x.shape)
+        self.assertLess(np.abs(exact - approx).max(), 0.05)
+
+    def testHistogramEqualizeVisualDiff(self):
+        # Compare the final 8 bit images after contrast
+        x = fixture(frames=600, bins=64)
+        images = []
+        for method in ['argsort', 'histogram']:
+            cov = similarity.get_similarity(x, freq_blur=4, equalize=method)
+            images.append((similarity.normalize(cov) * 255).astype(np.uint8))
+        diff = np.abs(images[0].astype(int) - images[1])
+        self.assertLess(diff.mean(), 0.5)
+        self.assertLess(np.percentile(diff, 99.9), 8)
+
+    def testStraighten(self):
+        for n in [1, 2, 7, 16]:
+            cov = np.random.RandomState(n).rand(n, n)
+            np.testing.assert_array_equal(similarity.straighten(cov), loop_straighten(cov))
+            # The cached index must not leak between calls
+            np.testing.assert_array_equal(similarity.straighten(cov.T), loop_straighten(cov.T))
+
+    def testLagCovariance(self):
+        x = fixture(frames=400, bins=24)
+        for width, stride, block in [(64, 8, 256), (16, 3, 7), (10, 10, 5)]:
+            full = similarity.chunk_covariance(x, width, stride)
+            n = len(full)
+            straight = similarity.straighten(full)
+            cov, valid = similarity.lag_covariance(x, width, stride, n//2, block=block)
+            np.testing.assert_allclose(cov[:, :2*(n//2)], straight[:, :2*(n//2)], rtol=1e-7, atol=1e-12)
+            # A narrower band is the center of the straightened matrix
+            band = n//4
+            cov, valid = similarity.lag_covariance(x, width, stride, band, block=block)
+            np.testing.assert_allclose(cov, straight[:, n//2-band:n//2+band], rtol=1e-7, atol=1e-12)
+            self.assertEqual(valid.sum(), (straight[:, n//2-band:n//2+band] != 0).sum())
+
+    def testBandSimilarityImages(self):
+        x = fixture(frames=3 * 96, bins=32)
+        windows = x.reshape(3, 96, 32)
+        full = similarity.get_similarity_images(windows, chunk_width=16, chunk_stride=4, mode='full')
+        # Without a band every lag is calculated, in full
+        band = similarity.get_similarity_images(windows, chunk_width=16, chunk_stride=4, mode='band')
+        for a, b in zip(full, band):
+            np.testing.assert_array_equal(a, b)
+        narrow = similarity.get_similarity_images(windows, chunk_width=16, chunk_stride=4, mode='band', band=6)
+        self.assertEqual([i.shape for i in narrow], [(24, 12)] * 3)
+
+    def testParallelSimilarityImages(self):
+        x = fixture(frames=4 * 96, bins=32)
+        windows = x.reshape(4, 96, 32)
+        for (mode, band) in [('full', None), ('band', 6)]:
+            sequential = similarity.get_similarity_images(
+                windows, chunk_width=16, chunk_stride=4, mode=mode, band=band, processes=1)
+            parallel = similarity.get_similarity_images(
+                windows, chunk_width=16, chunk_stride=4, mode=mode, band=band, processes=2)
+            for a, b in zip(sequential, parallel):
+                np.testing.assert_array_equal(a, b)
+
+    def testBlurredBoardPair(self):
+        x = fixture(frames=2 * 96, bins=48)
+        windows = x.reshape(2, 96, 48)
+        # Blurring each pair after stacking and padding it
+        pair = np.pad(x, ((8, 8), (0, 0)), 'edge')
+        expected = similarity.straighten(similarity.get_similarity(pair, chunk_width=16, chunk_stride=4))
+        board = similarity.padded_board(windows, chunk_width=16)
+        np.testing.assert_array_equal(
+            similarity.pair_similarity(board, 0, 96, chunk_width=16, chunk_stride=4), expected)
+
+        # Blocks of rows are blurred separately
+        blocked = similarity.blur_frequencies(np.pad(x, ((8, 8), (0, 0)), 'edge'), block=7)
+        np.testing.assert_array_equal(blocked, board)
+
+    def testRawSpectrogram(self):
+        # The range of the png: db_min to db_max and at most TOP_DB below the peak
+        cqt = (fixture(frames=40, bins=8) ** 4 * 20).astype(np.float16)
+        f = io.BytesIO()
+        np.save(f, cqt)
+        np.testing.assert_array_equal(similarity.npy_view(f.getvalue()), cqt)
+
+        similarity.pool_bucket = None
+        similarity.pool_precision = 'float32'
+        metadata = {'db_min': '-80', 'db_max': '10'}
+        row = {'filename': 'x.mp3', 'data': {'npy': (f.getvalue(), metadata)}}
+        raw, _ = similarity.fetch_raw_spectrogram(row)
+        db = np.clip(librosa.amplitude_to_db(cqt.astype(np.float32)), -80, 10)
+        self.assertEqual(raw.dtype, np.float32)
+        np.testing.assert_allclose(raw, librosa.db_to_amplitude(db), rtol=1e-4)
+        self.assertGreater(raw.min(), librosa.db_to_amplitude(-80))
+
+    def testCachedPairs(self):
+        x = fixture(frames=4 * 96, bins=32)
+        windows = x.reshape(4, 96, 32)
+        expected = similarity.get_similarity_images(windows, chunk_width=16, chunk_stride=4)
+        cache_dir = similarity.CACHE_DIR
+        with tempfile.TemporaryDirectory() as tmp:
+            similarity.CACHE_DIR = tmp
+            try:
+                key = similarity.cache_key(window_size=96)
+                board = similarity.padded_board(windows, chunk_width=16)
+                pairs = similarity.compute_pair_images(board, 96, [0, 1], chunk_width=16, chunk_stride=4)
+                for i in pairs:
+                    similarity.store_cached_pair(similarity.cache_name('loc', key, 100 + i), pairs[i], 86.1)
+                self.assertIsNone(similarity.load_cached_pair(similarity.cache_name('loc', key, 102)))
+                # Pairs of other spectrogram generations are not hits
+                self.assertIsNone(similarity.load_cached_pair(
+                    similarity.cache_name('loc', key, 100, [['x.0001.mp3', ['png', 2]]])))
+
+                images = {}
+                for i in [0, 1]:
+                    images[i], px_per_sec = similarity.load_cached_pair(similarity.cache_name('loc', key, 100 + i))
+                    self.assertEqual(px_per_sec, 86.1)
+                images.update(similarity.compute_pair_images(board, 96, [2], chunk_width=16, chunk_stride=4))
+                for a, b in zip(expected, similarity.stitch_images([images[i] for i in sorted(images)])):
+                    np.testing.assert_array_equal(a, b)
+
+                similarity.prune_cache(max_bytes=0)
+                self.assertEqual(os.listdir(os.path.join(tmp, 'loc', key)), [])
+            finally:
+                similarity.CACHE_DIR = cache_dir
+
+    def testBatchSeconds(self):
+        # A float64 pasteboard of BATCH_BYTES, four times the seconds at float16
+        seconds = similarity.max_batch_seconds('float64')
+        board = seconds * similarity.SPECTROGRAM_FRAMES_PER_SEC * similarity.SPECTROGRAM_BINS * 8
+        self.assertAlmostEqual(board, similarity.BATCH_BYTES)
+        self.assertAlmostEqual(similarity.max_batch_seconds('float16'), 4 * seconds)
+        self.assertLess(seconds, 3600)
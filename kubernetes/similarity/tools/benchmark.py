@@ -0,0 +1,193 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmarks for the similarity job on a synthetic pasteboard.
+#
+#   python -m similarity.tools.benchmark chunks --window-size 30
+
+import argparse
+import time
+import tracemalloc
+import numpy as np
+from similarity import similarity
+
+PX_PER_SEC = 22050 / 256.0
+BINS = 1024
+
+
+def window_px(window_size):
+    # A multiple of the stride keeps the pair covariance even sized
+    return int(PX_PER_SEC * window_size) // 8 * 8
+
+
+def pasteboard(window_size, windows=2, bins=BINS, seed=0):
+    """ Noise with a repeated unit every few seconds, like a song """
+    rng = np.random.RandomState(seed)
+    amp = rng.rand(window_px(window_size) * windows, bins) * 0.1
+    unit = rng.rand(int(PX_PER_SEC), bins)
+    for start in range(0, len(amp) - len(unit), int(PX_PER_SEC * 4)):
+        amp[start:start+len(unit)] += unit
+    return amp
+
+
+def pair(window_size, chunk_width=64):
+    amp = pasteboard(window_size)
+    return np.pad(amp, ((chunk_width//2, chunk_width//2), (0, 0)), 'edge')
+
+
+def measure(fn):
+    """ Run fn, returns result, seconds and peak traced allocation in bytes """
+    tracemalloc.start()
+    t = time.time()
+    ret = fn()
+    d = time.time() - t
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return ret, d, peak
+
+
+def report(name, d, peak):
+    print("%-24s %8.2fs %10.1f MB" % (name, d, peak / 1e6))
+
+
+def loop_chunks(x, width, stride):
+    """ get_chunks before it returned a strided view """
+    indices = np.arange(0, len(x) - width, stride)
+    chunks = np.empty((len(indices), width, x.shape[1]), dtype=x.dtype)
+    for i in range(len(indices)):
+        j = indices[i]
+        chunks[i] = x[j:j+width]
+    return chunks
+
+
+def bench_chunks(args):
+    x = pair(args.window_size)
+    print("pair %s, chunk width %i stride %i" % (x.shape, args.chunk_width, args.stride))
+
+    expected, d, peak = measure(
+        lambda: np.cov(similarity.flatish(loop_chunks(x, args.chunk_width, args.stride))))
+    report("copied chunks + np.cov", d, peak)
+
+    for method in ['offsets', 'gram']:
+        cov, d, peak = measure(
+            lambda: similarity.chunk_covariance(x, args.chunk_width, args.stride, method=method))
+        report("chunk_covariance %s" % method, d, peak)
+        print("max relative difference %g" % (np.abs(cov - expected).max() / np.abs(expected).max()))
+
+
+def similarity_image(pasteboard, window_px, precision):
+    """ get_similarity_images and the normalization of generate_similarity """
+    storage_dtype = similarity.PRECISIONS[precision][0]
+    windows = pasteboard.astype(storage_dtype).reshape(-1, window_px, pasteboard.shape[1])
+    stacked = np.vstack(similarity.get_similarity_images(windows, precision=precision))
+    similarity.normalize(stacked)
+    return (stacked.T * 255).astype(np.uint8)
+
+
+def bench_precision(args):
+    px = window_px(args.window_size)
+    amp = pasteboard(args.window_size, windows=3)
+    print("pasteboard %s, 3 windows of %i px" % (amp.shape, px))
+
+    expected, d, peak = measure(lambda: similarity_image(amp, px, 'float64'))
+    report("float64", d, peak)
+    for precision in ['float32', 'float16']:
+        img, d, peak = measure(lambda: similarity_image(amp, px, precision))
+        report(precision, d, peak)
+        diff = np.abs(img.astype(int) - expected)
+        print("  image diff mean %.3f max %i, %.2f%% of pixels differ by more than 1" % (
+            diff.mean(), diff.max(), 100.0 * (diff > 1).mean()))
+
+
+def bench_equalize(args):
+    x = pair(args.window_size)
+    cov = similarity.normalize(similarity.chunk_covariance(x, args.chunk_width, args.stride))
+    print("covariance %s" % (cov.shape,))
+
+    images = {}
+    for method in ['argsort', 'histogram']:
+        eq, d, peak = measure(lambda: similarity.histogram_equalize(cov, method=method))
+        report(method, d, peak)
+        eq **= 100
+        images[method] = (similarity.normalize(eq) * 255).astype(np.uint8)
+    diff = np.abs(images['argsort'].astype(int) - images['histogram'])
+    print("image diff mean %.3f p99.9 %.1f max %i" % (
+        diff.mean(), np.percentile(diff, 99.9), diff.max()))
+
+
+def bench_band(args):
+    x = pair(args.window_size)
+    n = len(range(0, len(x) - args.chunk_width, args.stride))
+    print("pair %s, %i chunks" % (x.shape, n))
+
+    full, d, peak = measure(lambda: similarity.straighten(similarity.get_similarity(x)))
+    report("full + straighten", d, peak)
+    band, d, peak = measure(lambda: similarity.get_similarity(x, band=n//2))
+    report("band n/2", d, peak)
+    print("  max difference %.3g" % np.abs(full[:, :2*(n//2)] - band).max())
+    if args.band_size:
+        lags = int(args.band_size * PX_PER_SEC / args.stride)
+        _, d, peak = measure(lambda: similarity.get_similarity(x, band=lags))
+        report("band %gs" % args.band_size, d, peak)
+
+
+def bench_prepare(args):
+    px = window_px(args.window_size)
+    windows = pasteboard(args.window_size, windows=args.windows).reshape(args.windows, px, BINS)
+    print("%i windows of %i px" % (args.windows, px))
+
+    def stacked():
+        # Every pair stacked, padded and blurred on its own
+        for i in range(len(windows) - 1):
+            pair = np.pad(np.vstack(windows[i:i+2]), ((args.chunk_width//2, args.chunk_width//2), (0, 0)), 'edge')
+            similarity.cv2.GaussianBlur(pair, (65, 1), 0)
+    _, d, peak = measure(stacked)
+    report("vstack + pad + blur", d, peak)
+    _, d, peak = measure(lambda: similarity.padded_board(windows, chunk_width=args.chunk_width))
+    report("padded_board", d, peak)
+
+
+def bench_parallel(args):
+    px = window_px(args.window_size)
+    windows = pasteboard(args.window_size, windows=args.windows).reshape(args.windows, px, BINS)
+    print("%i windows of %i px, %i cpus" % (args.windows, px, similarity.available_cpus()))
+
+    base = None
+    for processes in range(1, (args.processes or similarity.available_cpus()) + 1):
+        _, d, _ = measure(lambda: similarity.get_similarity_images(windows, processes=processes))
+        base = base or d
+        print("%2i processes %8.2fs speedup %.2fx" % (processes, d, base / d))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Similarity benchmarks")
+    parser.add_argument('benchmark', choices=['chunks', 'precision', 'equalize', 'band', 'prepare', 'parallel'])
+    parser.add_argument('--window-size', type=float, default=60, help="Window size in seconds")
+    parser.add_argument('--chunk-width', type=int, default=64)
+    parser.add_argument('--stride', type=int, default=8)
+    parser.add_argument('--band-size', type=float, help="Band of lags in seconds")
+    parser.add_argument('--windows', type=int, default=8, help="Windows in the pasteboard")
+    parser.add_argument('--processes', type=int, help="Max number of processes (default all cpus)")
+    args = parser.parse_args()
+
+    {
+        'chunks': bench_chunks,
+        'precision': bench_precision,
+        'equalize': bench_equalize,
+        'band': bench_band,
+        'prepare': bench_prepare,
+        'parallel': bench_parallel,
+    }[args.benchmark](args)
@@ -18,6 +18,7 @@ import tempfile
 from google.cloud import storage
 import numpy as np
 import librosa
+import scipy.signal
 import png
 import time
 import math
@@ -26,12 +27,18 @@ import sys
 import os
 from multiprocessing import Pool, cpu_count
 import argparse
+import collections
+import functools
+import pickle
+import json
+import hashlib
 
+from google.api_core import exceptions
 from PIL import Image, ImageFile
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
-from common_lib import file_utils, cloud_logging, worker
+from common_lib import file_utils, cloud_logging, worker, shared_array, spectrogram_index
 
 cloud_logging.setup_logging()
 
@@ -51,6 +58,41 @@ FILTER_SCALE = 0.5
 
 N_BINS = 1024
 
+# librosa.load resamples every chunk to this rate
+SAMPLE_RATE = 22050
+
+# "cqt" or "stft", the stft mode maps a plain fft onto the same log frequency
+# bins, much cheaper and good enough for zoomed out tiles
+MODE = "cqt"
+N_FFT = 4096
+STFT_BATCH_FRAMES = 512
+
+# Immutable bundle of the parameters above, passed to the pool workers so
+# they never depend on module globals
+SpectrogramConfig = collections.namedtuple("SpectrogramConfig", [
+    "freq_min", "freq_max", "hop_length", "window", 
+    "db_min", "db_max", "filter_scale", "n_bins", "mode", "n_fft",
+])
+
+# Fields that only change stft outputs
+STFT_FIELDS = ("mode", "n_fft")
+
+DEFAULT_CONFIG = SpectrogramConfig(
+    freq_min=FREQ_MIN,
+    freq_max=FREQ_MAX,
+    hop_length=HOP_LENGTH,
+    window=WINDOW,
+    db_min=DB_MIN,
+    db_max=DB_MAX,
+    filter_scale=FILTER_SCALE,
+    n_bins=N_BINS,
+    mode=MODE,
+    n_fft=N_FFT,
+)
+
+# Per original file state (median and manifest of outputs) for incremental runs
+STATE_PREFIX = '_state/'
+
 
 def fetch_filelist(message):
     file_utils.update_filelist(message.attributes.get('experiment_name'))
@@ -61,37 +103,133 @@ def scale(D, inMin, inMax):
     D = np.clip(D, 0, 255)
     return D
 
-def generate_cqt(file, blob):
+def config_key(config):
+    """ Short hash of a spectrogram config, used to key outputs and state
+
+    The stft fields are left out of cqt configs, so their keys (and the
+    stored manifests and medians) are the same as before the stft mode.
+    """
+    params = config._asdict()
+    if config.mode == "cqt":
+        for field in STFT_FIELDS:
+            params.pop(field)
+    params = json.dumps(params, sort_keys=True)
+    return hashlib.sha1(params.encode()).hexdigest()[:12]
+
+def config_prefix(config):
+    """ Outputs of non default configs are namespaced by the config hash
+
+    The tiler and similarity read them with their config_key option.
+    """
+    if config_key(config) == config_key(DEFAULT_CONFIG):
+        return ''
+    return config_key(config) + '/'
+
+def config_from_attributes(attributes):
+    """ Default config with overrides from pubsub attributes (e.g. hop_length) """
+    overrides = {}
+    for field, default in DEFAULT_CONFIG._asdict().items():
+        if attributes.get(field) is not None:
+            overrides[field] = type(default)(attributes.get(field))
+    return DEFAULT_CONFIG._replace(**overrides)
+
+def generate_cqt(file, blob, config=DEFAULT_CONFIG):
     logging.info("Process %s" % blob.name)
-    audio, sr = librosa.load(file.name)
+    audio, sr = librosa.load(file.name, sr=SAMPLE_RATE)
+
+    if config.mode == "stft":
+        cqt = compute_stft(audio, sr, config)
+    else:
+        cqt = compute_cqt(audio, sr, config)
 
-    n_bins = N_BINS
-    octave_range = librosa.core.hz_to_octs(FREQ_MAX) - librosa.core.hz_to_octs(FREQ_MIN)
+    file.close()
+    os.unlink(file.name)
+    return cqt
+
+def cqt_frames(duration, config=DEFAULT_CONFIG):
+    """ Frames of the cqt (and stft) of duration seconds of audio, both are centered """
+    return 1 + math.ceil(duration * SAMPLE_RATE) // config.hop_length
+
+def chunk_duration(location_name, original_filename, filenames):
+    """ Seconds of the longest of the chunks (wav names) of an original file, from the filelist """
+    filenames = set(filenames)
+    durations = [(r["end_time"] - r["start_time"]).total_seconds()
+                 for r in file_utils.query_audio_files(location_name, original_filename)
+                 if r["filename"].replace('.mp3', '.wav') in filenames]
+    if not durations:
+        raise ValueError("No filelist entries for the chunks of %s" % original_filename)
+    return max(durations)
+
+def compute_cqt(audio, sr, config=DEFAULT_CONFIG):
+    """ Amplitude cqt (time x bins) as float16 """
+    n_bins = config.n_bins
+    octave_range = librosa.core.hz_to_octs(config.freq_max) - librosa.core.hz_to_octs(config.freq_min)
     bins_per_octave = int(n_bins / octave_range)
 
     cqt = librosa.cqt(
         audio,
         sr=sr,
-        hop_length=HOP_LENGTH,
-        fmin=FREQ_MIN,
+        hop_length=config.hop_length,
+        fmin=config.freq_min,
         n_bins=n_bins,
         bins_per_octave=bins_per_octave,
-        filter_scale=FILTER_SCALE,
-        window=WINDOW,
+        filter_scale=config.filter_scale,
+        window=config.window,
     )
 
-    cqt = np.abs(cqt.T).astype(dtype=np.float16, copy=False)
+    return np.abs(cqt.T).astype(dtype=np.float16, copy=False)
+
+@functools.lru_cache(maxsize=8)
+def log_frequency_matrix(sr, config):
+    """ Matrix (fft bins x n_bins) mapping an fft onto the cqt center frequencies
+
+    Every output bin is a triangle around its center frequency, at least one
+    fft bin wide, so low bins interpolate between fft bins and high bins
+    average them. Rows are normalized to sum to one.
+    """
+    octave_range = librosa.core.hz_to_octs(config.freq_max) - librosa.core.hz_to_octs(config.freq_min)
+    bins_per_octave = int(config.n_bins / octave_range)
+    centers = librosa.cqt_frequencies(config.n_bins, fmin=config.freq_min, bins_per_octave=bins_per_octave)
+    fft_freqs = np.fft.rfftfreq(config.n_fft, 1.0 / sr)
+
+    half_width = np.maximum(centers * (2 ** (1.0 / bins_per_octave) - 1), sr / config.n_fft)
+    weights = 1 - np.abs(fft_freqs[:, None] - centers[None, :]) / half_width[None, :]
+    weights = np.maximum(weights, 0)
+    weights /= weights.sum(axis=0, keepdims=True)
+    return weights.astype(np.float32)
+
+def compute_stft(audio, sr, config=DEFAULT_CONFIG):
+    """ Log frequency mapped stft (time x bins) with the same shape as the cqt """
+    n_fft = config.n_fft
+    hop = config.hop_length
+    window = scipy.signal.get_window(config.window, n_fft, fftbins=True).astype(np.float32)
+    # Match the level of librosa's scaled cqt for broadband noise
+    window *= np.sqrt(n_fft) / window.sum()
+    mapping = log_frequency_matrix(sr, config)
+
+    # Centered frames like the cqt, as a strided view over the padded audio
+    padded = np.pad(audio.astype(np.float32, copy=False), n_fft // 2, mode="constant")
+    n_frames = 1 + (len(padded) - n_fft) // hop
+    frames = np.lib.stride_tricks.as_strided(
+        padded,
+        shape=(n_frames, n_fft),
+        strides=(padded.strides[0] * hop, padded.strides[0]),
+        writeable=False,
+    )
 
-    file.close()
-    os.unlink(file.name)
-    return cqt
+    out = np.empty((n_frames, config.n_bins), dtype=np.float16)
+    for start in range(0, n_frames, STFT_BATCH_FRAMES):
+        batch = frames[start:start + STFT_BATCH_FRAMES] * window
+        spectrum = np.abs(np.fft.rfft(batch, axis=1)).astype(np.float32, copy=False)
+        out[start:start + len(batch)] = np.dot(spectrum, mapping)
+    return out
 
 
-def upload_file(file, bucket_name, source_name):
+def upload_file(file, bucket_name, source_name, config, extension="png"):
     storage_client = storage.Client()
     bucket = storage_client.get_bucket(bucket_name)
     # write the npy
-    output_name = "{}.png".format(source_name)
+    output_name = "{}.{}".format(source_name, extension)
     blob = bucket.blob(output_name)
 
     blob.upload_from_filename(file.name)
@@ -101,15 +239,21 @@ def upload_file(file, bucket_name, source_name):
     # Set metadata on file for debuggin
     metadata = {}
     metadata["source_name"] = source_name
-    metadata["freq_min"] = FREQ_MIN
-    metadata["freq_max"] = FREQ_MAX
-    metadata["window"] = WINDOW
-    metadata["hop_length"] = HOP_LENGTH
-    metadata["db_min"] = DB_MIN
-    metadata["db_max"] = DB_MAX
-    metadata["filter_scale"] = FILTER_SCALE
+    metadata["freq_min"] = config.freq_min
+    metadata["freq_max"] = config.freq_max
+    metadata["window"] = config.window
+    metadata["hop_length"] = config.hop_length
+    metadata["db_min"] = config.db_min
+    metadata["db_max"] = config.db_max
+    metadata["filter_scale"] = config.filter_scale
+    metadata["n_bins"] = config.n_bins
+    metadata["mode"] = config.mode
+    if config.mode == "stft":
+        metadata["n_fft"] = config.n_fft
+    metadata["config_key"] = config_key(config)
     blob.metadata = metadata
     blob.patch()
+    return blob
 
 
 # def clean_cqt(input_cqt, median_cqt, mode="mean"):
@@ -132,11 +276,18 @@ def clean_cqt(input_cqt, median_cqt):
     clean *= np.median(median_cqt)
     return clean
 
-def save_cqt(cqt):
+def save_cqt(cqt, config=DEFAULT_CONFIG):
     height, width = cqt.shape
     tmp = tempfile.NamedTemporaryFile(mode="wb", suffix=".png")
     png_writer = png.Writer(width, height, greyscale=True)
-    png_writer.write(tmp, scale(cqt.copy(), DB_MIN, DB_MAX).astype(dtype=np.uint8))
+    png_writer.write(tmp, scale(cqt.copy(), config.db_min, config.db_max).astype(dtype=np.uint8))
+    return tmp
+
+def save_cqt_raw(cqt):
+    """ Save amplitude cqt (time x bins) as float16 .npy, readable in place (see similarity.npy_view) """
+    tmp = tempfile.NamedTemporaryFile(mode="wb", suffix=".npy")
+    np.save(tmp, np.ascontiguousarray(cqt, dtype=np.float16))
+    tmp.flush()
     return tmp
 
 def query_audio_files(experiment_name, name):
@@ -151,61 +302,257 @@ def query_audio_files(experiment_name, name):
     logging.info("Found %i files" % len(filenames))
     return filenames
 
-def generate_spectrograms(bucket, filenames, denoise=True, upload=True, normal=True):
+def store_cqt(file, blob, config=DEFAULT_CONFIG):
+    """ Generate cqt and write it into the shared arena slot of the file """
+    cqt = generate_cqt(file, blob, config)
+    slot = _arena.array[_arena_index[blob.name]]
+    if cqt.shape[1:] != slot.shape[1:]:
+        raise ValueError("Cqt of %s has shape %s, expected %s" 
+                            % (blob.name, cqt.shape, slot.shape))
+    if len(cqt) != len(slot):
+        # The filelist duration is off (rounding or a short chunk), crop or
+        # repeat the last frame rather than failing the whole file
+        logging.warning("Cqt of %s has %i frames, expected %i" % (blob.name, len(cqt), len(slot)))
+    n = min(len(cqt), len(slot))
+    slot[:n] = cqt[:n]
+    slot[n:] = cqt[n-1]
+
+def state_name(original_filename, suffix):
+    return "{}{}{}.{}".format(FILE_PREFIX_DENOISE, STATE_PREFIX, original_filename, suffix)
+
+def load_manifest(bucket, original_filename):
+    """ Manifest of generated outputs, keyed by parameter hash """
+    blob = bucket.get_blob(state_name(original_filename, "json"))
+    if not blob:
+        return {}
+    return json.loads(blob.download_as_string())
+
+def update_manifest(bucket, original_filename, update):
+    """ Read the manifest, apply update(manifest) and write it back
+
+    Config sweeps and redelivered messages can finish runs for the same
+    original file at the same time, the write is conditional on the
+    generation that was read and is retried if another run wrote first.
+    """
+    name = state_name(original_filename, "json")
+    for attempt in range(spectrogram_index.WRITE_ATTEMPTS):
+        blob = bucket.get_blob(name)
+        manifest = json.loads(blob.download_as_string()) if blob is not None else {}
+        update(manifest)
+        try:
+            bucket.blob(name).upload_from_string(json.dumps(manifest), content_type="application/json",
+                                                 if_generation_match=blob.generation if blob is not None else 0)
+            return manifest
+        except exceptions.PreconditionFailed:
+            logging.warning("Manifest of %s was changed by another run, retrying" % original_filename)
+    raise RuntimeError("Could not write the manifest of %s in %i attempts"
+                       % (original_filename, spectrogram_index.WRITE_ATTEMPTS))
+
+def pending_filenames(manifest, key, filenames, kinds, force=False):
+    """ Chunks missing any of the outputs (kinds) of a config in the manifest, all of them when forced """
+    if force:
+        return list(filenames)
+    outputs = manifest.get(key, {}).get("outputs", {})
+    return [f for f in filenames if not set(kinds) <= set(outputs.get(f, []))]
+
+def record_outputs(manifest, key, filenames, kinds):
+    """ Add the outputs (kinds) of the chunks to the manifest entry of a config """
+    entry = manifest.setdefault(key, {"outputs": {}})
+    for filename in filenames:
+        entry["outputs"][filename] = sorted(set(entry["outputs"].get(filename, [])) | set(kinds))
+
+def load_median(blob):
+    tmp = tempfile.NamedTemporaryFile(suffix=".npy")
+    blob.download_to_file(tmp)
+    tmp.flush()
+    median_cqt = np.load(tmp.name)
+    tmp.close()
+    return median_cqt
+
+def check_median(median_cqt, frames, config=DEFAULT_CONFIG):
+    """ The stored median if it fits the arena, None if it has to be recalculated
+
+    The median is stored from all chunks of the file, a changed filelist (or
+    duration) makes it a different shape than the cqts of a new run.
+    """
+    if median_cqt is None or median_cqt.shape == (frames, config.n_bins):
+        return median_cqt
+    logging.warning("Stored median has shape %s, expected %s, recalculating"
+                    % (median_cqt.shape, (frames, config.n_bins)))
+    return None
+
+def store_median(bucket, original_filename, key, median_cqt, generation):
+    """ Store the median, unless another run replaced the generation it was read at """
+    blob = bucket.blob(state_name(original_filename, key + ".median.npy"))
+    tmp = tempfile.NamedTemporaryFile(suffix=".npy")
+    np.save(tmp, median_cqt)
+    tmp.flush()
+    try:
+        blob.upload_from_filename(tmp.name, if_generation_match=generation)
+    except exceptions.PreconditionFailed:
+        logging.warning("Median of %s was stored by another run" % original_filename)
+    finally:
+        tmp.close()
+
+def index_outputs(location_name, original_filename, uploaded):
+    """ Add the uploaded (bucket, name, filename, entry) of the chunks of an original file to the spectrogram index """
+    rows = dict((r["filename"].replace('.mp3', '.wav'), r)
+                for r in file_utils.query_audio_files(location_name, original_filename))
+    by_bucket = {}
+    for (bucket_name, name, filename, entry) in uploaded:
+        if filename not in rows:
+            continue
+        entry["chunk"] = rows[filename]["filename"]
+        entry["start_time"] = rows[filename]["start_time"].isoformat()
+        by_bucket.setdefault(bucket_name, {})[name] = entry
+
+    for (bucket_name, entries) in by_bucket.items():
+        bucket = storage.Client().get_bucket(bucket_name)
+        spectrogram_index.write(bucket, location_name, original_filename, entries)
+
+def generate_spectrograms(bucket, filenames, location_name, original_filename, denoise=True,
+                          upload=True, normal=True, raw=False, force=False, config=DEFAULT_CONFIG):
+    global _arena
+    global _arena_index
+    global _median_cqt
+
     logging.info("Generate spectrogram for bucket: %s" 
                     % (bucket))
-    
-    # Fetch the files to memory, and generate cqts (running in parallel)
-    all_cqts = np.array(
-        file_utils.fetch_files(filenames, bucket, generate_cqt)
-    )
-    
-    logging.info("Download and preprocess finished")
-    logging.info("Size of cqts %i bytes" % sys.getsizeof(all_cqts))
-    
-    median_cqt = None
-    if denoise:
-        # Calculate median image
-        median_cqt = np.median(all_cqts, axis=0)
 
-        logging.info("Median calculation finished")
+    if not filenames:
+        logging.warning("No files to process")
+        return
+
+    # The shape of the shared arena all workers write to follows from the
+    # chunk duration and the config, so every cqt runs in parallel. It is
+    # sized from all chunks like the stored median.
+    frames = cqt_frames(chunk_duration(location_name, original_filename, filenames), config)
+
+    # Skip outputs that were already generated with the same parameters, and
+    # reuse the stored median so only new chunks need a cqt
+    incremental = upload
+    kinds = [k for k, on in (("normal", normal), ("denoise", denoise), ("raw", raw)) if on]
+    key = config_key(config)
+    _median_cqt = None
+    median_generation = 0
+    export_filenames = filenames
+    if incremental:
+        state_bucket = storage.Client().get_bucket(OUTPUT_BUCKET_DENOISE)
+        if not force:
+            export_filenames = pending_filenames(load_manifest(state_bucket, original_filename),
+                                                 key, filenames, kinds)
+        logging.info("%i of %i files need processing" % (len(export_filenames), len(filenames)))
+        if not export_filenames:
+            return
+
+        if denoise:
+            median_blob = state_bucket.get_blob(state_name(original_filename, key + ".median.npy"))
+            if median_blob is not None:
+                median_generation = median_blob.generation
+                if not force:
+                    _median_cqt = check_median(load_median(median_blob), frames, config)
+
+    # All chunks are needed when the median has to be calculated
+    cqt_filenames = export_filenames
+    if denoise and _median_cqt is None:
+        cqt_filenames = filenames
+
+    _arena = shared_array.SharedArray((len(cqt_filenames), frames, config.n_bins), np.float16)
+    _arena_index = {filename: i for i, filename in enumerate(cqt_filenames)}
+
+    try:
+        # Fetch the files, and generate cqts into the arena (running in parallel)
+        file_utils.fetch_files(cqt_filenames, bucket, functools.partial(store_cqt, config=config))
         
-    # Create list of jobs that needs to be run
-    jobs = []
-    for i, cqt in enumerate(all_cqts):
-        jobs.append([
-            filenames[i], cqt, median_cqt, normal, denoise, upload
-        ])
-    
-    # Create initializer for parallel job, processing data
-    def initializer():
-        global _client
-        _client = storage.Client()
-    
-    # Run all export function on all jobs in parallel
-    with Pool(initializer=initializer, processes=cpu_count() * 4) as pool:
-        pool.map(export, jobs)
+        logging.info("Download and preprocess finished")
+        logging.info("Size of cqts %i bytes" % _arena.nbytes)
+        
+        if denoise and _median_cqt is None:
+            # Calculate median image
+            _median_cqt = np.median(_arena.array, axis=0)
+            if incremental:
+                store_median(state_bucket, original_filename, key, _median_cqt, median_generation)
+
+            logging.info("Median calculation finished")
+            
+        # Create list of jobs that needs to be run, the cqts are read from the
+        # arena by the forked workers so only the index is sent over the pipe
+        jobs = []
+        for filename in export_filenames:
+            jobs.append([
+                _arena_index[filename], filename, normal, denoise, upload, raw, config
+            ])
+        
+        # Create initializer for parallel job, processing data
+        def initializer():
+            global _client
+            _client = storage.Client()
+        
+        # Run all export function on all jobs in parallel
+        with Pool(initializer=initializer, processes=cpu_count() * 4) as pool:
+            uploaded = [u for us in pool.map(export, jobs) for u in us]
+
+        peak_self, peak_children = shared_array.peak_memory()
+        logging.info(
+            "Export finished",
+            extra={
+                "arena_bytes": _arena.nbytes,
+                "ipc_job_bytes": sum(len(pickle.dumps(job)) for job in jobs),
+                "peak_rss_bytes": peak_self,
+                "peak_rss_children_bytes": peak_children,
+            },
+        )
+    finally:
+        _arena.close()
+        _arena = None
+        _median_cqt = None
+
+    if incremental:
+        update_manifest(state_bucket, original_filename,
+                        lambda manifest: record_outputs(manifest, key, export_filenames, kinds))
+
+    # Readers find the outputs without a request per object
+    if upload:
+        index_outputs(location_name, original_filename, uploaded)
 
 def export(job):
+    """ Store the outputs of one chunk, returns (bucket, name, filename, index entry) of the uploads """
     # Extract job info
-    filename, cqt, median_cqt, normal, denoise, upload = job
+    index, filename, normal, denoise, upload, raw, config = job
+    prefix = config_prefix(config)
+    cqt = _arena.array[index]
+    median_cqt = _median_cqt
+    uploaded = []
+
+    def upload_output(f, bucket_name, name, extension="png"):
+        blob = upload_file(f, bucket_name, name, config, extension=extension)
+        uploaded.append((bucket_name, blob.name, filename, spectrogram_index.entry(blob)))
     
     # Save noisy image
     if normal:
         noisy = np.flipud(cqt.T)
         noisy_cqt_db = librosa.amplitude_to_db(noisy)
-        f = save_cqt(noisy_cqt_db)
+        f = save_cqt(noisy_cqt_db, config)
         if upload:
-            upload_file(f, OUTPUT_BUCKET, FILE_PREFIX+filename)
+            upload_output(f, OUTPUT_BUCKET, FILE_PREFIX+prefix+filename)
+        if raw:
+            f = save_cqt_raw(cqt)
+            if upload:
+                upload_output(f, OUTPUT_BUCKET, FILE_PREFIX+prefix+filename, extension="npy")
 
     if denoise:    
         # Generate clean image
         clean = clean_cqt(cqt, median_cqt)
+        if raw:
+            f = save_cqt_raw(clean)
+            if upload:
+                upload_output(f, OUTPUT_BUCKET_DENOISE, FILE_PREFIX_DENOISE+prefix+filename, extension="npy")
         clean = np.flipud(clean.T)
         cqt_db = librosa.amplitude_to_db(clean)
-        f = save_cqt(cqt_db)
+        f = save_cqt(cqt_db, config)
         if upload:
-            upload_file(f, OUTPUT_BUCKET_DENOISE, FILE_PREFIX_DENOISE+filename)
+            upload_output(f, OUTPUT_BUCKET_DENOISE, FILE_PREFIX_DENOISE+prefix+filename)
+    return uploaded
 
 def str_to_bool(s):
     if s == 'True':
@@ -228,6 +575,11 @@ def pubsub_callback(message):
                 upload=True,
                 denoise=str_to_bool(message.attributes.get("denoise", True)), 
                 normal=str_to_bool(message.attributes.get("normal", True)),                 
+                raw=str_to_bool(message.attributes.get("raw", "False")),
+                original_filename=filename,
+                force=str_to_bool(message.attributes.get("force", "False")),
+                config=config_from_attributes(message.attributes),
+                location_name=file_utils.get_location_name(experiment_name),
                 )
 
         except Exception as e:
@@ -259,6 +611,8 @@ if __name__ == "__main__":
     parser.add_argument('--bucket', help="bucket to process", default='deepblue-transcoded-audio')
     parser.add_argument('--denoise', action='store_true', help="denoise spectrogram")
     parser.add_argument('--upload', action='store_true', help="Upload images to cloud storage")
+    parser.add_argument('--raw', action='store_true', help="Also store float16 .npy cqt next to the png")
+    parser.add_argument('--force', action='store_true', help="Regenerate outputs that already exist")
     parser.add_argument('--max-count', type=int, help="Max number chunks to process")
     parser.add_argument('--destination-bucket', default='cl-deepblue-test', help="Bucket to output files if uploading")
     
@@ -270,6 +624,8 @@ if __name__ == "__main__":
     parser.add_argument('--window', default=WINDOW)
     parser.add_argument('--n-bins', default=N_BINS, type=int)
     parser.add_argument('--filter-scale', default=FILTER_SCALE, type=float)
+    parser.add_argument('--mode', default=MODE, choices=['cqt', 'stft'])
+    parser.add_argument('--n-fft', default=N_FFT, type=int)
 
     args = parser.parse_args()
 
@@ -288,19 +644,28 @@ if __name__ == "__main__":
         FILE_PREFIX = 'normal/'
         FILE_PREFIX_DENOISE = 'denoise/'
 
-        FREQ_MIN = args.freq_min
-        FREQ_MAX = args.freq_max
-        HOP_LENGTH = args.hop_length
-        DB_MIN = args.db_min
-        DB_MAX = args.db_max
-        WINDOW = args.window
-        N_BINS = args.n_bins
-        FILTER_SCALE = args.filter_scale
-
+        config = SpectrogramConfig(
+            freq_min=args.freq_min,
+            freq_max=args.freq_max,
+            hop_length=args.hop_length,
+            window=args.window,
+            db_min=args.db_min,
+            db_max=args.db_max,
+            filter_scale=args.filter_scale,
+            n_bins=args.n_bins,
+            mode=args.mode,
+            n_fft=args.n_fft,
+        )
+        logging.info("Spectrogram config %s (%s)" % (config_key(config), config))
 
         generate_spectrograms(
             bucket=args.bucket,
             filenames=filenames,
             denoise=args.denoise,
-            upload=args.upload
+            upload=args.upload,
+            raw=args.raw,
+            original_filename=args.file,
+            force=args.force,
+            config=config,
+            location_name='Hawaii'
         )
\ No newline at end of file
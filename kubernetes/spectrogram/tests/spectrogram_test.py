@@ -0,0 +1,248 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import tempfile
+import types
+import unittest
+import librosa
+import numpy as np
+import scipy.io.wavfile
+from google.api_core import exceptions
+from common_lib import shared_array, spectrogram_index
+from spectrogram import spectrogram
+
+
+class Blob(object):
+    """ Blob of a Bucket in memory """
+
+    def __init__(self, bucket, name, generation=None):
+        self.bucket = bucket
+        self.name = name
+        self.generation = generation
+
+    def _write(self, data, if_generation_match):
+        if self.bucket.before_write:
+            before_write, self.bucket.before_write = self.bucket.before_write, None
+            before_write()
+        generation = self.bucket.generations.get(self.name, 0)
+        if if_generation_match is not None and if_generation_match != generation:
+            raise exceptions.PreconditionFailed('Generation %i of %s' % (generation, self.name))
+        self.bucket.objects[self.name] = data
+        self.bucket.generations[self.name] = generation + 1
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        self._write(data.encode(), if_generation_match)
+
+    def upload_from_filename(self, filename, if_generation_match=None):
+        with open(filename, 'rb') as f:
+            self._write(f.read(), if_generation_match)
+
+    def download_as_string(self):
+        return self.bucket.objects[self.name]
+
+    def download_to_file(self, f):
+        f.write(self.bucket.objects[self.name])
+
+
+class Bucket(object):
+    """ The part of a storage bucket the state uses, in memory """
+
+    def __init__(self):
+        self.objects = {}
+        self.generations = {}
+        # Called once before the next write, to write in between its read and write
+        self.before_write = None
+
+    def blob(self, name):
+        return Blob(self, name)
+
+    def get_blob(self, name):
+        if name not in self.objects:
+            return None
+        return Blob(self, name, self.generations[name])
+
+
+def audio(seconds, seed=0):
+    """ Noise with a few tones, at the sample rate of the cqt """
+    t = np.arange(int(seconds * spectrogram.SAMPLE_RATE)) / float(spectrogram.SAMPLE_RATE)
+    rng = np.random.RandomState(seed)
+    tones = sum(np.sin(2 * np.pi * f * t) for f in (200, 800, 2000))
+    return (tones + rng.randn(len(t)) * 0.1).astype(np.float32)
+
+
+class TestSpectrogram(unittest.TestCase):
+
+    def testConfigKey(self):
+        config = spectrogram.DEFAULT_CONFIG
+        # Keys of stored outputs and state must not change between releases
+        self.assertEqual(spectrogram.config_key(config), 'bf7bd9e8d41e')
+        self.assertEqual(spectrogram.config_prefix(config), '')
+
+        # The stft fields do not change cqt outputs
+        self.assertEqual(spectrogram.config_key(config._replace(n_fft=1024)), 'bf7bd9e8d41e')
+        stft = config._replace(mode='stft')
+        self.assertNotEqual(spectrogram.config_key(stft), spectrogram.config_key(config))
+        self.assertNotEqual(spectrogram.config_key(stft._replace(n_fft=1024)), spectrogram.config_key(stft))
+
+        hop = config._replace(hop_length=512)
+        self.assertEqual(spectrogram.config_prefix(hop), spectrogram.config_key(hop) + '/')
+        self.assertEqual(spectrogram.config_from_attributes({'hop_length': '512'}), hop)
+
+    def testStftShape(self):
+        config = spectrogram.DEFAULT_CONFIG._replace(n_bins=64)
+        x = audio(2.0)
+        cqt = spectrogram.compute_cqt(x, spectrogram.SAMPLE_RATE, config)
+        stft = spectrogram.compute_stft(x, spectrogram.SAMPLE_RATE, config._replace(mode='stft'))
+        self.assertEqual(stft.shape, cqt.shape)
+        self.assertEqual(stft.dtype, cqt.dtype)
+        self.assertEqual(len(stft), spectrogram.cqt_frames(2.0, config))
+
+        # The tones are in the same bins
+        self.assertEqual(np.argmax(stft.mean(axis=0)), np.argmax(cqt.mean(axis=0)))
+
+    def testRawFloor(self):
+        cqt = spectrogram.compute_cqt(audio(1.0), spectrogram.SAMPLE_RATE,
+                                      spectrogram.DEFAULT_CONFIG._replace(n_bins=64))
+        f = spectrogram.save_cqt_raw(cqt.astype(np.float32))
+        raw = np.load(f.name, mmap_mode='r')
+        self.assertEqual(raw.dtype, np.float16)
+        np.testing.assert_array_equal(raw, cqt)
+
+        # Down to the floor of the png (TOP_DB below the peak) float16 keeps
+        # the levels of the png
+        png_db = librosa.amplitude_to_db(cqt.astype(np.float32))
+        floor = raw.max() * librosa.db_to_amplitude(-80.0)
+        raw_db = librosa.amplitude_to_db(np.maximum(raw.astype(np.float32), floor), ref=1.0, top_db=None)
+        np.testing.assert_allclose(raw_db, png_db, atol=0.1)
+        f.close()
+
+    def testStoreCqt(self):
+        config = spectrogram.DEFAULT_CONFIG._replace(n_bins=64, mode='stft')
+        directory = tempfile.mkdtemp()
+        frames = spectrogram.cqt_frames(1.0, config)
+        spectrogram._arena = shared_array.SharedArray((3, frames, config.n_bins), np.float16, shared=False)
+        spectrogram._arena_index = {'short.wav': 0, 'exact.wav': 1, 'long.wav': 2}
+        try:
+            expected = []
+            for name, seconds in (('short.wav', 0.5), ('exact.wav', 1.0), ('long.wav', 1.5)):
+                path = os.path.join(directory, name)
+                scipy.io.wavfile.write(path, spectrogram.SAMPLE_RATE, (audio(seconds) * 1000).astype(np.int16))
+                x, sr = librosa.load(path, sr=spectrogram.SAMPLE_RATE)
+                expected.append(spectrogram.compute_stft(x, sr, config))
+                spectrogram.store_cqt(open(path, 'rb'), types.SimpleNamespace(name=name), config=config)
+            arena = spectrogram._arena.array
+
+            # Every cqt is in its own slot, a short one is padded with its
+            # last frame and a long one is cropped
+            short, exact, long = expected
+            np.testing.assert_array_equal(arena[0][:len(short)], short)
+            np.testing.assert_array_equal(arena[0][len(short):], np.repeat(short[-1:], frames - len(short), axis=0))
+            np.testing.assert_array_equal(arena[1], exact)
+            np.testing.assert_array_equal(arena[2], long[:frames])
+            # The wav files are removed once their cqt is stored
+            self.assertEqual(os.listdir(directory), [])
+
+            path = os.path.join(directory, 'bins.wav')
+            scipy.io.wavfile.write(path, spectrogram.SAMPLE_RATE, (audio(1.0) * 1000).astype(np.int16))
+            spectrogram._arena_index['bins.wav'] = 1
+            with self.assertRaises(ValueError):
+                spectrogram.store_cqt(open(path, 'rb'), types.SimpleNamespace(name='bins.wav'),
+                                      config=config._replace(n_bins=32))
+        finally:
+            spectrogram._arena.close()
+            spectrogram._arena = None
+
+    def testPendingFilenames(self):
+        filenames = ['a.wav', 'b.wav', 'c.wav']
+        manifest = {}
+        self.assertEqual(spectrogram.pending_filenames(manifest, 'k', filenames, ['normal']), filenames)
+
+        spectrogram.record_outputs(manifest, 'k', ['a.wav', 'b.wav'], ['normal'])
+        # Rerun skips existing outputs, a new chunk is processed
+        self.assertEqual(spectrogram.pending_filenames(manifest, 'k', filenames, ['normal']), ['c.wav'])
+        # A new kind or another config needs all chunks
+        self.assertEqual(spectrogram.pending_filenames(manifest, 'k', filenames, ['normal', 'raw']), filenames)
+        self.assertEqual(spectrogram.pending_filenames(manifest, 'other', filenames, ['normal']), filenames)
+        # Force regenerates everything
+        self.assertEqual(spectrogram.pending_filenames(manifest, 'k', filenames, ['normal'], force=True), filenames)
+
+        spectrogram.record_outputs(manifest, 'k', ['a.wav'], ['raw'])
+        self.assertEqual(manifest['k']['outputs']['a.wav'], ['normal', 'raw'])
+        self.assertEqual(spectrogram.pending_filenames(manifest, 'k', filenames, ['normal', 'raw']),
+                         ['b.wav', 'c.wav'])
+
+    def testUpdateManifest(self):
+        bucket = Bucket()
+        name = spectrogram.state_name('o.wav', 'json')
+        spectrogram.update_manifest(bucket, 'o.wav', lambda m: spectrogram.record_outputs(m, 'k1', ['a.wav'], ['normal']))
+
+        # Another config finishes between the read and the write of this one
+        bucket.before_write = lambda: spectrogram.update_manifest(
+            bucket, 'o.wav', lambda m: spectrogram.record_outputs(m, 'k2', ['a.wav'], ['normal']))
+        reads = []
+        def update(m):
+            reads.append(sorted(m))
+            spectrogram.record_outputs(m, 'k3', ['a.wav'], ['normal'])
+        manifest = spectrogram.update_manifest(bucket, 'o.wav', update)
+
+        self.assertEqual(reads, [['k1'], ['k1', 'k2']])
+        self.assertEqual(sorted(manifest), ['k1', 'k2', 'k3'])
+        self.assertEqual(json.loads(bucket.objects[name]), manifest)
+        self.assertEqual(bucket.generations[name], 3)
+
+    def testUpdateManifestAttempts(self):
+        bucket = Bucket()
+        name = spectrogram.state_name('o.wav', 'json')
+        spectrogram.update_manifest(bucket, 'o.wav', lambda m: None)
+        # Another run writes before every write of this one
+        updates = []
+        def update(m):
+            updates.append(m)
+            bucket.before_write = lambda: bucket.blob(name).upload_from_string('{}')
+        with self.assertRaises(RuntimeError):
+            spectrogram.update_manifest(bucket, 'o.wav', update)
+        self.assertEqual(len(updates), spectrogram_index.WRITE_ATTEMPTS)
+
+    def testCheckMedian(self):
+        config = spectrogram.DEFAULT_CONFIG._replace(n_bins=8)
+        median = np.ones((10, 8), dtype=np.float16)
+        self.assertIs(spectrogram.check_median(median, 10, config), median)
+        self.assertIsNone(spectrogram.check_median(None, 10, config))
+        # Stored from a different set of chunks
+        self.assertIsNone(spectrogram.check_median(median, 12, config))
+        self.assertIsNone(spectrogram.check_median(median, 10, config._replace(n_bins=16)))
+
+    def testStoreMedian(self):
+        bucket = Bucket()
+        name = spectrogram.state_name('o.wav', 'k.median.npy')
+        spectrogram.store_median(bucket, 'o.wav', 'k', np.ones((4, 2), dtype=np.float16), 0)
+        self.assertEqual(bucket.generations[name], 1)
+
+        # Another run stored one since, it is kept
+        spectrogram.store_median(bucket, 'o.wav', 'k', np.zeros((4, 2), dtype=np.float16), 0)
+        self.assertEqual(bucket.generations[name], 1)
+        np.testing.assert_array_equal(spectrogram.load_median(bucket.get_blob(name)), np.ones((4, 2)))
+
+        # A recalculated median replaces the generation it was read at
+        spectrogram.store_median(bucket, 'o.wav', 'k', np.zeros((4, 2), dtype=np.float16), 1)
+        self.assertEqual(bucket.generations[name], 2)
+        np.testing.assert_array_equal(spectrogram.load_median(bucket.get_blob(name)), np.zeros((4, 2)))
+
+
+if __name__ == '__main__':
+    unittest.main()
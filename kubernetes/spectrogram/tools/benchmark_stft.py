@@ -0,0 +1,89 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compare throughput and output of the cqt and stft spectrogram modes.
+#
+#   python -m spectrogram.tools.benchmark_stft [audio file]
+#
+# Without an audio file a synthetic chunk (noise with frequency sweeps) of
+# the length of a transcoded chunk is used.
+
+import sys
+import time
+import numpy as np
+import librosa
+from spectrogram import spectrogram
+
+SR = 22050
+DURATION = 43.75
+
+
+def synthetic_audio():
+    rng = np.random.RandomState(0)
+    t = np.arange(int(SR * DURATION)) / SR
+    audio = 0.05 * rng.randn(len(t))
+    for start in np.arange(1, DURATION - 2, 3.0):
+        mask = (t >= start) & (t < start + 1.5)
+        f0 = 150 + 100 * (start % 7)
+        sweep = f0 * (1 + (t - start) * 2)
+        phase = 2 * np.pi * np.cumsum(sweep) / SR
+        audio[mask] += 0.3 * np.sin(phase[mask])
+    return audio.astype(np.float32)
+
+
+def to_image(spec, config):
+    """ Same mapping as the png written by the spectrogram job """
+    db = librosa.amplitude_to_db(np.flipud(spec.T).astype(np.float32))
+    return spectrogram.scale(db, config.db_min, config.db_max).astype(np.uint8)
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        t = time.time()
+        ret = fn()
+        d = time.time() - t
+        best = d if best is None else min(best, d)
+    return ret, best
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        audio, _ = librosa.load(sys.argv[1], sr=SR)
+    else:
+        audio = synthetic_audio()
+
+    cqt_config = spectrogram.DEFAULT_CONFIG._replace(mode="cqt")
+    stft_config = spectrogram.DEFAULT_CONFIG._replace(mode="stft")
+    # Build the mapping matrix outside of the timing
+    spectrogram.log_frequency_matrix(SR, stft_config)
+
+    cqt, cqt_time = timed(lambda: spectrogram.compute_cqt(audio, SR, cqt_config), 1)
+    stft, stft_time = timed(lambda: spectrogram.compute_stft(audio, SR, stft_config), 3)
+
+    seconds = len(audio) / SR
+    print("shape      cqt %s stft %s" % (cqt.shape, stft.shape))
+    print("cqt        %.2fs (%.1fx realtime)" % (cqt_time, seconds / cqt_time))
+    print("stft       %.2fs (%.1fx realtime)" % (stft_time, seconds / stft_time))
+    print("speedup    %.1fx" % (cqt_time / stft_time))
+
+    a = to_image(cqt, cqt_config).astype(np.float32)
+    b = to_image(stft, stft_config).astype(np.float32)
+    diff = np.abs(a - b)
+    print("image diff mean %.2f median %.2f p99 %.2f (0-255)" % (
+        diff.mean(), np.median(diff), np.percentile(diff, 99)))
+    print("image mean cqt %.1f stft %.1f" % (a.mean(), b.mean()))
+    print("image correlation %.3f" % np.corrcoef(a.ravel(), b.ravel())[0, 1])
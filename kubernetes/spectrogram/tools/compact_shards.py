@@ -0,0 +1,55 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Pack the indexed spectrograms of every hour into one shard object so the
+# tiler and similarity read consecutive chunks with one ranged request.
+#
+#   python -m spectrogram.tools.compact_shards --bucket deepblue-spectrograms \
+#       --location Hawaii --start 2015-01-01 --end 2015-01-31
+#
+# Run it after the spectrogram jobs of the days have finished, chunks added
+# to a day later are read directly until the day is compacted again.
+
+import argparse
+import datetime
+import logging
+from google.cloud import storage
+from common_lib import cloud_logging, spectrogram_index
+
+cloud_logging.setup_logging()
+
+
+def parse_day(s):
+    return datetime.datetime.strptime(s, '%Y-%m-%d').date()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Spectrogram shard compaction")
+    parser.add_argument('--bucket', default='deepblue-spectrograms')
+    parser.add_argument('--location', default='Hawaii')
+    parser.add_argument('--start', type=parse_day, required=True, help="First day, YYYY-MM-DD")
+    parser.add_argument('--end', type=parse_day, help="Last day, YYYY-MM-DD, the first day if not set")
+    parser.add_argument('--extension', action='append', help="Object types to pack, png and npy by default")
+    parser.add_argument('--force', action='store_true', help="Pack hours that are packed already again")
+    args = parser.parse_args()
+
+    bucket = storage.Client().bucket(args.bucket)
+    day = args.start
+    while day <= (args.end or args.start):
+        for extension in args.extension or ['png', 'npy']:
+            written = spectrogram_index.compact(bucket, args.location, day, extension, force=args.force)
+            logging.info("Compacted %s %s: %i shards" % (day, extension, written))
+        day += datetime.timedelta(days=1)
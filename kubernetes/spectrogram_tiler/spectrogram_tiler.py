@@ -14,21 +14,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from common_lib import file_utils, cloud_logging, worker
+from common_lib import file_utils, cloud_logging, worker, timeline, image_encoding, spectrogram_index
+from common_lib.tiles import tile_duration, tile_destination, tile_starts
 from google.cloud import storage, pubsub_v1
 import multiprocessing
 from multiprocessing.pool import ThreadPool
 import csv
 import sys
-import tempfile
 import math
 import datetime
 import logging
 import time
 import threading
+import collections
+import hashlib
 import os
-import pytz
 import argparse
+import io
+import json
+import numpy as np
 from PIL import Image, ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
@@ -42,28 +46,164 @@ ACK_DEADLINE = 30
 cloud_logging.setup_logging()
 
 OUTPUT_BUCKET_NAME = 'deepblue-tiled-spectrograms'
+# See image_encoding.FORMATS
+OUTPUT_FORMAT = 'jpeg'
+
+# How the columns of the chunks become tile columns. 'mean', 'max' and
+# 'percentile' (PERCENTILE) reduce the source columns in every tile column
+# (see bin_edges), 'lanczos' resizes every chunk with PIL and pastes it.
+# 'max' and 'percentile' keep short calls visible in zoomed out tiles.
+REDUCTIONS = ['mean', 'max', 'percentile', 'lanczos']
+REDUCTION = 'mean'
+PERCENTILE = 95
+
+# Tiles of a batch job that are uploaded at the same time
+UPLOAD_THREADS = 8
+
+# Tiles around requested tiles (see related_tiles) are rendered while no job
+# ran for PREFETCH_IDLE_SECONDS, at most PREFETCH_BUDGET are queued
+PREFETCH = True
+PREFETCH_BUDGET = 32
+PREFETCH_IDLE_SECONDS = 2
+# A prefetch gives way to a job within this many seconds (see Preempted)
+PREEMPT_SECONDS = 0.1
+MAX_ZOOM = 5
+
+# Seconds a tile job waits for its chunks, None waits for all. With a
+# deadline the tile is stored with the chunks that arrived, marked partial,
+# and rendered again in the background (see Prefetcher.retry).
+DEADLINE = None
+# Upper bounds (seconds) of the chunk latency histogram logged for every tile
+LATENCY_BUCKETS = [0.25, 0.5, 1, 2, 4, 8, 16]
+
+# Held while tiles are rendered, by jobs, batches and the prefetcher
+render_lock = threading.Lock()
+
+
+class Preempted(Exception):
+    """ A prefetch stopped for a job (see fetch_chunks) """
+
+
+def job_key(attributes):
+    """ Identical tile jobs have the same key, batch jobs are never coalesced """
+    if attributes.get('batch') == 'True':
+        return None
+    return tuple(attributes.get(k) for k in ('destination', 'time_start', 'time_end', 'width',
+                                              'bucket_name', 'reduction', 'percentile', 'config_key'))
 
 
 def pubsub_callback(attributes):
     logging.info('processing attributes: {}'.format(attributes))
+    prefetcher.begin(attributes.get('destination'))
     try:
         time_fmt = "%Y-%m-%d %H:%M:%S.%f %z"
+        image_format = attributes.get('format', OUTPUT_FORMAT)
+
+        if attributes.get('batch') == 'True':
+            with render_lock:
+                generate_tile_batch(
+                    location_name = attributes.get('experiment_name'),
+                    zoom = int(attributes.get('zoom')),
+                    time_start = datetime.datetime.strptime(attributes.get('time_start'), time_fmt),
+                    time_end = datetime.datetime.strptime(attributes.get('time_end'), time_fmt),
+                    width = int(attributes.get('width', 512)),
+                    bucket_name = attributes.get('bucket_name', 'deepblue-spectrograms'),
+                    reduction = attributes.get('reduction', REDUCTION),
+                    percentile = float(attributes.get('percentile', PERCENTILE)),
+                    image_format = image_format,
+                    config_key = attributes.get('config_key'),
+                )
+            return
         
-        im, metadata = generate_combined_spectrogram(
-            location_name = attributes.get('experiment_name'),
+        job = dict(
             width = int(attributes.get('width')),
             time_start = datetime.datetime.strptime(attributes.get('time_start'), time_fmt),
             time_end = datetime.datetime.strptime(attributes.get('time_end'), time_fmt),
             bucket_name = attributes.get('bucket_name', 'deepblue-spectrograms'),
+            reduction = attributes.get('reduction', REDUCTION),
+            percentile = float(attributes.get('percentile', PERCENTILE)),
+            config_key = attributes.get('config_key'),
         )
+        deadline = float(attributes.get('deadline', 0)) or DEADLINE
+        expected = current_metadata(attributes.get('experiment_name'), job, image_format)
+        if attributes.get('force') != 'True' and output_exists(attributes.get('destination'), expected):
+            logging.info("Skipped job, %s exists" % attributes.get('destination'))
+            prefetcher.add(attributes.get('experiment_name'), attributes.get('destination'), job, image_format)
+            return 'skipped'
+
+        with render_lock:
+            im, metadata = generate_combined_spectrogram(location_name=attributes.get('experiment_name'),
+                                                         deadline=deadline, **job)
         if im and metadata:
-            store_image(im, metadata, attributes.get('destination'))            
+            store_image(im, metadata, attributes.get('destination'), image_format=image_format)
+            if metadata.get('partial'):
+                prefetcher.retry(attributes.get('experiment_name'), attributes.get('destination'), job, image_format)
+            prefetcher.add(attributes.get('experiment_name'), attributes.get('destination'), job, image_format)
         else:
             logging.info("Skipped job")
         
     except Exception as e:
         logging.exception("Exception of type %s during processing" % e)
         raise e
+    finally:
+        prefetcher.end()
+
+def output_metadata(time_start, time_end, width, bucket_name, reduction, percentile, config_key=None):
+    """ Metadata that identifies what a tile was rendered from """
+    metadata = {
+        'time_start': time_start.isoformat(),
+        'time_end': time_end.isoformat(),
+        'width': width,
+        'source_bucket': bucket_name,
+        'reduction': reduction,
+    }
+    if reduction == 'percentile':
+        metadata['percentile'] = percentile
+    if config_key:
+        metadata['config_key'] = config_key
+    return metadata
+
+
+def tile_rows(location_name, time_start, time_end, bucket_name, config_key=None):
+    """ Copies of the filelist rows from time_start to time_end with their index entries (see annotate) """
+    rows = [dict(row) for row in file_utils.query_audio_files_in_range(location_name, time_start, time_end)]
+    index = spectrogram_index.load(storage.Client().bucket(bucket_name), location_name, time_start, time_end)
+    spectrogram_index.annotate(rows, index, ['png'], config_key)
+    return rows
+
+
+def source_key(rows):
+    """ Hash of the spectrograms of rows and their generations, None unless all of them are in the index """
+    entries = [(spectrogram_index.object_name(row, 'png'), (row.get('index') or {}).get('png')) for row in rows]
+    if not entries or any(e is None for (_, e) in entries):
+        return None
+    return hashlib.sha1(json.dumps(sorted((name, e['generation']) for (name, e) in entries)).encode()).hexdigest()[:12]
+
+
+def current_metadata(location_name, job, image_format=OUTPUT_FORMAT):
+    """ output_metadata of a tile job and the source_key of the chunks it would be rendered from now """
+    metadata = dict(output_metadata(**job), format=image_format)
+    sources = source_key(tile_rows(location_name, job['time_start'], job['time_end'], job['bucket_name'],
+                                   job.get('config_key')))
+    if sources:
+        metadata['sources'] = sources
+    return metadata
+
+
+def output_exists(destination, metadata):
+    """ True if destination was already rendered with the same metadata, and not partially
+
+    Tiles are stored with the source_key of their chunks when all of them
+    were indexed and rendered. A tile with missing spans and without one
+    can miss chunks that exist by now, it is rendered again.
+    """
+    blob = storage.Client().get_bucket(OUTPUT_BUCKET_NAME).get_blob(destination)
+    if blob is None or not blob.metadata or blob.metadata.get('partial') == 'True':
+        return False
+    if blob.metadata.get('missing') and not blob.metadata.get('sources'):
+        return False
+    return all(blob.metadata.get(k) == str(v) for (k, v) in metadata.items())
+
 
 def fetch_filelist(attributes):
     experiment_name = "Hawaii"
@@ -82,58 +222,308 @@ def resize_image(row, image):
         ), Image.LANCZOS)
 
 
+def fetch_png(row):
+    """ Download the spectrogram png of a row, returns the image and the blob metadata
+
+    Rows with an index entry (see spectrogram_index) skip the metadata request.
+    """
+    data, metadata = spectrogram_index.download(pool_bucket, row, 'png')
+    if data is None:
+        raise ValueError(spectrogram_index.object_name(row, 'png') + " not found")
+
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    return img, metadata
+
+
 def fetch_scaled_spectrogram_image(row):
     """ Fetch spectrogram at specific path from cloud storage """
     
     try: 
         filename = row['filename'].replace('.mp3','.wav')
         logging.info("Fetch "+filename+".png")
-        blob = pool_bucket.get_blob(filename+".png")
-        if not blob:
-            logging.error(filename+".png not found")
-        
-        tmp = tempfile.NamedTemporaryFile(suffix=".png")
-        blob.download_to_file(tmp)
-        tmp.seek(0)
-        img = Image.open(tmp)
+        img, metadata = fetch_png(row)
         
         logging.info("Resize "+filename)
         scaled_img = resize_image(row, img)
 
-        tmp.close()
         logging.info("Finished loading "+filename)
-        return [scaled_img, blob.metadata]
+        return [scaled_img, metadata]
     except Exception as e:
         logging.error("Could not download "+filename+".png")
         logging.error(e)
         return 
 
 
-def generate_combined_spectrogram(location_name, width, time_start, time_end, bucket_name='deepblue-spectrograms'):
-    """ Generate a spectrogram of specific width for a given timeslot and location_name """
+def bin_edges(start, end, columns, target_resolution, width):
+    """ First tile column of a chunk and the source column positions of the edges of the tile columns it covers
+
+    The chunk covers start to end seconds since the start of the tile, its
+    column j goes to tile column floor((start + j * (end - start) / columns) / target_resolution).
+    """
+    first = max(0, math.floor(start / target_resolution))
+    last = min(width, math.ceil(end / target_resolution))
+    return first, (np.arange(first, max(first, last) + 1) * target_resolution - start) * columns / (end - start)
+
+
+def bin_columns(img, edges, reduction='mean', percentile=PERCENTILE):
+    """ Reduced source columns in every tile column and their counts
+
+    'mean' returns the sums and 'max' the maxima of the columns, each with
+    one reduceat. 'percentile' gathers the tile columns with the same count
+    into one block and sorts it, the value at the nearest rank is
+    returned. A tile column narrower than a source column repeats the
+    source column it is in.
+    """
+    columns = img.shape[1]
+    # An edge on a column start within rounding error starts there
+    edges = np.round(edges, 6)
+    lo = np.clip(np.ceil(edges), 0, columns).astype(np.int64)
+    counts = np.diff(lo)
+    filled = counts > 0
+    starts = np.where(filled, lo[:-1], np.clip(np.floor(edges[:-1]), 0, columns - 1).astype(np.int64))
+    counts = np.maximum(counts, 1)
+
+    if reduction == 'percentile':
+        # Tile columns of a chunk have one or two different counts, every
+        # count is one block. A stable sort of uint8 is a radix sort.
+        values = np.empty((img.shape[0], len(counts)), dtype=np.float32)
+        for n in np.unique(counts):
+            same = counts == n
+            block = img[:, starts[same, np.newaxis] + np.arange(n)]
+            kth = int(round(percentile / 100.0 * (n - 1)))
+            values[:, same] = np.sort(block, axis=2, kind='stable')[:, :, kth]
+        return values, counts.astype(np.float32)
+
+    values = np.empty((img.shape[0], len(counts)), dtype=np.float32)
+    # Without the empty tile columns the indices increase and every segment
+    # ends where the next one starts
+    ufunc = np.maximum if reduction == 'max' else np.add
+    values[:, filled] = ufunc.reduceat(img[:, :lo[-1]], lo[:-1][filled], axis=1, dtype=np.float32)
+    values[:, ~filled] = img[:, starts[~filled]]
+    return values, counts.astype(np.float32)
+
+
+def bin_chunk(img, start_offset, end_offset, row):
+    """ (first, values, counts) of a chunk on a tile starting start_offset seconds before it """
+    first, edges = bin_edges(start_offset, end_offset, img.shape[1],
+                             row['target_resolution'], row['width'])
+    if len(edges) < 2:
+        return
+    values, counts = bin_columns(img, edges, row['reduction'], row['percentile'])
+    return (first, values, counts)
+
+
+def fetch_binned_spectrogram_image(row):
+    """ Fetch spectrogram and reduce its columns to the tile resolution """
+
+    try:
+        filename = row['filename'].replace('.mp3','.wav')
+        img, metadata = fetch_png(row)
+        img = np.asarray(img if img.mode == 'L' else img.convert('L'))
+
+        # None without columns in the tile, the chunk was read all the same
+        return [bin_chunk(img, row['start_offset'], row['end_offset'], row), metadata]
+    except Exception as e:
+        logging.error("Could not download "+filename+".png")
+        logging.error(e)
+        return
+
+
+def fetch_binned_tiles(row):
+    """ Fetch spectrogram and reduce its columns on every tile it overlaps
+
+    row['tiles'] lists (tile, start_offset, end_offset) of the chunk relative
+    to the start of each tile, returns (tile, (first, values, counts)) of those
+    and the blob metadata.
+    """
+
+    try:
+        filename = row['filename'].replace('.mp3','.wav')
+        img, metadata = fetch_png(row)
+        img = np.asarray(img if img.mode == 'L' else img.convert('L'))
+
+        binned = []
+        for (tile, start_offset, end_offset) in row['tiles']:
+            b = bin_chunk(img, start_offset, end_offset, row)
+            if b is not None:
+                binned.append((tile, b))
+        return [binned, metadata]
+    except Exception as e:
+        logging.error("Could not download "+filename+".png")
+        logging.error(e)
+        return
+
+
+def compose_scaled(images, starts, target_resolution, height, width, mask=None):
+    """ Tile of resized chunk images pasted at their start second, mask is set where they are """
+    buffer = np.zeros((height, width), dtype=np.uint8)
+    arrays = [np.asarray(im if im.mode == 'L' else im.convert('L')) for im in images]
+    src, dst, count = timeline.placements(starts, [a.shape[1] for a in arrays], 1 / target_resolution, width)
+    return timeline.assemble(buffer, arrays, src, dst, count, axis=1, mask=mask)
+
+
+def compose_binned(binned, height, width, reduction='mean'):
+    """ Tile of the (first, values, counts) of the chunks
+
+    Chunks share the tile columns at their ends, 'mean' adds up the sums and
+    counts of both, the other reductions keep the larger value.
+    """
+    values = np.zeros((height, width), dtype=np.float32)
+    counts = np.zeros(width, dtype=np.float32)
+    for (first, v, c) in binned:
+        if reduction == 'mean':
+            values[:len(v), first:first + v.shape[1]] += v
+            counts[first:first + len(c)] += c
+        else:
+            np.maximum(values[:len(v), first:first + v.shape[1]], v, out=values[:len(v), first:first + v.shape[1]])
+    if reduction == 'mean':
+        values /= np.maximum(counts, 1)
+    return np.rint(values).astype(np.uint8)
+
+
+def latency_histogram(latencies, buckets=LATENCY_BUCKETS):
+    """ Number of latencies up to every bucket bound and above the last, as logging extra """
+    counts = np.histogram(latencies, [0] + list(buckets) + [np.inf])[0]
+    extra = dict(('latency_le_%g' % b, int(c)) for (b, c) in zip(buckets, counts))
+    extra['latency_gt_%g' % buckets[-1]] = int(counts[-1])
+    return extra
+
+
+def missing_metadata(mask, target_resolution):
+    """ 'missing' spans (seconds since the tile start) and 'missing_seconds' of a tile, empty without gaps """
+    missing = [(a * target_resolution, b * target_resolution) for (a, b) in timeline.gaps(mask)]
+    if not missing:
+        return {}
+    return {'missing': json.dumps([[round(a, 3), round(b, 3)] for (a, b) in missing]),
+            'missing_seconds': round(sum(b - a for (a, b) in missing), 3)}
+
+
+def fetch_chunks(rows, fetch, bucket_name, deadline=None, cancel=None):
+    """ fetch of every row in a pool, returns the results, the late rows and the latencies
+
+    Consecutive rows in a shard are read together in threads here (see
+    spectrogram_index.read_batch) and every row is decoded in the pool as
+    soon as its batch is read. With a deadline (seconds) the results of the
+    rows that did not arrive in time, read or decoded, are None and their
+    indices are returned as late. When nothing arrived in time it waits for
+    all. While waiting cancel() is checked every PREEMPT_SECONDS, when it
+    is true the fetches are stopped and Preempted is raised.
+    """
+    def pool_initializer():
+        global pool_bucket
+        pool_bucket = storage.Client().get_bucket(bucket_name)
+
+    start = time.time()
+    latencies = [None] * len(rows)
+    fetches = [None] * len(rows)
+
+    def arrived(i):
+        def callback(result):
+            latencies[i] = time.time() - start
+        return callback
+
+    def wait(result, until=None):
+        # Until the result is ready or the time until, checking cancel in between
+        while not result.ready() and (until is None or time.time() < until):
+            if cancel is not None and cancel():
+                raise Preempted()
+            timeout = None if until is None else until - time.time()
+            if cancel is not None:
+                timeout = PREEMPT_SECONDS if timeout is None else min(timeout, PREEMPT_SECONDS)
+            result.wait(timeout)
+
+    bucket = storage.Client().bucket(bucket_name)
+    groups = spectrogram_index.batches(rows, 'png')
+    firsts = [sum(len(g) for g in groups[:k]) for k in range(len(groups))]
+    finished = threading.Event()
+    # Not joined when done, a slow read must not hold the tile past the deadline
+    read_pool = ThreadPool(spectrogram_index.READ_THREADS)
+    try:
+        with multiprocessing.Pool(initializer=pool_initializer) as pool:
+            def submit(first, group):
+                if finished.is_set():
+                    return
+                for (j, row) in enumerate(spectrogram_index.read_batch(bucket, group, 'png')):
+                    fetches[first + j] = pool.apply_async(fetch, (row,), callback=arrived(first + j))
+
+            reads = [read_pool.apply_async(submit, (first, group)) for (first, group) in zip(firsts, groups)]
+            if deadline:
+                for r in reads:
+                    wait(r, start + deadline)
+                for f in list(fetches):
+                    if f is not None:
+                        wait(f, start + deadline)
+                if not any(f is not None and f.ready() and f.get() is not None for f in list(fetches)):
+                    logging.warning("No images after %.1fs, waiting for all" % deadline)
+                    deadline = None
+            if not deadline:
+                for r in reads:
+                    wait(r)
+                    r.get()
+                for f in fetches:
+                    wait(f)
+            # Rows whose batch was not read by the deadline are late too
+            ready = [f is not None and f.ready() for f in fetches]
+            results = [f.get() if ok else None for (f, ok) in zip(fetches, ready)]
+            late = [i for (i, ok) in enumerate(ready) if not ok]
+    finally:
+        finished.set()
+        read_pool.close()
+    latencies = [l for l in latencies if l is not None]
+    return results, late, latencies
+
+
+def generate_combined_spectrogram(location_name, width, time_start, time_end, bucket_name='deepblue-spectrograms',
+                                  reduction=REDUCTION, percentile=PERCENTILE, deadline=None, config_key=None,
+                                  cancel=None):
+    """ Generate a spectrogram of specific width for a given timeslot and location_name
+
+    Except for 'lanczos' the workers reduce the columns of their chunk on the
+    tile grid (see bin_columns) and the tile is combined from those.
+
+    Spans of the tile without chunks are listed in the 'missing' metadata (in
+    seconds since time_start). With a deadline (see fetch_chunks) chunks that
+    arrive late are missing too and the tile is 'partial'.
+
+    With a config_key the spectrograms of that spectrogram config are used.
+    cancel stops the download (see fetch_chunks).
+    """
+    tile_start = time.time()
+    if reduction not in REDUCTIONS:
+        raise ValueError("Unknown reduction %s" % reduction)
 
     duration = time_end - time_start
     target_resolution = duration.total_seconds() / width  # sec / px
-    # rows = query_audio_files_in_range(location_name, time_start, time_end)
-    rows = file_utils.query_audio_files_in_range(location_name, time_start, time_end)
+    width = math.ceil(duration.total_seconds() / target_resolution)
+    rows = tile_rows(location_name, time_start, time_end, bucket_name, config_key)
     if len(rows) == 0:
         logging.warning("No images in time range")
         return [None, None]
+    sources = source_key(rows)
 
-    for row in rows:
+    starts, ends = timeline.offsets(rows, time_start)
+    for (i, row) in enumerate(rows):
         row['target_resolution'] = target_resolution
+        row['width'] = width
+        row['start_offset'] = starts[i]
+        row['end_offset'] = ends[i]
+        row['reduction'] = reduction
+        row['percentile'] = percentile
 
     logging.info("Downloading %i images" % len(rows))
 
-    def pool_initializer():
-        global pool_bucket
-        pool_bucket = storage.Client().get_bucket(bucket_name)
-
-
-    with multiprocessing.Pool(initializer=pool_initializer) as pool:
-        images = pool.map(fetch_scaled_spectrogram_image, rows)
-
-    images = [i for i in images if i is not None]
+    fetch = fetch_scaled_spectrogram_image if reduction == 'lanczos' else fetch_binned_spectrogram_image
+    images, late, latencies = fetch_chunks(rows, fetch, bucket_name, deadline, cancel)
+    chunks = len(rows)
+    if late:
+        logging.warning("%i of %i images arrived after %.1fs" % (len(late), len(rows), deadline))
+
+    # Keep the rows in line with the downloaded images
+    if any(image is None for image in images):
+        sources = None
+    rows = [row for (row, image) in zip(rows, images) if image is not None and image[0] is not None]
+    images = [image for image in images if image is not None and image[0] is not None]
     if not images or len(images) == 0:
         logging.warning("No images in time range after download")
         return [None, None]
@@ -142,7 +532,10 @@ def generate_combined_spectrogram(location_name, width, time_start, time_end, bu
     logging.info("Download finished")
 
     # Verify height of spectrograms
-    _, heights = zip(*(i[0].size for i in images))
+    if reduction == 'lanczos':
+        heights = [i[0].size[1] for i in images]
+    else:
+        heights = [len(i[0][1]) for i in images]
     max_height = max(heights)
     min_height = min(heights)
     if max_height != min_height:
@@ -150,17 +543,17 @@ def generate_combined_spectrogram(location_name, width, time_start, time_end, bu
                       (min_height, max_height))
 
     # Create new output image
-    width = math.ceil(duration.total_seconds() / target_resolution)
-    new_im = Image.new('L', (width, max_height))
-
-    # Paste spectrograms into output image
-    for (i, im) in enumerate(images):
-        t = rows[i]['start_time'] - time_start
-        new_im.paste(
-            im[0], (math.floor(t.total_seconds() / target_resolution), 0))
-
-    for im in images:
-        im[0].close()
+    mask = np.zeros(width, dtype=bool)
+    if reduction == 'lanczos':
+        starts, _ = timeline.offsets(rows, time_start)
+        buffer = compose_scaled([im[0] for im in images], starts, target_resolution, max_height, width, mask)
+        for im in images:
+            im[0].close()
+    else:
+        buffer = compose_binned([im[0] for im in images], max_height, width, reduction)
+        for ((first, _, c), _) in images:
+            mask[first:first + len(c)] = True
+    new_im = Image.fromarray(buffer)
 
     metadata = images[0][1]
     if not metadata:
@@ -168,25 +561,297 @@ def generate_combined_spectrogram(location_name, width, time_start, time_end, bu
 
     metadata['duration'] = duration.total_seconds()
     metadata['target_resolution'] = target_resolution
+    # The requested width, width is rounded up
+    metadata.update(output_metadata(time_start, time_end, int(round(duration.total_seconds() / target_resolution)),
+                                    bucket_name, reduction, percentile, config_key))
     metadata['source_name'] = None
+    metadata.update(missing_metadata(mask, target_resolution))
+    if sources:
+        metadata['sources'] = sources
+    if late:
+        metadata['partial'] = True
+        metadata['late_chunks'] = len(late)
+
+    extra = latency_histogram(latencies)
+    extra.update(tile_seconds=time.time() - tile_start, chunks=chunks, late_chunks=len(late),
+                 missing_seconds=metadata.get('missing_seconds', 0))
+    logging.info("Tile finished", extra=extra)
 
     return [new_im, metadata]
 
 
-def store_image(im, metadata, destination="", upload=True):
-    """ Upload image to cloud storage """
-    tmp = tempfile.NamedTemporaryFile(suffix=".jpg")
-    im.save(tmp, format='jpeg', optimize=True, quality=80)
-    tmp.seek(0)
-    
+def generate_tile_batch(location_name, zoom, time_start, time_end, width=512, bucket_name='deepblue-spectrograms',
+                        reduction=REDUCTION, percentile=PERCENTILE, denoise=None, upload=True,
+                        image_format=OUTPUT_FORMAT, config_key=None):
+    """ Render all tiles at zoom between time_start and time_end in one pass
+
+    The chunks are queried once and scanned in time order, every chunk is
+    downloaded once and reduced on all tiles it overlaps. A tile is composed
+    and uploaded as soon as the scan has passed its end. Returns the
+    destinations of the tiles.
+    """
+    if reduction not in REDUCTIONS or reduction == 'lanczos':
+        raise ValueError("Reduction %s is not supported in batch mode" % reduction)
+    if denoise is None:
+        denoise = bucket_name.endswith('-denoise')
+
+    duration = tile_duration(zoom)
+    target_resolution = duration / width  # sec / px
+    starts = tile_starts(zoom, time_start, time_end)
+    if len(starts) == 0:
+        return []
+    origin = starts[0]
+
+    end = origin + datetime.timedelta(seconds=len(starts) * duration)
+    # The tiles can start before time_start and end after time_end
+    rows = tile_rows(location_name, origin, end, bucket_name, config_key)
+    if len(rows) == 0:
+        logging.warning("No images in time range")
+        return []
+    rows = sorted(rows, key=lambda row: row['start_time'])
+
+    # Offsets of every chunk relative to the start of the tiles it overlaps
+    chunk_starts, chunk_ends = timeline.offsets(rows, origin)
+    for (i, row) in enumerate(rows):
+        first = max(0, math.floor(chunk_starts[i] / duration))
+        last = min(len(starts), math.ceil(chunk_ends[i] / duration))
+        row['tiles'] = [(t, chunk_starts[i] - t * duration, chunk_ends[i] - t * duration) for t in range(first, last)]
+        row['target_resolution'] = target_resolution
+        row['width'] = width
+        row['reduction'] = reduction
+        row['percentile'] = percentile
+
+    logging.info("Rendering %i tiles from %i images" % (len(starts), len(rows)))
+
+    def pool_initializer():
+        global pool_bucket
+        pool_bucket = storage.Client().get_bucket(bucket_name)
+
+    open_tiles = {}
+    tile_metadata = {}
+    failed = set()
+    destinations = []
+    uploads = []
+
+    def finish(tile, upload_pool):
+        binned = open_tiles.pop(tile)
+        height = max(len(b[1]) for b in binned)
+        im = Image.fromarray(compose_binned(binned, height, width, reduction))
+        metadata = dict(tile_metadata.pop(tile) or {})
+        metadata['duration'] = duration
+        metadata['target_resolution'] = target_resolution
+        metadata.update(output_metadata(starts[tile], starts[tile] + datetime.timedelta(seconds=duration),
+                                        width, bucket_name, reduction, percentile, config_key))
+        metadata['source_name'] = None
+        # Gaps like in generate_combined_spectrogram, batches have no deadline so no tile is partial
+        mask = np.zeros(width, dtype=bool)
+        for (first, _, c) in binned:
+            mask[first:first + len(c)] = True
+        metadata.update(missing_metadata(mask, target_resolution))
+        # The chunks generate_combined_spectrogram renders the tile from
+        tile_end = starts[tile] + datetime.timedelta(seconds=duration)
+        overlap = [i for (i, row) in enumerate(rows) if row['end_time'] >= starts[tile] and row['start_time'] < tile_end]
+        sources = source_key([rows[i] for i in overlap])
+        if sources and not failed.intersection(overlap):
+            metadata['sources'] = sources
+        destination = tile_destination(location_name, zoom, starts[tile], denoise)
+        destinations.append(destination)
+        logging.info("Tile %s finished" % destination)
+        uploads.append(upload_pool.apply_async(store_image, (im, metadata, destination, upload, image_format)))
+
+    with ThreadPool(UPLOAD_THREADS) as upload_pool:
+        with multiprocessing.Pool(initializer=pool_initializer) as pool:
+            # imap keeps the time order, the chunks after this one start later
+            groups = spectrogram_index.batches(rows, 'png')
+            reads = spectrogram_index.read_batches(storage.Client().bucket(bucket_name), groups, 'png')
+            results = pool.imap(fetch_binned_tiles, reads)
+            for (i, result) in enumerate(results):
+                for tile in sorted(t for t in open_tiles if (t + 1) * duration <= chunk_starts[i]):
+                    finish(tile, upload_pool)
+                if result is None:
+                    failed.add(i)
+                    continue
+                (binned, metadata) = result
+                for (tile, b) in binned:
+                    open_tiles.setdefault(tile, []).append(b)
+                    tile_metadata.setdefault(tile, metadata)
+
+        for tile in sorted(open_tiles):
+            finish(tile, upload_pool)
+        for u in uploads:
+            u.get()
+
+    logging.info("Batch finished, %i tiles" % len(destinations))
+    return destinations
+
+
+def tile_zoom(time_start, time_end):
+    """ Zoom level of the client tile from time_start to time_end, None if it is not one """
+    zoom = math.log2(3600 / (time_end - time_start).total_seconds())
+    if abs(zoom - round(zoom)) > 1e-9:
+        return None
+    zoom = int(round(zoom))
+    if tile_starts(zoom, time_start, time_end) != [time_start]:
+        return None
+    return zoom
+
+
+def related_tiles(zoom, tile_start):
+    """ (zoom, start) of the tiles a client is likely to request after a tile
+
+    The next and previous tile at the same zoom, the parent tile and the two
+    child tiles up to MAX_ZOOM, most likely first.
+    """
+    duration = datetime.timedelta(seconds=tile_duration(zoom))
+    tiles = [(zoom, tile_start + duration), (zoom, tile_start - duration),
+             (zoom - 1, tile_starts(zoom - 1, tile_start, tile_start + duration)[0])]
+    if zoom < MAX_ZOOM:
+        tiles += [(zoom + 1, tile_start), (zoom + 1, tile_start + duration / 2)]
+    return tiles
+
+
+class Prefetcher(object):
+    """ Renders the related_tiles of requested tiles while the worker is idle
+
+    Partial tiles (see DEADLINE) are rendered again the same way.
+
+    The tiles queued last are rendered first, beyond PREFETCH_BUDGET the
+    oldest are dropped. Tiles that exist already are not rendered again. A
+    job that starts while a tile is prefetched preempts it, the tile is
+    queued again. A request for a prefetched tile counts as a hit, the stats
+    are logged after every prefetched tile.
+    """
+
+    def __init__(self, budget=PREFETCH_BUDGET):
+        self.budget = budget
+        self.queue = collections.OrderedDict()
+        self.retries = set()
+        self.prefetched = collections.OrderedDict()
+        self.stats = collections.Counter()
+        self.condition = threading.Condition()
+        self.active = 0
+        self.last_active = 0
+
+    def begin(self, destination):
+        """ A job for destination started """
+        with self.condition:
+            self.active += 1
+            self.stats['requests'] += 1
+            self.queue.pop(destination, None)
+            self.retries.discard(destination)
+            if self.prefetched.pop(destination, None):
+                self.stats['hits'] += 1
+
+    def end(self):
+        """ A job finished """
+        with self.condition:
+            self.active -= 1
+            self.last_active = time.time()
+            self.condition.notify()
+
+    def add(self, experiment_name, destination, job, image_format=OUTPUT_FORMAT):
+        """ Queue the related tiles of the tile job rendered to destination """
+        parts = destination.split('/')
+        zoom = tile_zoom(job['time_start'], job['time_end'])
+        if not PREFETCH or zoom is None or len(parts) != 3 or not parts[0].startswith('tiles-'):
+            return
+        with self.condition:
+            # Most likely last, it is rendered first
+            for (z, start) in reversed(related_tiles(zoom, job['time_start'])):
+                d = tile_destination(parts[1], z, start, parts[0].endswith('-denoise'))
+                if d in self.prefetched or d in self.retries:
+                    continue
+                end = start + datetime.timedelta(seconds=tile_duration(z))
+                self.queue[d] = (experiment_name, dict(job, time_start=start, time_end=end), image_format)
+                self.queue.move_to_end(d)
+                self.stats['queued'] += 1
+            while len(self.queue) > self.budget:
+                self.retries.discard(self.queue.popitem(last=False)[0])
+                self.stats['dropped'] += 1
+            self.condition.notify()
+
+    def retry(self, experiment_name, destination, job, image_format=OUTPUT_FORMAT):
+        """ Queue a partial tile to be rendered again without deadline, before the prefetches (see pop) """
+        with self.condition:
+            self.queue[destination] = (experiment_name, job, image_format)
+            self.queue.move_to_end(destination)
+            self.retries.add(destination)
+            self.stats['retries'] += 1
+            self.condition.notify()
+
+    def pop(self):
+        """ Take the next tile from the queue, partial tiles first, with the condition held """
+        destination = next((d for d in reversed(self.queue) if d in self.retries), next(reversed(self.queue)))
+        (experiment_name, job, image_format) = self.queue.pop(destination)
+        retry = destination in self.retries
+        self.retries.discard(destination)
+        return destination, experiment_name, job, image_format, retry
+
+    def extra(self):
+        """ Stats as logging extra, hit_rate is the part of the requests that were prefetched """
+        extra = dict(('prefetch_' + k, v) for (k, v) in self.stats.items())
+        extra['prefetch_hit_rate'] = self.stats['hits'] / max(1, self.stats['requests'])
+        return extra
+
+    def render(self, destination, experiment_name, job, image_format, retry=False):
+        """ Render and store one queued tile """
+        if output_exists(destination, current_metadata(experiment_name, job, image_format)):
+            with self.condition:
+                self.stats['present'] += 1
+            return
+        try:
+            with render_lock:
+                im, metadata = generate_combined_spectrogram(location_name=experiment_name,
+                                                             cancel=lambda: self.active > 0, **job)
+        except Preempted:
+            with self.condition:
+                self.queue[destination] = (experiment_name, job, image_format)
+                if retry:
+                    self.retries.add(destination)
+                self.stats['preempted'] += 1
+            logging.info("Preempted prefetch of %s" % destination)
+            return
+        if not im or not metadata:
+            with self.condition:
+                self.stats['empty'] += 1
+            return
+        store_image(im, metadata, destination, image_format=image_format)
+        if retry:
+            with self.condition:
+                self.stats['retried'] += 1
+            logging.info("Replaced partial tile %s" % destination, extra=self.extra())
+            return
+        with self.condition:
+            self.prefetched[destination] = True
+            # Remember a few budgets of tiles for the hit rate
+            while len(self.prefetched) > 16 * self.budget:
+                self.prefetched.popitem(last=False)
+            self.stats['rendered'] += 1
+        logging.info("Prefetched %s" % destination, extra=self.extra())
+
+    def run(self):
+        """ Render queued tiles when idle, forever """
+        while True:
+            with self.condition:
+                while not self.queue or self.active or time.time() - self.last_active < PREFETCH_IDLE_SECONDS:
+                    self.condition.wait(PREFETCH_IDLE_SECONDS)
+                (destination, experiment_name, job, image_format, retry) = self.pop()
+            try:
+                self.render(destination, experiment_name, job, image_format, retry)
+            except Exception as e:
+                logging.exception("Exception of type %s during prefetch" % e)
+
+
+prefetcher = Prefetcher()
+
+
+def store_image(im, metadata, destination="", upload=True, image_format=OUTPUT_FORMAT):
+    """ Encode image in memory and upload it to cloud storage """
     if upload:
         output_bucket = storage.Client().get_bucket(OUTPUT_BUCKET_NAME)
         blob = output_bucket.blob("{}".format(destination))
-        blob.upload_from_filename(tmp.name)
-        blob.metadata = metadata
-        blob.patch()
-        logging.info("Saved to %s" % destination)
-    tmp.close()
+        size = image_encoding.upload(blob, im, metadata, image_format)
+        logging.info("Saved to %s" % destination, extra={'format': image_format, 'bytes': size})
 
 
 
@@ -198,19 +863,46 @@ if __name__ == "__main__":
     parser.add_argument('--bucket-name', default='deepblue-spectrograms')
     parser.add_argument('--destination', default='test.jpg')
     parser.add_argument('--location_name', default='Hawaii')
+    parser.add_argument('--reduction', choices=REDUCTIONS, default=REDUCTION,
+                        help="How source columns are combined into a tile column")
+    parser.add_argument('--percentile', type=float, default=PERCENTILE,
+                        help="Percentile of the 'percentile' reduction")
+    parser.add_argument('--batch', action='store_true',
+                        help="Render all tiles at --zoom between the start and end time")
+    parser.add_argument('--zoom', type=int, default=0)
+    parser.add_argument('--format', choices=sorted(image_encoding.FORMATS), default=OUTPUT_FORMAT)
+    parser.add_argument('--config-key', help="Render the spectrograms of this non default spectrogram config")
 
     if len(sys.argv) == 1:
-        worker.pull_pubsub_streaming(PUBSUB_SUBSCRIPTION, pubsub_callback, fetch_filelist)
+        threading.Thread(target=prefetcher.run, daemon=True).start()
+        worker.pull_pubsub_streaming(PUBSUB_SUBSCRIPTION, pubsub_callback, fetch_filelist, key=job_key)
     else :
         args = parser.parse_args()
 
+        if args.batch:
+            generate_tile_batch(
+                location_name=args.location_name,
+                zoom=args.zoom,
+                time_start=datetime.datetime.strptime(' '.join(args.start_time), "%Y-%m-%d %H:%M:%S.%f %z"),
+                time_end=datetime.datetime.strptime(' '.join(args.end_time), "%Y-%m-%d %H:%M:%S.%f %z"),
+                width=args.width,
+                bucket_name=args.bucket_name,
+                reduction=args.reduction,
+                percentile=args.percentile,
+                image_format=args.format,
+                config_key=args.config_key
+            )
+            sys.exit()
+
         im, metadata = generate_combined_spectrogram(
             location_name=args.location_name,
             width=args.width,
             time_start=datetime.datetime.strptime(' '.join(args.start_time), "%Y-%m-%d %H:%M:%S.%f %z"),
             time_end=datetime.datetime.strptime(' '.join(args.end_time), "%Y-%m-%d %H:%M:%S.%f %z"),
-            bucket_name=args.bucket_name
-            
+            bucket_name=args.bucket_name,
+            reduction=args.reduction,
+            percentile=args.percentile,
+            config_key=args.config_key
         )
-        store_image(im, metadata, upload=True, destination=args.destination)
+        store_image(im, metadata, upload=True, destination=args.destination, image_format=args.format)
         
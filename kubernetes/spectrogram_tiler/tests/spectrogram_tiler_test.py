@@ -0,0 +1,210 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import datetime
+import types
+import pytz
+import numpy as np
+from spectrogram_tiler import spectrogram_tiler
+
+
+def box_reduce(img, start, end, target_resolution, width, fn=np.mean):
+    """ Tile columns reduced from the source columns starting in them, one at a time """
+    dt = (end - start) / img.shape[1]
+    cols = np.floor((start + np.arange(img.shape[1]) * dt) / target_resolution).astype(int)
+    out = {}
+    for c in range(width):
+        if (cols == c).any():
+            out[c] = fn(img[:, cols == c], axis=1)
+    return out
+
+
+class TestSpectrogramTiler(unittest.TestCase):
+
+    def testBinEdges(self):
+        # 10 columns of 0.5s from 1s, tile columns of 1s
+        first, edges = spectrogram_tiler.bin_edges(1.0, 6.0, 10, 1.0, 8)
+        self.assertEqual(first, 1)
+        np.testing.assert_array_equal(edges, [0, 2, 4, 6, 8, 10])
+        # Cropped at both ends of the tile
+        first, edges = spectrogram_tiler.bin_edges(-2.0, 3.0, 10, 1.0, 2)
+        self.assertEqual(first, 0)
+        np.testing.assert_array_equal(edges, [4, 6, 8])
+
+    def testBinColumns(self):
+        rng = np.random.RandomState(0)
+        img = (rng.rand(4, 37) * 255).astype(np.uint8)
+        for (start, end, res) in [(0.3, 4.1, 0.25), (-1.0, 2.7, 0.6), (0.0, 3.7, 0.1)]:
+            width = 12
+            first, edges = spectrogram_tiler.bin_edges(start, end, img.shape[1], res, width)
+            sums, counts = spectrogram_tiler.bin_columns(img, edges)
+            expected = box_reduce(img, start, end, res, width)
+            for (i, c) in enumerate(range(first, first + len(edges) - 1)):
+                if c in expected:
+                    np.testing.assert_allclose(sums[:, i] / counts[i], expected[c], rtol=1e-5)
+
+    def testMaxAndPercentile(self):
+        rng = np.random.RandomState(1)
+        img = (rng.rand(4, 53) * 255).astype(np.uint8)
+        # The nearest rank, by hand so the test runs with the numpy of the service
+        percentile = lambda x, axis: np.take(np.sort(x, axis=axis), int(round(0.9 * (x.shape[axis] - 1))), axis=axis)
+        for (reduction, fn) in [('max', np.max), ('percentile', percentile)]:
+            for (start, end, res) in [(0.3, 4.1, 0.25), (-1.0, 2.7, 0.6)]:
+                first, edges = spectrogram_tiler.bin_edges(start, end, img.shape[1], res, 12)
+                values, _ = spectrogram_tiler.bin_columns(img, edges, reduction, percentile=90)
+                expected = box_reduce(img, start, end, res, 12, fn)
+                for (i, c) in enumerate(range(first, first + len(edges) - 1)):
+                    if c in expected:
+                        np.testing.assert_array_equal(values[:, i], expected[c])
+
+    def testComposeShared(self):
+        # Two chunks share tile column 1
+        binned = [(0, np.array([[10, 20]], np.float32), np.array([2, 1], np.float32)),
+                  (1, np.array([[40, 30]], np.float32), np.array([1, 2], np.float32))]
+        np.testing.assert_array_equal(spectrogram_tiler.compose_binned(binned, 1, 3, 'mean'), [[5, 30, 15]])
+        np.testing.assert_array_equal(spectrogram_tiler.compose_binned(binned, 1, 3, 'max'), [[10, 40, 30]])
+
+    def testUpsampled(self):
+        # Tile columns narrower than the source columns repeat them
+        img = np.arange(4, dtype=np.uint8)[np.newaxis]
+        first, edges = spectrogram_tiler.bin_edges(0.0, 4.0, 4, 0.5, 8)
+        sums, counts = spectrogram_tiler.bin_columns(img, edges)
+        np.testing.assert_array_equal(sums[0] / counts, [0, 0, 1, 1, 2, 2, 3, 3])
+
+    def testTileDestination(self):
+        start = datetime.datetime(2015, 3, 1, 12, 15, tzinfo=pytz.utc)
+        self.assertEqual(spectrogram_tiler.tile_destination('Hawaii', 2, start),
+                         'tiles-2/Hawaii/2015_03_01T12_15_00.jpg')
+        self.assertEqual(spectrogram_tiler.tile_destination('Hawaii', -3, start, denoise=True),
+                         'tiles-n3-denoise/Hawaii/2015_03_01T12_15_00.jpg')
+
+    def testTileStarts(self):
+        # Tiles of 15 minutes aligned to the epoch
+        start = datetime.datetime(2015, 3, 1, 12, 20, tzinfo=pytz.utc)
+        end = datetime.datetime(2015, 3, 1, 12, 45, tzinfo=pytz.utc)
+        starts = spectrogram_tiler.tile_starts(2, start, end)
+        self.assertEqual([s.minute for s in starts], [15, 30])
+
+    def testRelatedTiles(self):
+        start = datetime.datetime(2015, 3, 1, 12, 15, tzinfo=pytz.utc)
+        end = datetime.datetime(2015, 3, 1, 12, 30, tzinfo=pytz.utc)
+        self.assertEqual(spectrogram_tiler.tile_zoom(start, end), 2)
+        self.assertIsNone(spectrogram_tiler.tile_zoom(start, start + datetime.timedelta(minutes=10)))
+        self.assertIsNone(spectrogram_tiler.tile_zoom(start + datetime.timedelta(minutes=5),
+                                                      end + datetime.timedelta(minutes=5)))
+        tiles = [(z, t.strftime('%H:%M:%S')) for (z, t) in spectrogram_tiler.related_tiles(2, start)]
+        self.assertEqual(tiles, [(2, '12:30:00'), (2, '12:00:00'), (1, '12:00:00'),
+                                 (3, '12:15:00'), (3, '12:22:30')])
+
+    def testPrefetchQueue(self):
+        prefetcher = spectrogram_tiler.Prefetcher(budget=4)
+        start = datetime.datetime(2015, 3, 1, 12, 15, tzinfo=pytz.utc)
+        job = dict(time_start=start, time_end=start + datetime.timedelta(minutes=15), width=512)
+        prefetcher.add('Hawaii', 'tiles-2/Hawaii/2015_03_01T12_15_00.jpg', job)
+        # The oldest (least likely) tile is dropped, the next tile is first
+        self.assertEqual(len(prefetcher.queue), 4)
+        self.assertEqual(prefetcher.stats['dropped'], 1)
+        destination = next(reversed(prefetcher.queue))
+        self.assertEqual(destination, 'tiles-2/Hawaii/2015_03_01T12_30_00.jpg')
+        self.assertEqual(prefetcher.queue[destination][1]['time_start'], start + datetime.timedelta(minutes=15))
+        # A request takes the tile out of the queue
+        prefetcher.begin(destination)
+        prefetcher.end()
+        self.assertNotIn(destination, prefetcher.queue)
+        self.assertEqual(prefetcher.stats['hits'], 0)
+
+    def testLatencyHistogram(self):
+        extra = spectrogram_tiler.latency_histogram([0.1, 0.3, 0.4, 3, 20], [0.5, 4])
+        self.assertEqual(extra, {'latency_le_0.5': 3, 'latency_le_4': 1, 'latency_gt_4': 1})
+
+    def testPrefetchRetry(self):
+        prefetcher = spectrogram_tiler.Prefetcher(budget=8)
+        start = datetime.datetime(2015, 3, 1, 12, 15, tzinfo=pytz.utc)
+        job = dict(time_start=start, time_end=start + datetime.timedelta(minutes=15), width=512)
+        destination = 'tiles-2/Hawaii/2015_03_01T12_15_00.jpg'
+        prefetcher.retry('Hawaii', destination, job)
+        prefetcher.add('Hawaii', destination, job)
+        # The partial tile goes before the related tiles queued after it
+        (d, _, _, _, retry) = prefetcher.pop()
+        self.assertEqual(d, destination)
+        self.assertTrue(retry)
+        (d, _, _, _, retry) = prefetcher.pop()
+        self.assertEqual(d, 'tiles-2/Hawaii/2015_03_01T12_30_00.jpg')
+        self.assertFalse(retry)
+
+    def testPrefetchPreempted(self):
+        prefetcher = spectrogram_tiler.Prefetcher(budget=8)
+        start = datetime.datetime(2015, 3, 1, 12, 15, tzinfo=pytz.utc)
+        job = dict(time_start=start, time_end=start + datetime.timedelta(minutes=15), width=512)
+        destination = 'tiles-2/Hawaii/2015_03_01T12_15_00.jpg'
+
+        def generate(location_name, cancel, **job):
+            # A job starts during the download
+            prefetcher.begin('tiles-2/Hawaii/2015_03_01T12_45_00.jpg')
+            if cancel():
+                raise spectrogram_tiler.Preempted()
+
+        (output_exists, generate_combined_spectrogram) = (spectrogram_tiler.output_exists,
+                                                          spectrogram_tiler.generate_combined_spectrogram)
+        (spectrogram_tiler.output_exists, spectrogram_tiler.generate_combined_spectrogram) = (
+            lambda destination, metadata: False, generate)
+        current_metadata = spectrogram_tiler.current_metadata
+        spectrogram_tiler.current_metadata = lambda location_name, job, image_format: {}
+        try:
+            prefetcher.render(destination, 'Hawaii', job, 'jpeg', retry=True)
+        finally:
+            spectrogram_tiler.output_exists = output_exists
+            spectrogram_tiler.generate_combined_spectrogram = generate_combined_spectrogram
+            spectrogram_tiler.current_metadata = current_metadata
+        # The tile is rendered again after the job
+        self.assertEqual(prefetcher.stats['preempted'], 1)
+        self.assertIn(destination, prefetcher.queue)
+        self.assertIn(destination, prefetcher.retries)
+        self.assertFalse(spectrogram_tiler.render_lock.locked())
+
+    def testSourceKey(self):
+        rows = [{'filename': 'x.%04d.mp3' % i, 'index': {'png': {'generation': 1}}} for i in range(3)]
+        key = spectrogram_tiler.source_key(rows)
+        self.assertEqual(spectrogram_tiler.source_key(list(reversed(rows))), key)
+        # A chunk written again changes the key
+        rows[1]['index']['png']['generation'] = 2
+        self.assertNotEqual(spectrogram_tiler.source_key(rows), key)
+        # Not all chunks are indexed (yet)
+        rows[2]['index']['png'] = None
+        self.assertIsNone(spectrogram_tiler.source_key(rows))
+
+    def testOutputExists(self):
+        blobs = {}
+        bucket = types.SimpleNamespace(get_blob=lambda name: blobs.get(name))
+        storage = spectrogram_tiler.storage
+        spectrogram_tiler.storage = types.SimpleNamespace(Client=lambda: types.SimpleNamespace(get_bucket=lambda n: bucket))
+        try:
+            expected = {'width': 512, 'sources': 'abc'}
+            blobs['a'] = types.SimpleNamespace(metadata={'width': '512', 'sources': 'abc', 'missing': '[[0, 1]]'})
+            self.assertTrue(spectrogram_tiler.output_exists('a', expected))
+            self.assertFalse(spectrogram_tiler.output_exists('a', dict(expected, sources='def')))
+            # Missing spans without sources can have been filled in since
+            blobs['b'] = types.SimpleNamespace(metadata={'width': '512', 'missing': '[[0, 1]]'})
+            self.assertFalse(spectrogram_tiler.output_exists('b', {'width': 512}))
+            blobs['c'] = types.SimpleNamespace(metadata={'width': '512'})
+            self.assertTrue(spectrogram_tiler.output_exists('c', {'width': 512}))
+        finally:
+            spectrogram_tiler.storage = storage
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+#
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compose tiles from synthetic chunks with every reduction, without the
+# downloads. Quality is compared with an area (box) average of the full
+# resolution timeline, "calls" is the mean tile value at the short calls
+# in the chunks (230 on a background of 60).
+#
+#   python -m spectrogram_tiler.tools.benchmark --zoom -2 0 2 5
+#
+# With --formats the 'mean' tiles are encoded in every output format instead,
+# with the CPU time and size of each.
+#
+#   python -m spectrogram_tiler.tools.benchmark --formats jpeg progressive webp png
+
+import argparse
+import pickle
+import time
+import cv2
+import numpy as np
+from PIL import Image
+from common_lib import image_encoding
+from spectrogram_tiler import spectrogram_tiler
+
+CHUNK_SECONDS = 43.75
+CHUNK_COLUMNS = 3768
+HEIGHT = 256
+
+
+def chunk(i):
+    """ Noise with a few short bright calls, returns the image and the (row, column) of the calls """
+    rng = np.random.RandomState(i)
+    img = rng.normal(60, 15, (HEIGHT, CHUNK_COLUMNS))
+    calls = []
+    for _ in range(3):
+        col = rng.randint(0, CHUNK_COLUMNS - 40)
+        row = rng.randint(0, HEIGHT - 20)
+        img[row:row + 20, col:col + 40] = 230
+        calls.append((row + 10, col + 20))
+    return np.clip(img, 0, 255).astype(np.uint8), calls
+
+
+def compose(reduction, chunks, starts, target_resolution, width, percentile=spectrogram_tiler.PERCENTILE):
+    """ What the workers and generate_combined_spectrogram do for every chunk, returns tile and pickled bytes """
+    results = []
+    for (img, start) in zip(chunks, starts):
+        end = start + CHUNK_SECONDS
+        if reduction == 'lanczos':
+            size = int(np.ceil(CHUNK_SECONDS / target_resolution))
+            results.append(Image.fromarray(img).resize((size, HEIGHT), Image.LANCZOS))
+        else:
+            first, edges = spectrogram_tiler.bin_edges(start, end, img.shape[1], target_resolution, width)
+            results.append((first,) + spectrogram_tiler.bin_columns(img, edges, reduction, percentile))
+    sent = sum(len(pickle.dumps(r)) for r in results)
+    if reduction == 'lanczos':
+        return spectrogram_tiler.compose_scaled(results, starts, target_resolution, HEIGHT, width), sent
+    return spectrogram_tiler.compose_binned(results, HEIGHT, width, reduction), sent
+
+
+def encode(tile, image_format, repeat=5):
+    """ CPU seconds of encoding tile in image_format and the bytes, best of repeat """
+    im = Image.fromarray(tile)
+    best = None
+    for _ in range(repeat):
+        t = time.process_time()
+        data = image_encoding.encode(im, image_format)
+        d = time.process_time() - t
+        best = d if best is None else min(best, d)
+    return best, len(data)
+
+
+def reference(chunks, width):
+    timeline = np.hstack(chunks)
+    return cv2.resize(timeline.astype(np.float32), (width, HEIGHT), interpolation=cv2.INTER_AREA)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Tile composition benchmark")
+    parser.add_argument('--zoom', type=int, nargs='+', default=[-2, 0, 2, 5],
+                        help="Zoom levels, a tile is 3600 / 2^zoom seconds")
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--reductions', nargs='+', default=spectrogram_tiler.REDUCTIONS)
+    parser.add_argument('--percentile', type=float, default=spectrogram_tiler.PERCENTILE)
+    parser.add_argument('--formats', nargs='+', choices=sorted(image_encoding.FORMATS),
+                        help="Benchmark encoding the tiles in these formats")
+    args = parser.parse_args()
+
+    for zoom in args.zoom:
+        duration = 3600.0 / 2**zoom
+        n = int(np.ceil(duration / CHUNK_SECONDS))
+        chunks, calls = zip(*[chunk(i) for i in range(n)])
+        starts = np.arange(n) * CHUNK_SECONDS
+        target_resolution = n * CHUNK_SECONDS / args.width
+        ref = reference(chunks, args.width)
+        call_px = [(row, int((start + col * CHUNK_SECONDS / CHUNK_COLUMNS) / target_resolution))
+                   for (start, chunk_calls) in zip(starts, calls) for (row, col) in chunk_calls]
+        rows, cols = np.array(call_px).T
+        print("zoom %i: %i chunks, %.2fs per column" % (zoom, n, target_resolution))
+        if args.formats:
+            tile, _ = compose('mean', chunks, starts, target_resolution, args.width)
+            for image_format in args.formats:
+                d, size = encode(tile, image_format)
+                print("  %-12s %7.2fms cpu %8.1f KB" % (image_format, d * 1e3, size / 1e3))
+            continue
+        for reduction in args.reductions:
+            t = time.time()
+            tile, sent = compose(reduction, chunks, starts, target_resolution, args.width, args.percentile)
+            d = time.time() - t
+            diff = np.abs(tile.astype(np.float32) - ref)
+            print("  %-10s %7.3fs %8.1f KB pickled, diff to area average mean %6.2f, calls %5.1f background %5.1f" % (
+                reduction, d, sent / 1e3, diff.mean(), tile[rows, cols].mean(), np.median(tile)))